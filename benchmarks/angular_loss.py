@@ -0,0 +1,97 @@
+'''
+该文件的功能：检查向量化的AngularPenaltySMLoss与原实现的数值一致性，并比较不同batch size下前向与反向传播的耗时
+
+用法：python benchmarks/angular_loss.py --batch_sizes 32 128 512 2048 --num_classes 54
+'''
+import argparse
+import copy
+import os
+import sys
+import time
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from losses.arcface_loss import AngularPenaltySMLoss
+
+
+def original_forward(loss, x, labels):
+    ''' 原实现：逐个样本拼接非目标类的logits，并通过B x B的矩阵取出目标类的logits；对权重的归一化不起作用
+    '''
+    for W in loss.fc.parameters():
+        W = F.normalize(W, p=2, dim=1)
+
+    x = F.normalize(x, p=2, dim=1)
+
+    wf = loss.fc(x)
+    if loss.loss_type == 'cosface':
+        numerator = loss.s * (torch.diagonal(wf.transpose(0, 1)[labels]) - loss.m)
+    if loss.loss_type == 'arcface':
+        numerator = loss.s * torch.cos(torch.acos(torch.clamp(torch.diagonal(wf.transpose(0, 1)[labels]), -1. + loss.eps, 1 - loss.eps)) + loss.m)
+    if loss.loss_type == 'sphereface':
+        numerator = loss.s * torch.cos(loss.m * torch.acos(torch.clamp(torch.diagonal(wf.transpose(0, 1)[labels]), -1. + loss.eps, 1 - loss.eps)))
+
+    excl = torch.cat([torch.cat((wf[i, :y], wf[i, y + 1:])).unsqueeze(0) for i, y in enumerate(labels)], dim=0)
+    denominator = torch.exp(numerator) + torch.sum(torch.exp(loss.s * excl), dim=1)
+    L = numerator - torch.log(denominator)
+    return -torch.mean(L)
+
+
+def check_parity(loss, x, labels):
+    ''' 原实现没有归一化权重，权重的每一行都归一化为单位长度时两者应当相同
+
+    Return:
+        float, 损失值的绝对误差与输入梯度的最大绝对误差
+    '''
+    loss = copy.deepcopy(loss)
+    with torch.no_grad():
+        loss.fc.weight.copy_(F.normalize(loss.fc.weight, p=2, dim=1))
+    results = []
+    for forward in (original_forward, lambda loss, x, labels: loss(x, labels)):
+        inputs = x.clone().requires_grad_(True)
+        value = forward(loss, inputs, labels)
+        value.backward()
+        results.append((value.detach(), inputs.grad))
+    (expected, expected_grad), (value, grad) = results
+    return (value - expected).abs().item(), (grad - expected_grad).abs().max().item()
+
+
+def time_loss(forward, loss, x, labels, steps):
+    ''' 返回前向与反向传播耗时的中位数（毫秒）
+    '''
+    inputs = x.clone().requires_grad_(True)
+    times = []
+    for _ in range(steps + 1):
+        start = time.perf_counter()
+        forward(loss, inputs, labels).backward()
+        if inputs.is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    # 第一步包含内存分配等开销，不计入
+    times = sorted(times[1:])
+    return times[len(times) // 2] * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 128, 512, 2048])
+    parser.add_argument('--num_classes', type=int, default=54)
+    parser.add_argument('--in_features', type=int, default=1024)
+    parser.add_argument('--steps', type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    print('%-11s %6s %14s %14s %9s %10s %10s' % (
+        'loss', 'batch', 'original (ms)', 'vectorized (ms)', 'speedup', 'loss err', 'grad err'))
+    for loss_type in ('arcface', 'sphereface', 'cosface'):
+        loss = AngularPenaltySMLoss(args.in_features, args.num_classes, loss_type=loss_type).to(device)
+        for batch_size in args.batch_sizes:
+            x = torch.randn(batch_size, args.in_features, device=device)
+            labels = torch.randint(0, args.num_classes, (batch_size,), device=device)
+            loss_error, grad_error = check_parity(loss, x, labels)
+            original_time = time_loss(original_forward, loss, x, labels, args.steps)
+            vectorized_time = time_loss(lambda loss, x, labels: loss(x, labels), loss, x, labels, args.steps)
+            print('%-11s %6d %14.2f %14.2f %8.2fx %10.2e %10.2e' % (
+                loss_type, batch_size, original_time, vectorized_time, original_time / vectorized_time,
+                loss_error, grad_error))
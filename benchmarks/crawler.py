@@ -0,0 +1,204 @@
+'''
+该文件的功能：使用本地HTTP服务器模拟搜索页与图片，检查expand_images/async_crawler.py的下载、重试、限速、
+图片校验与近似去重以及断点续爬，并统计吞吐量
+
+本地服务器提供：
+* /search?word=xxx&pn=n: 百度翻页格式的搜索结果，每页包含正常、暂时失败（第一次请求返回503）、404、返回网页、
+  文件头不是图片、截断的图片以及与前一张图片近似重复（JPEG质量不同）的图片链接；
+* /img/xxx.jpg: 生成的JPEG图片，每次请求延迟--latency秒。
+图片链接分别使用127.0.0.1与localhost两个域名，用于检查每个域名的并发与限速。
+
+用法：python benchmarks/crawler.py --keywords 4 --pages 3 --images_per_page 20 --latency 0.05
+'''
+import argparse
+import asyncio
+import collections
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from expand_images.async_crawler import AsyncCrawler
+from expand_images.image_validator import ImageValidator
+
+
+class LocalImageServer(object):
+    """在后台线程中运行的本地图片服务器，记录每个路径被请求的次数以及每个域名的最大并发数目
+    """
+    def __init__(self, pages, images_per_page, latency):
+        self.pages = pages
+        self.images_per_page = images_per_page
+        self.latency = latency
+        self.requests = collections.Counter()
+        self.active = collections.Counter()
+        self.max_active = collections.Counter()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                host = self.headers.get('Host', '').split(':')[0]
+                with server.lock:
+                    server.requests[self.path] += 1
+                    count = server.requests[self.path]
+                    server.active[host] += 1
+                    server.max_active[host] = max(server.max_active[host], server.active[host])
+                try:
+                    status, content_type, body = server.respond(self.path, count)
+                    self.send_response(status)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # 爬虫被中断时连接已经关闭
+                    pass
+                finally:
+                    with server.lock:
+                        server.active[host] -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def respond(self, path, count):
+        parsed = urllib.parse.urlparse(path)
+        if parsed.path == '/search':
+            query = urllib.parse.parse_qs(parsed.query)
+            return 200, 'text/html; charset=utf-8', self.search_page(query['word'][0], int(query.get('pn', ['0'])[0]))
+        if parsed.path.startswith('/img/'):
+            time.sleep(self.latency)
+            if parsed.path.endswith('-flaky.jpg') and count == 1:
+                return 503, 'text/plain', b'busy'
+            if parsed.path.endswith('-missing.jpg'):
+                return 404, 'text/plain', b'not found'
+            if parsed.path.endswith('-html.jpg'):
+                return 200, 'text/html', b'<html></html>'
+            if parsed.path.endswith('-fake.jpg'):
+                return 200, 'image/jpeg', b'<html>' + b' ' * 2048 + b'</html>'
+            name = urllib.parse.unquote(parsed.path[len('/img/'):-len('.jpg')])
+            if name.endswith('-duplicate'):
+                # 与前一张图片内容相同，只是JPEG质量不同
+                word, page, index, _ = name.rsplit('-', 3)
+                return 200, 'image/jpeg', fixture_image('%s-%s-%d' % (word, page, int(index) - 1), quality=60)
+            image_bytes = fixture_image(name.replace('-flaky', ''))
+            if name.endswith('-truncated'):
+                image_bytes = image_bytes[:len(image_bytes) // 2]
+            return 200, 'image/jpeg', image_bytes
+        return 404, 'text/plain', b'not found'
+
+    def search_page(self, word, page):
+        lines = []
+        for i in range(self.images_per_page):
+            host = '127.0.0.1' if i % 2 == 0 else 'localhost'
+            kind = {1: '-truncated', 3: '-flaky', 5: '-missing', 6: '-fake', 7: '-html', 9: '-duplicate'}.get(i % 10, '')
+            name = urllib.parse.quote('%s-%d-%d%s.jpg' % (word, page, i, kind))
+            lines.append('"objURL":"http://%s:%d/img/%s",' % (host, self.port, name))
+        if page + 1 < self.pages:
+            lines.append('<a href="/search?word=%s&pn=%d" class="n">下一页</a>' % (urllib.parse.quote(word), page + 1))
+        return '\n'.join(lines).encode('utf-8')
+
+    def image_requests(self):
+        return sum(count for path, count in self.requests.items() if path.startswith('/img/'))
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def fixture_image(name, quality=90):
+    """由名称生成的平滑图片，不同名称的图片互不相似
+    """
+    seed = int(hashlib.md5(name.encode('utf-8')).hexdigest()[:8], 16)
+    small = np.random.RandomState(seed).randint(0, 255, (8, 8, 3), dtype=np.uint8)
+    image = Image.fromarray(small).resize((128, 96), Image.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def crawl(server, save_path, keywords, args, stop_after=None):
+    """运行爬虫，stop_after不为None时在stop_after秒后取消，模拟中断
+    """
+    crawler = AsyncCrawler(save_path, concurrency=args.concurrency, per_host=args.per_host, rate=args.rate,
+                           retries=2, backoff=0.05, timeout=5,
+                           search_url='http://127.0.0.1:%d/search?word={keyword}' % server.port,
+                           validator=ImageValidator(min_bytes=512))
+
+    async def main():
+        if stop_after is None:
+            return await crawler.crawl(keywords, page_number=args.pages)
+        try:
+            return await asyncio.wait_for(crawler.crawl(keywords, page_number=args.pages), stop_after)
+        except asyncio.TimeoutError:
+            return None
+
+    try:
+        return asyncio.run(main())
+    finally:
+        crawler.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keywords', type=int, default=4)
+    parser.add_argument('--pages', type=int, default=3)
+    parser.add_argument('--images_per_page', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds of each image request')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--per_host', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=0, help='max requests per second for each host')
+    args = parser.parse_args()
+
+    keywords = ['关键词%d' % i for i in range(args.keywords)]
+    total = args.keywords * args.pages * args.images_per_page
+    # 每10张中编号为1、6、9的图片未通过校验，5、7的图片下载失败
+    expected = collections.Counter({1: 'rejected', 5: 'failed', 6: 'rejected', 7: 'failed', 9: 'rejected'}.get(
+        i % 10, 'done') for i in range(args.images_per_page))
+    expected = {status: count * args.keywords * args.pages for status, count in expected.items()}
+    save_path = tempfile.mkdtemp()
+    try:
+        with LocalImageServer(args.pages, args.images_per_page, args.latency) as server:
+            # 中断后继续
+            crawl(server, save_path, keywords, args, stop_after=args.latency * 3 + 0.2)
+            interrupted_requests = server.image_requests()
+            # 被中断的请求在服务器端可能仍在处理，只统计继续爬取时的并发数目
+            time.sleep(args.latency * 2)
+            server.max_active.clear()
+            start = time.perf_counter()
+            counts = crawl(server, save_path, keywords, args)
+            elapsed = time.perf_counter() - start
+            print('Interrupted after %d image requests, resumed in %.2fs (%.1f images/s)' % (
+                interrupted_requests, elapsed, (server.image_requests() - interrupted_requests) / elapsed))
+            print('Url states: %s, max connections per host: %s' % (counts, dict(server.max_active)))
+            assert counts == expected and sum(counts.values()) == total, counts
+
+            # 正常图片只成功下载一次，再次运行不发送任何图片请求
+            downloaded = [path for path, count in server.requests.items() if path.startswith('/img/')]
+            requests_before = server.image_requests()
+            crawl(server, save_path, keywords, args)
+            assert server.image_requests() == requests_before, 'Finished urls are fetched again.'
+            images = [name for name in os.listdir(save_path) if name.endswith('.jpg')]
+            assert len(images) == expected['done'] and not any(name.endswith('.part') for name in os.listdir(save_path))
+            assert max(server.max_active.values()) <= args.per_host
+            print('Resume check passed: %d images, %d distinct image urls requested.' % (len(images), len(downloaded)))
+    finally:
+        shutil.rmtree(save_path)
@@ -0,0 +1,110 @@
+'''
+该文件的功能：比较各个backbone在NCHW（contiguous）与NHWC（channels_last）两种内存格式下的推理与训练耗时，并检查两者输出的一致性
+
+用法：python benchmarks/memory_format.py --models se_resnext101_32x4d resnet50 --batch_size 8
+     python benchmarks/memory_format.py --train  # 同时测量包含反向传播与优化器更新的训练步
+'''
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.build_model import PrepareModel
+from models.res2net import res2net50
+
+
+SUPPORTED_MODELS = [
+    'resnet50',
+    'se_resnext50_32x4d',
+    'se_resnext101_32x4d',
+    'resnext101_32x8d_wsl',
+    'densenet121',
+    'dpn68',
+    'efficientnet-b0',
+    'res2net50',
+    'local_attention_resnet50'
+]
+
+
+def create_model(model_name, num_classes):
+    ''' 创建随机初始化的模型，res2net50与带局部注意力机制的模型不经过CustomModel
+    '''
+    prepare_model = PrepareModel()
+    # 创建模型时的输出不影响结果
+    with contextlib.redirect_stdout(io.StringIO()):
+        if model_name == 'res2net50':
+            return res2net50(pretrained=False, num_classes=num_classes)
+        if model_name.startswith('local_attention_'):
+            return prepare_model.create_local_attention_model(
+                model_name[len('local_attention_'):], num_classes, pretrained=False)
+        return prepare_model.create_model(model_name, num_classes, pretrained=False)
+
+
+def time_model(model, inputs, steps, train=False):
+    ''' 返回单步耗时的中位数（毫秒）；train为True时包含反向传播与优化器更新
+    '''
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9) if train else None
+    model.train(train)
+    times = []
+    for _ in range(steps + 1):
+        start = time.perf_counter()
+        if train:
+            model(inputs).logsumexp(dim=1).mean().backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        else:
+            with torch.no_grad():
+                model(inputs)
+        if inputs.is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    # 第一步包含内存分配、算法选择等开销，不计入
+    times = sorted(times[1:])
+    return times[len(times) // 2] * 1000
+
+
+def check_parity(model, inputs):
+    ''' 两种内存格式下推理输出之间的最大相对误差
+    '''
+    model.eval()
+    with torch.no_grad():
+        expected = model.to(memory_format=torch.contiguous_format)(inputs)
+        outputs = model.to(memory_format=torch.channels_last)(inputs.to(memory_format=torch.channels_last))
+    return ((outputs - expected).abs().max() / expected.abs().max().clamp(min=1e-12)).item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, nargs='+', default=SUPPORTED_MODELS)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--image_size', type=int, default=224)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--train', action='store_true', help='also time the training step')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.backends.cudnn.benchmark = True
+    inputs = torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device)
+    print('%-26s %-6s %12s %12s %9s %10s' % ('model', 'phase', 'NCHW (ms)', 'NHWC (ms)', 'speedup', 'max error'))
+    for model_name in args.models:
+        try:
+            model = create_model(model_name, num_classes=54).to(device)
+        except Exception as e:
+            print('%-26s skipped: %s' % (model_name, e))
+            continue
+        error = check_parity(model, inputs)
+        for phase in (('eval', 'train') if args.train else ('eval',)):
+            contiguous_time = time_model(model.to(memory_format=torch.contiguous_format), inputs, args.steps, phase == 'train')
+            channels_last_time = time_model(
+                model.to(memory_format=torch.channels_last),
+                inputs.to(memory_format=torch.channels_last),
+                args.steps,
+                phase == 'train'
+            )
+            print('%-26s %-6s %12.2f %12.2f %8.2fx %10.2e' % (
+                model_name, phase, contiguous_time, channels_last_time, contiguous_time / channels_last_time, error))
+        del model
@@ -0,0 +1,169 @@
+'''
+该文件的功能：检查multi-tensor优化器与原实现的数值一致性，并比较两者单步更新的耗时
+
+用法：python benchmarks/optimizer_step.py --model se_resnext101_32x4d --steps 50
+     python benchmarks/optimizer_step.py --lookahead  # 比较Lookahead慢权重逐个参数更新与展平更新的耗时
+'''
+import argparse
+import copy
+import os
+import sys
+import time
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.torchtools.optim import Lookahead, RAdam, PlainRAdam, AdamW, Lamb, Novograd, Ranger, RangerLars
+from utils.torchtools.optim import ForeachRAdam, ForeachPlainRAdam, ForeachAdamW, ForeachLamb, ForeachNovograd, \
+    ForeachRanger, ForeachRangerLars
+
+
+OPTIMIZERS = {
+    'RAdam': (RAdam, ForeachRAdam),
+    'PlainRAdam': (PlainRAdam, ForeachPlainRAdam),
+    'AdamW': (AdamW, ForeachAdamW),
+    'Lamb': (Lamb, ForeachLamb),
+    'Novograd': (Novograd, ForeachNovograd),
+    'Ranger': (Ranger, ForeachRanger),
+    'RangerLars': (RangerLars, ForeachRangerLars)
+}
+
+
+def get_param_shapes(model_name):
+    ''' 得到模型中所有参数的形状，不需要下载预训练权重
+
+    Args:
+        model_name: str, pretrainedmodels中的模型名称
+    Return:
+        list, 每一个参数的形状
+    '''
+    try:
+        import pretrainedmodels
+        model = pretrainedmodels.__dict__[model_name](num_classes=1000, pretrained=None)
+        return [p.shape for p in model.parameters()]
+    except ImportError:
+        # 没有安装pretrainedmodels时，使用与se_resnext101_32x4d参数数目相近的一组形状
+        print('pretrainedmodels is not installed, using synthetic param shapes.')
+        shapes = []
+        for channels in [256] * 3 + [512] * 4 + [1024] * 23 + [2048] * 3:
+            shapes += [(channels // 2, channels, 1, 1), (channels // 2,), (channels // 2,),
+                       (channels // 2, 4, 3, 3), (channels // 2,), (channels // 2,),
+                       (channels, channels // 2, 1, 1), (channels,), (channels,),
+                       (channels // 16, channels, 1, 1), (channels // 16,), (channels, channels // 16, 1, 1), (channels,)]
+        return shapes
+
+
+def make_params(shapes, device, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    params = [torch.randn(shape, generator=generator).mul_(0.05).to(device).requires_grad_() for shape in shapes]
+    # 与训练脚本一样分为两组，第二组使用更大的学习率
+    return [{'params': params[:-2], 'lr': 1e-4}, {'params': params[-2:], 'lr': 1e-3}]
+
+
+def set_grads(param_groups, step, device):
+    generator = torch.Generator().manual_seed(1000 + step)
+    for group in param_groups:
+        for p in group['params']:
+            p.grad = torch.randn(p.shape, generator=generator).mul_(0.01).to(device)
+
+
+def check_parity(name, shapes, device, steps, weight_decay=1e-4, rtol=1e-4, atol=1e-6):
+    ''' 使用相同的初始参数与梯度，比较两种实现更新后的参数与状态
+
+    Return:
+        float, 参数的最大绝对误差
+    '''
+    reference_class, foreach_class = OPTIMIZERS[name]
+    reference_groups = make_params(shapes, device)
+    foreach_groups = copy.deepcopy(reference_groups)
+    reference = reference_class(reference_groups, weight_decay=weight_decay)
+    foreach = foreach_class(foreach_groups, weight_decay=weight_decay)
+    for step in range(steps):
+        set_grads(reference_groups, step, device)
+        set_grads(foreach_groups, step, device)
+        reference.step()
+        foreach.step()
+
+    max_error = 0.
+    for reference_group, foreach_group in zip(reference_groups, foreach_groups):
+        for p_reference, p_foreach in zip(reference_group['params'], foreach_group['params']):
+            max_error = max(max_error, (p_reference - p_foreach).abs().max().item())
+            if not torch.allclose(p_reference, p_foreach, rtol=rtol, atol=atol):
+                raise RuntimeError('%s: multi-tensor result differs from the reference, max error %g' % (name, max_error))
+    # state_dict的结构必须相同，两种实现保存的断点可以互相加载
+    reference_state, foreach_state = reference.state_dict(), foreach.state_dict()
+    if reference_state['state'].keys() != foreach_state['state'].keys():
+        raise RuntimeError('%s: state_dict keys differ' % name)
+    for key, reference_param_state in reference_state['state'].items():
+        if reference_param_state.keys() != foreach_state['state'][key].keys():
+            raise RuntimeError('%s: state of param %s differs' % (name, key))
+    return max_error
+
+
+def time_step(optimizer_class, shapes, device, steps, warmup):
+    ''' 返回单步更新耗时的中位数（毫秒），中位数不容易受到机器上其它任务的干扰
+    '''
+    param_groups = make_params(shapes, device)
+    optimizer = optimizer_class(param_groups, weight_decay=1e-4)
+    set_grads(param_groups, 0, device)
+    for _ in range(warmup):
+        optimizer.step()
+    times = []
+    for _ in range(steps):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1000
+
+
+def time_lookahead_sync(shapes, device, steps, flatten, slow_dtype=None):
+    ''' 返回一次慢权重更新（sync_lookahead）耗时的中位数（毫秒）与慢权重占用的内存（MB）
+    '''
+    param_groups = make_params(shapes, device)
+    optimizer = Lookahead(torch.optim.SGD(param_groups, lr=1e-3), flatten=flatten, slow_dtype=slow_dtype)
+    set_grads(param_groups, 0, device)
+    optimizer.sync_lookahead()
+    times = []
+    for _ in range(steps):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        optimizer.sync_lookahead()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    slow_bytes = sum(state['slow_buffer'].numel() * state['slow_buffer'].element_size() for state in optimizer.state.values())
+    return sorted(times)[len(times) // 2] * 1000, slow_bytes / 1024 ** 2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='se_resnext101_32x4d')
+    parser.add_argument('--optimizers', type=str, nargs='+', default=list(OPTIMIZERS.keys()))
+    parser.add_argument('--parity_steps', type=int, default=12, help='more than k=6 so that Lookahead updates twice')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=6)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--lookahead', action='store_true', help='benchmark the Lookahead slow weight update only')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    shapes = get_param_shapes(args.model)
+    print('%s: %d param tensors, %.1fM params, device: %s' % (
+        args.model, len(shapes), sum(torch.Size(shape).numel() for shape in shapes) / 1e6, device))
+    if args.lookahead:
+        print('%-24s %14s %12s' % ('lookahead', 'sync (ms)', 'slow (MB)'))
+        for name, flatten, slow_dtype in [('per-param', False, None), ('flatten', True, None),
+                                          ('flatten + float16', True, torch.float16)]:
+            sync_time, slow_memory = time_lookahead_sync(shapes, device, args.steps, flatten, slow_dtype)
+            print('%-24s %14.2f %12.1f' % (name, sync_time, slow_memory))
+        sys.exit(0)
+    print('%-12s %12s %14s %14s %9s' % ('optimizer', 'max error', 'loop (ms)', 'foreach (ms)', 'speedup'))
+    for name in args.optimizers:
+        max_error = check_parity(name, shapes, device, args.parity_steps)
+        loop_time = time_step(OPTIMIZERS[name][0], shapes, device, args.steps, args.warmup)
+        foreach_time = time_step(OPTIMIZERS[name][1], shapes, device, args.steps, args.warmup)
+        print('%-12s %12.3g %14.2f %14.2f %8.2fx' % (name, max_error, loop_time, foreach_time, loop_time / foreach_time))
@@ -0,0 +1,128 @@
+'''
+该文件的功能：检查Regularization各模式与原实现的梯度一致性，并比较正则项带来的单步耗时
+
+用法：python benchmarks/regularization_step.py --model se_resnext101_32x4d --steps 10
+     python benchmarks/regularization_step.py --full_step  # 同时测量包含前向与反向传播的完整训练步
+'''
+import argparse
+import contextlib
+import copy
+import io
+import os
+import sys
+import time
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.sparsity import Regularization
+
+
+def original_regularization_loss(model, weight_decay, p):
+    ''' 原实现：每次调用都遍历named_parameters，并逐个计算范数
+    '''
+    weight_list = [(name, param) for name, param in model.named_parameters() if 'weight' in name]
+    reg_loss = 0
+    for name, w in weight_list:
+        reg_loss = reg_loss + torch.norm(w, p=p)
+    return weight_decay * reg_loss
+
+
+def create_regularization(model, weight_decay, p, mode):
+    # Regularization会打印所有参与正则化的参数名称，这里不输出
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Regularization(model, weight_decay, p=p, mode=mode)
+
+
+def init_grads(model):
+    # 所有参数都分配梯度，保证各模式的比较中梯度的内存分配相同
+    for param in model.parameters():
+        param.grad = torch.zeros_like(param)
+
+
+def check_parity(model, weight_decay, p):
+    ''' loss与grad模式得到的梯度都必须与原实现相同
+
+    Return:
+        float, 梯度的最大绝对误差
+    '''
+    init_grads(model)
+    original_regularization_loss(model, weight_decay, p).backward()
+    expected = [param.grad.clone() for param in model.parameters()]
+    max_error = 0.
+    for mode in ('loss', 'grad'):
+        regularization = create_regularization(model, weight_decay, p, mode)
+        model.zero_grad(set_to_none=False)
+        if mode == 'loss':
+            regularization(model).backward()
+        else:
+            regularization.update_grad()
+        for param, grad in zip(model.parameters(), expected):
+            error = (param.grad - grad).abs().max().item()
+            max_error = max(max_error, error)
+            if not torch.allclose(param.grad, grad, rtol=1e-4, atol=1e-7):
+                raise RuntimeError('%s mode: gradient differs from the original implementation, max error %g' % (mode, error))
+    return max_error
+
+
+def time_regularization(model, mode, weight_decay, p, steps, inputs=None):
+    ''' 返回单步耗时的中位数（毫秒）；inputs不为None时包含模型的前向与反向传播
+    '''
+    init_grads(model)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+    regularization = None if mode == 'original' else create_regularization(model, weight_decay, p, mode)
+    times = []
+    for _ in range(steps + 1):
+        start = time.perf_counter()
+        loss = model(inputs).logsumexp(dim=1).mean() if inputs is not None else 0
+        # 与训练程序一样，每一步都取出正则项的数值用于记录
+        if mode == 'original':
+            reg_loss = original_regularization_loss(model, weight_decay, p)
+            loss = loss + reg_loss
+        elif mode == 'loss':
+            reg_loss = regularization(model)
+            loss = loss + reg_loss
+        if torch.is_tensor(loss):
+            loss.backward()
+        if mode == 'grad':
+            regularization.update_grad()
+        optimizer.step()
+        if mode == 'proximal':
+            regularization.proximal_step(optimizer)
+        if mode in ('grad', 'proximal'):
+            reg_loss = regularization.last_loss
+        reg_loss.item()
+        optimizer.zero_grad(set_to_none=False)
+        times.append(time.perf_counter() - start)
+    # 第一步包含内存分配等开销，不计入
+    times = sorted(times[1:])
+    return times[len(times) // 2] * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='se_resnext101_32x4d')
+    parser.add_argument('--p', type=int, default=1)
+    parser.add_argument('--weight_decay', type=float, default=1e-4)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--full_step', action='store_true', help='include the model forward and backward')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--image_size', type=int, default=224)
+    args = parser.parse_args()
+
+    import pretrainedmodels
+    model = pretrainedmodels.__dict__[args.model](num_classes=1000, pretrained=None)
+    print('%s: %d weight tensors, max gradient error: %g' % (
+        args.model,
+        len([name for name, _ in model.named_parameters() if 'weight' in name]),
+        check_parity(copy.deepcopy(model), args.weight_decay, args.p)
+    ))
+    inputs = torch.randn(args.batch_size, 3, args.image_size, args.image_size) if args.full_step else None
+    if inputs is not None:
+        model.train()
+    print('%-10s %12s %9s' % ('mode', 'step (ms)', 'speedup'))
+    original_time = None
+    modes = ('original', 'loss', 'grad', 'proximal') if args.p in (1, 2) else ('original', 'loss', 'grad')
+    for mode in modes:
+        step_time = time_regularization(model, mode, args.weight_decay, args.p, args.steps, inputs)
+        original_time = original_time or step_time
+        print('%-10s %12.2f %8.2fx' % (mode, step_time, original_time / step_time))
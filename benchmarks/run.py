@@ -0,0 +1,324 @@
+'''
+该文件的功能：在只有CPU的机器上使用合成的JPEG图片，分别测量训练与推理各个环节的吞吐量，结果保存为json文件，用于比较不同提交之间的性能变化
+
+测量的环节：
+* data: TrainDataset解码与数据增强的速度（images/s），分别测量不同的图片大小、是否使用AutoAugment以及DataLoader的num_workers；
+* model: CustomModel中各个backbone单步前向+反向传播与单步推理的耗时；
+* optimizer: create_optimizer支持的每一种优化器单步更新的耗时，multi-tensor实现单独测量；
+* service: ImageClassificationService.inference在不同并发数下的延迟（p50/p99）与吞吐量。
+
+测量model与optimizer时复用memory_format.py与optimizer_step.py中的函数。给出--baseline时，与之前保存的结果逐项比较。
+
+用法：python benchmarks/run.py --output benchmark_results.json
+     python benchmarks/run.py --stages data service --baseline benchmark_results.json --output new_results.json
+     python benchmarks/run.py --quick  # 减少图片与步数，用于检查脚本能否运行
+'''
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+import torch
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from benchmarks.memory_format import create_model, time_model
+from benchmarks.optimizer_step import set_grads
+from datasets.create_dataset import TrainDataset
+from models.build_model import PrepareModel
+
+STAGES = ['data', 'model', 'optimizer', 'service']
+# create_optimizer支持的优化器；该基准在CPU上运行，create_optimizer在CPU上忽略multi_tensor，
+# multi-tensor实现与原实现的对比见benchmarks/optimizer_step.py
+OPTIMIZERS = ['Adam', 'SGD', 'RAdam', 'PlainRAdam', 'AdamW', 'Lamb', 'Novograd', 'RangerLars', 'Ranger']
+# 比较结果时数值越大越好的指标，其余指标（耗时）越小越好
+HIGHER_IS_BETTER = ('images_per_sec', 'requests_per_sec')
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+
+
+def synthetic_jpeg(seed, min_side=300, max_side=1200, quality=90):
+    ''' 生成大小随机的平滑图片，解码开销与真实照片相近
+
+    Return:
+        bytes, JPEG文件的内容
+    '''
+    random_state = np.random.RandomState(seed)
+    width, height = random_state.randint(min_side, max_side + 1, size=2)
+    small = random_state.randint(0, 255, (16, 16, 3), dtype=np.uint8)
+    image = Image.fromarray(small).resize((int(width), int(height)), Image.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def make_fixtures(image_root, number):
+    ''' 在image_root下生成number张合成图片
+
+    Return:
+        samples: list, 图片名称
+        labels: list, 类标
+    '''
+    samples, labels = [], []
+    for index in range(number):
+        sample = 'img_%d.jpg' % index
+        with open(os.path.join(image_root, sample), 'wb') as f:
+            f.write(synthetic_jpeg(index))
+        samples.append(sample)
+        labels.append(index % 54)
+    return samples, labels
+
+
+def percentile_ms(times, q):
+    return float(np.percentile(times, q) * 1000)
+
+
+def bench_data(image_root, samples, labels, args):
+    ''' TrainDataset的吞吐量；num_workers大于0时从第一个batch返回之后开始计时，不包含启动子进程的开销
+    '''
+    results = []
+    for image_size in args.image_sizes:
+        for auto_aug in (False, True):
+            dataset = TrainDataset(image_root, samples, labels, [image_size, image_size], MEAN, STD, auto_aug=auto_aug)
+            for num_workers in args.num_workers:
+                loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=num_workers)
+                iterator = iter(loader)
+                next(iterator)
+                start = time.perf_counter()
+                number = sum(images.size(0) for images, _ in iterator)
+                elapsed = time.perf_counter() - start
+                del iterator
+                results.append({
+                    'name': 'data/%d/auto_aug=%d/workers=%d' % (image_size, auto_aug, num_workers),
+                    'images_per_sec': number / elapsed
+                })
+                print('%-44s %10.1f images/s' % (results[-1]['name'], results[-1]['images_per_sec']))
+    return results
+
+
+def bench_model(args):
+    ''' 各个backbone单步训练（前向、反向与SGD更新）与单步推理的耗时
+    '''
+    results = []
+    for model_name in args.models:
+        try:
+            model = create_model(model_name, num_classes=54)
+        except Exception as e:
+            print('%-44s skipped: %s' % (model_name, e))
+            continue
+        for image_size in args.image_sizes:
+            inputs = torch.randn(args.batch_size, 3, image_size, image_size)
+            for phase in ('train', 'eval'):
+                step_ms = time_model(model, inputs, args.steps, phase == 'train')
+                results.append({
+                    'name': 'model/%s/%d/%s' % (model_name, image_size, phase),
+                    'step_ms': step_ms,
+                    'images_per_sec': args.batch_size / step_ms * 1000
+                })
+                print('%-44s %10.2f ms %10.1f images/s' % (
+                    results[-1]['name'], step_ms, results[-1]['images_per_sec']))
+        del model
+    return results
+
+
+def bench_optimizer(args):
+    ''' 使用create_optimizer创建优化器，与训练时的参数分组相同，测量单步更新耗时的中位数
+    '''
+    prepare_model = PrepareModel()
+    results = []
+    for name in OPTIMIZERS:
+        # 每个优化器都从相同的初始参数开始
+        torch.manual_seed(0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            model = torch.nn.DataParallel(create_model(args.optimizer_model, num_classes=54))
+            config = argparse.Namespace(
+                optimizer=name, lr=1e-3, weight_decay=1e-4, multi_tensor=False,
+                lookahead_flatten=False, lookahead_slow_dtype=''
+            )
+            optimizer = prepare_model.create_optimizer(args.optimizer_model, model, config)
+        set_grads(optimizer.param_groups, 0, torch.device('cpu'))
+        optimizer.step()
+        times = []
+        for _ in range(args.steps):
+            start = time.perf_counter()
+            optimizer.step()
+            times.append(time.perf_counter() - start)
+        results.append({
+            'name': 'optimizer/%s/%s' % (args.optimizer_model, name),
+            'step_ms': percentile_ms(times, 50)
+        })
+        print('%-44s %10.2f ms' % (results[-1]['name'], results[-1]['step_ms']))
+    return results
+
+
+def import_service(service):
+    ''' 导入线上（online）或本地（offline）推理服务的ImageClassificationService
+
+    线上服务依赖ModelArts推理运行时提供的model_service、metric与log模块，本地没有安装时使用只包含所需接口的替代模块，
+    替代模块不做任何事情，不影响测量结果。
+    '''
+    if service == 'offline':
+        spec = importlib.util.spec_from_file_location(
+            'offline_service', os.path.join(ROOT, 'online-service', 'offline_service.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module.ImageClassificationService
+
+    sys.path.insert(0, os.path.join(ROOT, 'online-service'))
+    try:
+        import model_service.pytorch_model_service  # noqa: F401
+    except ImportError:
+        print('ModelArts runtime is not installed, using placeholder modules for model_service, metric and log.')
+        placeholders = {
+            'model_service': {},
+            'model_service.pytorch_model_service': {'PTServingBaseService': object},
+            'metric': {},
+            'metric.metrics_manager': {'MetricsManager': type('MetricsManager', (), {'metrics': {}})},
+            'log': {'getLogger': logging.getLogger}
+        }
+        for module_name, attributes in placeholders.items():
+            module = types.ModuleType(module_name)
+            module.__dict__.update(attributes)
+            sys.modules.setdefault(module_name, module)
+    from model.customize_service import ImageClassificationService
+    return ImageClassificationService
+
+
+def bench_service(work_root, args):
+    ''' 使用随机初始化的权重创建推理服务，在不同的并发数下发送请求，统计每个请求的延迟与总的吞吐量
+    '''
+    ImageClassificationService = import_service(args.service)
+    model_path = os.path.join(work_root, 'model_best.pth')
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = PrepareModel().create_model('se_resnext101_32x4d', 54, pretrained=False)
+        torch.save({'state_dict': model.state_dict()}, model_path)
+        service = ImageClassificationService('se_resnext101_32x4d', model_path)
+    images = [synthetic_jpeg(1000 + index) for index in range(args.requests)]
+
+    def request(image):
+        start = time.perf_counter()
+        service.inference({'input_img': {'file': io.BytesIO(image)}})
+        return time.perf_counter() - start
+
+    results = []
+    # 离线服务每次推理都会打印输入的大小与设备
+    with contextlib.redirect_stdout(io.StringIO()):
+        request(images[0])
+    for concurrency in args.concurrency:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor, \
+                contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            latencies = list(executor.map(request, images))
+            elapsed = time.perf_counter() - start
+        results.append({
+            'name': 'service/%s/concurrency=%d' % (args.service, concurrency),
+            'p50_ms': percentile_ms(latencies, 50),
+            'p99_ms': percentile_ms(latencies, 99),
+            'requests_per_sec': len(images) / elapsed
+        })
+        print('%-44s p50 %8.1f ms  p99 %8.1f ms %8.2f requests/s' % (
+            results[-1]['name'], results[-1]['p50_ms'], results[-1]['p99_ms'], results[-1]['requests_per_sec']))
+    return results
+
+
+def environment():
+    ''' 记录测量环境，不同机器上的结果不能直接比较
+    '''
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL)
+        commit = commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ''
+    return {
+        'commit': commit,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'cuda': torch.cuda.is_available()
+    }
+
+
+def compare(baseline, results):
+    ''' 与之前的结果逐项比较，change为正时表示变好
+    '''
+    baseline_results = {result['name']: result for result in baseline['results']}
+    print('Comparing with %s (commit %s)' % (baseline['environment']['time'], baseline['environment']['commit'][:8]))
+    print('%-44s %-16s %12s %12s %9s' % ('name', 'metric', 'baseline', 'current', 'change'))
+    for result in results:
+        old = baseline_results.get(result['name'])
+        if old is None:
+            continue
+        for metric, value in result.items():
+            if metric == 'name' or not old.get(metric):
+                continue
+            change = value / old[metric] - 1 if metric in HIGHER_IS_BETTER else old[metric] / value - 1
+            print('%-44s %-16s %12.2f %12.2f %+8.1f%%' % (result['name'], metric, old[metric], value, change * 100))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', type=str, nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--output', type=str, default='benchmark_results.json')
+    parser.add_argument('--baseline', type=str, default='', help='results of an earlier run to compare with')
+    parser.add_argument('--images', type=int, default=256, help='number of synthetic images for the data stage')
+    parser.add_argument('--image_sizes', type=int, nargs='+', default=[256, 416])
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 4, 8])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--models', type=str, nargs='+', default=['resnet50', 'se_resnext50_32x4d', 'se_resnext101_32x4d'])
+    parser.add_argument('--optimizer_model', type=str, default='se_resnext101_32x4d')
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--service', type=str, default='online', choices=['online', 'offline'])
+    parser.add_argument('--requests', type=int, default=32, help='requests per concurrency level')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--quick', action='store_true', help='small sizes, only checks that every stage runs')
+    args = parser.parse_args()
+    if args.quick:
+        args.images, args.image_sizes, args.num_workers, args.batch_size = 16, [128], [0, 2], 4
+        args.models, args.optimizer_model, args.steps = ['resnet50'], 'resnet50', 2
+        args.requests, args.concurrency = 4, [1, 2]
+
+    environment_info = environment()
+    print('commit %s, torch %s, %d CPUs, %d threads' % (
+        environment_info['commit'][:8], environment_info['torch'], environment_info['cpu_count'],
+        environment_info['torch_threads']))
+    work_root = tempfile.mkdtemp(prefix='benchmark_')
+    results = []
+    try:
+        if 'data' in args.stages:
+            image_root = os.path.join(work_root, 'images')
+            os.makedirs(image_root)
+            samples, labels = make_fixtures(image_root, args.images)
+            results += bench_data(image_root, samples, labels, args)
+        if 'model' in args.stages:
+            results += bench_model(args)
+        if 'optimizer' in args.stages:
+            results += bench_optimizer(args)
+        if 'service' in args.stages:
+            results += bench_service(work_root, args)
+    finally:
+        shutil.rmtree(work_root)
+
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment_info, 'args': vars(args), 'results': results}, f, indent=2)
+    print('Saving results to %s' % args.output)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            compare(json.load(f), results)
@@ -0,0 +1,99 @@
+'''
+该文件的功能：提取训练集的L2归一化嵌入特征并建立检索索引，用于最近邻分类与伪标签中分布外样本的拒识
+
+用法：python build_embedding_index.py --weight_path checkpoints/se_resnext101_32x4d/log-xxx/model_best.pth
+         --head arcface --index_lists 0 --reject_quantile 0.01
+索引保存在weight_path所在目录下的embedding_index.npz中，线上部署时与权重文件放在同一目录即可；
+一个权重文件对应一折，只使用selected_fold中的第一折建立索引
+'''
+import os
+import torch
+import tqdm
+from torch.utils.data import DataLoader
+
+from config import get_classify_config
+from models.build_model import PrepareModel
+from datasets.create_dataset import GetDataloader, ValDataset
+from utils.embedding_index import EmbeddingIndex
+
+
+def extract_embeddings(model, data_loader, device, with_predicts=False):
+    """ 提取数据集中所有样本的嵌入特征
+
+    Args:
+        model: CustomModel
+        data_loader: 返回(样本名称, 图片, 类标)的数据加载器，不能打乱顺序
+        device: 推理使用的设备
+        with_predicts: bool, 是否同时返回分类层（softmax）预测的类别
+    Return:
+        embeddings: float16 tensor, [样本数目, 特征维度]
+        labels: long tensor, [样本数目]
+        sample_names: list, 样本名称
+        predicts: long tensor, [样本数目]，只在with_predicts为True时返回
+    """
+    model.eval()
+    embeddings, labels, sample_names, predicts = [], [], [], []
+    with torch.no_grad():
+        for names, images, targets in tqdm.tqdm(data_loader, desc='Extracting embeddings'):
+            images = images.to(device)
+            embeddings.append(model.get_embedding(images).half().cpu())
+            if with_predicts:
+                predicts.append(model(images).argmax(dim=1).cpu())
+            labels.append(targets)
+            sample_names.extend(names)
+    if with_predicts:
+        return torch.cat(embeddings), torch.cat(labels), sample_names, torch.cat(predicts)
+    return torch.cat(embeddings), torch.cat(labels), sample_names
+
+
+if __name__ == '__main__':
+    config = get_classify_config()
+    if not config.weight_path:
+        raise ValueError('You must specified weight_path of the trained model.')
+    mean = (0.485, 0.456, 0.406)
+    std = (0.229, 0.224, 0.225)
+    get_dataloader = GetDataloader(
+        config.dataset_root,
+        folds_split=config.n_splits,
+        test_size=config.val_size,
+        only_self=config.only_self,
+        only_official=config.only_official,
+        selected_labels=config.selected_labels,
+        val_official=config.val_official,
+        load_split_from_file=config.load_split_from_file,
+        manifest_path=config.manifest
+    )
+    train_dataloaders, val_dataloaders = get_dataloader.get_dataloader(config.batch_size, config.image_size, mean, std)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # 索引与权重放在同一目录下，线上服务按照固定的文件名读取，因此只处理一折
+    fold_index = config.selected_fold[0]
+    if len(config.selected_fold) > 1:
+        print('@ weight_path belongs to a single fold, building the index of fold %d only.' % fold_index)
+    train_loader, valid_loader = train_dataloaders[fold_index], val_dataloaders[fold_index]
+    prepare_model = PrepareModel()
+    model = prepare_model.create_model(config.model_type, config.num_classes, pretrained=False, head=config.head,
+                                       margin_scale=config.margin_scale)
+    model = prepare_model.load_chekpoint(model, config.weight_path).to(device)
+
+    # 训练样本不经过数据增强
+    train_dataset = train_loader.dataset
+    dataset = ValDataset(train_dataset.data_root, train_dataset.sample_list, train_dataset.label_list,
+                         config.image_size, mean=mean, std=std)
+    loader = DataLoader(dataset, batch_size=config.batch_size, num_workers=8, pin_memory=True, shuffle=False)
+    embeddings, labels, sample_names = extract_embeddings(model, loader, device)
+    index = EmbeddingIndex(embeddings, labels, config.num_classes, n_lists=config.index_lists,
+                           sample_names=sample_names)
+    index.calibrate(config.reject_quantile)
+
+    # 在验证集上比较softmax与两种最近邻分类方式的准确率，以及被拒识的比例
+    val_embeddings, val_labels, _, val_predicts = extract_embeddings(model, valid_loader, device, with_predicts=True)
+    print('softmax: OA %.4f' % (val_predicts == val_labels).float().mean())
+    for method in ('centroid', 'knn'):
+        predicts, _, rejected = index.classify(val_embeddings.float(), method=method)
+        print('%s: OA %.4f, rejected %.4f' % (
+            method, (predicts == val_labels).float().mean(), rejected.float().mean()))
+
+    index_path = os.path.join(os.path.dirname(config.weight_path), 'embedding_index.npz')
+    index.save(index_path)
+    print('Saving embedding index to %s.' % index_path)
@@ -18,6 +18,8 @@ def get_classify_config():
     # 数据集划分
     parser.add_argument('--dataset_from_folder', type=bool, default=False, help='loading dataset from folder.')
     parser.add_argument('--load_split_from_file', type=str, default='', help='loading dataset split from load_split_from_file， if '' , generate online.' )
+    parser.add_argument('--manifest', type=str, default='',
+                        help='loading samples from the manifest (expand_images/compose_dataset.py) instead of the annotation files in dataset_root, a split loaded from load_split_from_file only keeps the samples of the manifest.')
     parser.add_argument('--n_splits', type=int, default=5, help='n_splits_fold')
     parser.add_argument('--val_official', type=bool, default=False, help='only use official data in validate dataset or not.')
     parser.add_argument('--selected_fold', type=list, default=[0], help='which folds for training')
@@ -37,19 +39,51 @@ def get_classify_config():
     parser.add_argument('--val_multi_scale', type=bool, default=True, help='use multi scale validate or not.')
     parser.add_argument('--multi_scale_size', type=list, default=[[256, 256], [288, 288], [320, 320], [352, 352], [384, 384], [416, 416]], help='multi scale choice.')
     parser.add_argument('--multi_scale_interval', type=int, default=10, help='make a scale choice every [] iterations.')
+    # 渐进式调整图片大小，启用时不使用multi_scale
+    parser.add_argument('--progressive_resize', type=bool, default=False,
+                        help='train the early epochs with smaller images and larger batches, then ramp to image_size.')
+    parser.add_argument('--progressive_start_size', type=int, default=224,
+                        help='image height of the first epoch, the width is scaled in proportion.')
+    parser.add_argument('--progressive_epochs', type=int, default=30, help='ramp the image size to image_size in [] epochs.')
+    parser.add_argument('--progressive_max_batch_size', type=int, default=96, help='max batch size for the small images.')
+    parser.add_argument('--progressive_lr_scale', type=str, default='sqrt',
+                        help='how the lr follows the batch size: linear/sqrt (for Adam and the like)/none.')
     # 稀疏度训练
     parser.add_argument('--sparsity', type=bool, default=False, help='use sparsity training or not.')
     parser.add_argument('--sparsity_scale', type=float, default=1e-2, help='sparsity scale.')
     parser.add_argument('--penalty_type', type=str, default='L1', help='penalty type.')
+    parser.add_argument('--sparsity_bias', type=bool, default=False, help='also apply the sparsity penalty to BN biases or not.')
+    parser.add_argument('--sparsity_schedule', type=str, default='constant',
+                        help='how the sparsity scale changes during training: constant/linear/cosine.')
     # l1正则化
     parser.add_argument('--l1_regular', type=bool, default=False, help='use l1 regular or not.')
     parser.add_argument('--l1_decay', type=float, default=1e-4, help='l1 regular decay factor.')
+    parser.add_argument('--l1_mode', type=str, default='loss',
+                        help='how to apply the l1 regular: loss (add to the loss)/grad (add to the grads)/proximal (soft threshold after each step).')
+    
+    # 通道剪枝
+    parser.add_argument('--prune_ratio', type=float, default=0.3, help='ratio of the prunable channels to remove.')
+    parser.add_argument('--prune_residual', type=bool, default=False,
+                        help='also prune the residual channels shared by a whole stage (downsample, SE and classifier inputs).')
+    parser.add_argument('--prune_min_keep', type=float, default=0.1, help='min ratio of channels kept in every layer.')
+    parser.add_argument('--prune_epoch', type=int, default=10, help='epochs of fine-tuning after pruning, 0 to skip.')
+
+    # 嵌入特征检索索引
+    parser.add_argument('--index_lists', type=int, default=0, help='number of IVF lists of the embedding index, 0 for brute force search.')
+    parser.add_argument('--reject_quantile', type=float, default=0.01,
+                        help='ratio of the training samples rejected by the per class distance thresholds.')
     
     # model set
     parser.add_argument('--model_type', type=str, default='se_resnext101_32x4d',
                         help='densenet201/efficientnet-b5/se_resnext101_32x4d')
     parser.add_argument('--drop_rate', type=float, default=0, help='dropout rate in classify module')
     parser.add_argument('--bn_to_gn', type=bool, default=False, help='dropout rate in classify module')
+    parser.add_argument('--head', type=str, default='linear',
+                        help='classifier head: linear/arcface/sphereface/cosface, the cosine heads need the ArcFace/SphereFace/CosFace loss.')
+    parser.add_argument('--margin_scale', type=float, default=30.0, help='scale of the cosine head and the ArcFace/SphereFace/CosFace loss.')
+    parser.add_argument('--margin', type=float, default=None, help='margin of the ArcFace/SphereFace/CosFace loss, None to use the default.')
+    parser.add_argument('--channels_last', type=bool, default=False,
+                        help='use channels_last (NHWC) memory format for the model and inputs, faster convolutions on CPU.')
 
     # model hyper-parameters
     parser.add_argument('--num_classes', type=int, default=54)
@@ -68,10 +102,59 @@ def get_classify_config():
     parser.add_argument('--delay_epoch', type=int, default=None, help='delay epoch (if you want to keep your lr at the begining.)')
     
     # 优化器
-    parser.add_argument('--optimizer', type=str, default='Adam', help='optimizer type: Adam/SGD/RAdam/RangerLars/Ranger')
+    parser.add_argument('--optimizer', type=str, default='Adam',
+                        help='optimizer type: Adam/SGD/RAdam/PlainRAdam/AdamW/Lamb/Novograd/RangerLars/Ranger')
+    parser.add_argument('--multi_tensor', type=bool, default=False,
+                        help='use the multi-tensor (foreach) implementation of RAdam/PlainRAdam/AdamW/Lamb/Novograd/RangerLars/Ranger, '
+                             'only pays off on CUDA and is ignored on CPU. '
+                             'Parity check: python -m utils.torchtools.optim.multi_tensor')
+    parser.add_argument('--lookahead_flatten', type=bool, default=False,
+                        help='keep the params and Lookahead slow weights of Ranger/RangerLars in flat contiguous buffers.')
+    parser.add_argument('--lookahead_slow_dtype', type=str, default='',
+                        help='dtype of the Lookahead slow weights: float16/bfloat16, empty to use the param dtype.')
     # 损失函数
     parser.add_argument('--loss_name', type=str, default='1.0*SmoothCrossEntropy',
-                        help='Select the loss function, CrossEntropy/SmoothCrossEntropy/FocalLoss/SmoothCrossEntropyHardMining')
+                        help='Select the loss function, CrossEntropy/SmoothCrossEntropy/FocalLoss/SmoothCrossEntropyHardMining/ArcFace/SphereFace/CosFace')
+    parser.add_argument('--class_alpha', type=bool, default=False,
+                        help='use per class alpha weights in FocalLoss, computed from the class counts of the train set.')
+    parser.add_argument('--class_alpha_power', type=float, default=0.5, help='alpha is proportional to count^(-power).')
+
+    # 知识蒸馏
+    parser.add_argument('--distillation', type=bool, default=False,
+                        help='train the model with the logits of teacher models, loss_name must contain KD.')
+    parser.add_argument('--kd_teachers', type=str, nargs='+', default=[],
+                        help='teacher models: model_type:weight_path[:height,width], logits of several teachers are averaged.')
+    parser.add_argument('--kd_tta', type=bool, default=True, help='average the teacher logits of the flipped images or not.')
+    parser.add_argument('--kd_temperature', type=float, default=4.0, help='temperature of the KD loss.')
+    parser.add_argument('--kd_store', type=str, default='',
+                        help='path (without extension) of the precomputed teacher logits, default save_path/teacher_logits/fold[].')
+
+    # 权重滑动平均
+    parser.add_argument('--ema', type=bool, default=False, help='keep an exponential moving average of the weights or not.')
+    parser.add_argument('--ema_decay', type=float, default=0.9998, help='per-step decay of the weight EMA.')
+    parser.add_argument('--ema_interval', type=int, default=1, help='update the weight EMA every [] steps.')
+    parser.add_argument('--ema_async', type=bool, default=False, help='update the weight EMA in a background thread or not.')
+    parser.add_argument('--ema_eval', type=bool, default=True, help='validate and select the best model with the EMA weights or not.')
+
+    # 权重保存
+    parser.add_argument('--async_checkpoint', type=bool, default=True, help='save checkpoints in a background thread or not.')
+    parser.add_argument('--checkpoint_queue_size', type=int, default=2, help='max number of checkpoints waiting to be written.')
+    parser.add_argument('--save_interval', type=int, default=10, help='save a snapshot every [] epochs.')
+    parser.add_argument('--keep_last_snapshots', type=int, default=None, help='max number of epoch snapshots to keep, None to keep all.')
+
+    # 断点续训
+    parser.add_argument('--resume', type=str, default='', help='resume training from the given resume checkpoint.')
+    parser.add_argument('--resume_interval', type=int, default=0, help='save a resume checkpoint every [] iterations, 0 to save only at the end of each epoch.')
+
+    # 性能分析
+    parser.add_argument('--profile', type=bool, default=False,
+                        help='record the wall time of each training phase and write it to tensorboard or not.')
+    parser.add_argument('--profile_interval', type=int, default=50, help='write the phase times every [] iterations.')
+    parser.add_argument('--profile_sync', type=bool, default=True,
+                        help='synchronize cuda at the phase boundaries so that asynchronous kernels are counted in the phase that launched them.')
+    parser.add_argument('--profile_trace_steps', type=int, default=0,
+                        help='record a torch.profiler trace of [] iterations into the log dir, 0 to disable.')
+    parser.add_argument('--profile_trace_wait', type=int, default=10, help='skip [] iterations before recording the trace.')
 
     # 路径
     parser.add_argument('--save_path', type=str, default='./checkpoints')
@@ -3,16 +3,17 @@ import os
 import json
 import numpy as np
 from PIL import Image
-import matplotlib.pylab as plt
-from matplotlib.font_manager import FontProperties
+import collections
 from sklearn.model_selection import train_test_split, StratifiedKFold
 from torch.utils.data import Dataset, DataLoader
 import torchvision.transforms as T
 from utils.autoaugment import ImageNetPolicy
+from utils.sampler import ResumableRandomSampler
+from datasets.manifest import Manifest, is_official
 
 
 class TrainDataset(Dataset):
-    def __init__(self, data_root, sample_list, label_list, size, mean, std, transforms=None, only_self=False, only_official=False, multi_scale=False, auto_aug=False):
+    def __init__(self, data_root, sample_list, label_list, size, mean, std, transforms=None, only_self=False, only_official=False, multi_scale=False, auto_aug=False, return_index=False):
         """
         Args:
             data_root: str, 数据集根目录
@@ -22,6 +23,7 @@ class TrainDataset(Dataset):
             mean: tuple, 通道均值
             std: tuple, 通道方差
             transforms: callable, 数据集转换方式
+            return_index: bool, 是否同时返回样本的索引，知识蒸馏时用于读取教师网络的输出
         """
         super(TrainDataset, self).__init__()
         self.data_root = data_root
@@ -34,7 +36,7 @@ class TrainDataset(Dataset):
             sample_list = []
             label_list = []
             for sample, label in zip(self.sample_list, self.label_list):
-                if 'img' in sample:
+                if is_official(sample):
                     sample_list.append(sample)
                     label_list.append(label)
             self.sample_list = sample_list
@@ -43,7 +45,7 @@ class TrainDataset(Dataset):
             sample_list = []
             label_list = []
             for sample, label in zip(self.sample_list, self.label_list):
-                if 'img' not in sample:
+                if not is_official(sample):
                     sample_list.append(sample)
                     label_list.append(label)
             self.sample_list = sample_list
@@ -54,6 +56,7 @@ class TrainDataset(Dataset):
         self.std = std
         self.transforms = transforms
         self.multi_scale = multi_scale
+        self.return_index = return_index
     
     def __getitem__(self, index):
         """
@@ -63,6 +66,7 @@ class TrainDataset(Dataset):
         Returns:
             image: [channel, height, width] tensor, 当前索引下标对应的图像数据
             label: [1] tensor, 当前索引下标对应的图像数据对应的类标
+            index: int, 当前索引下标，仅在return_index为True时返回
         """
         sample_path = os.path.join(self.data_root, self.sample_list[index])
         image = Image.open(sample_path).convert('RGB')
@@ -92,6 +96,8 @@ class TrainDataset(Dataset):
             image = transform_compose(image)
         label = torch.tensor(label).long()
 
+        if self.return_index:
+            return image, label, index
         return image, label
 
     def __len__(self):
@@ -121,7 +127,7 @@ class ValDataset(Dataset):
             sample_list = []
             label_list = []
             for sample, label in zip(self.sample_list, self.label_list):
-                if 'img' in sample:
+                if is_official(sample):
                     sample_list.append(sample)
                     label_list.append(label)
             self.sample_list = sample_list
@@ -130,7 +136,7 @@ class ValDataset(Dataset):
             sample_list = []
             label_list = []
             for sample, label in zip(self.sample_list, self.label_list):
-                if 'img' not in sample:
+                if not is_official(sample):
                     sample_list.append(sample)
                     label_list.append(label)
             self.sample_list = sample_list
@@ -188,7 +194,8 @@ class GetDataloader(object):
         val_official=False, 
         selected_labels=None,
         load_split_from_file=None,
-        auto_aug=False
+        auto_aug=False,
+        manifest_path=None
         ):
         """
         Args:
@@ -201,10 +208,13 @@ class GetDataloader(object):
             val_official: bool, 在验证集中是否只是用官方的数据集
             selected_labels: list，被选中用于训练的类别
             load_split_from_file: str, 存放数据集划分的文件的路径，如果存在则从文件加载，否则在线生成
+            manifest_path: str, 数据集清单的路径，不为空时从清单中读取样本与类标，而不是读取data_root下的标注文件；
+                清单中的相对路径相对于data_root
         """
         self.data_root = data_root
         self.folds_split = folds_split
         self.selected_labels = selected_labels
+        self.manifest_path = manifest_path
         if self.selected_labels:
             print('@ Selected Labels: ', self.selected_labels)
         with open(label_names_path, 'r') as f:
@@ -223,7 +233,8 @@ class GetDataloader(object):
             if not test_size:
                 raise ValueError('You must specified test_size when folds_split equal to 1.')
     
-    def get_dataloader(self, batch_size, image_size, mean, std, transforms=None, multi_scale=False, val_multi_scale=False):
+    def get_dataloader(self, batch_size, image_size, mean, std, transforms=None, multi_scale=False, val_multi_scale=False,
+                       distribution_path=None):
         """得到数据加载器
         Args:
             batch_size: int, 批量大小
@@ -232,13 +243,15 @@ class GetDataloader(object):
             std: tuple, 通道方差
             transforms: callable, 数据增强方式
             multi_scale: 是否使用多尺度训练
+            distribution_path: str, 保存各个折的类别数目的路径，为None时不保存
         Return:
             train_dataloader_folds: list, [train_dataloader_0, train_dataloader_1,...]
             valid_dataloader_folds: list, [val_dataloader_0, val_dataloader_1, ...]
         """
         train_lists, val_lists = self.get_split()
         train_dataloader_folds, valid_dataloader_folds = list(), list()
-        # self.draw_train_val_distribution(train_lists, val_lists)
+        if distribution_path:
+            self.save_train_val_distribution(train_lists, val_lists, distribution_path)
 
         for train_list, val_list in zip(train_lists, val_lists):
             train_dataset = TrainDataset(
@@ -267,12 +280,13 @@ class GetDataloader(object):
                 multi_scale=val_multi_scale
                 )
 
+            # 使用可恢复的采样器，断点续训时可以跳过已经使用过的样本
             train_dataloader = DataLoader(
                 train_dataset,
                 batch_size=batch_size,
+                sampler=ResumableRandomSampler(train_dataset),
                 num_workers=8,
-                pin_memory=True,
-                shuffle=True
+                pin_memory=True
             )
             val_dataloader = DataLoader(
                 val_dataset,
@@ -285,55 +299,23 @@ class GetDataloader(object):
             valid_dataloader_folds.append(val_dataloader)
         return train_dataloader_folds, valid_dataloader_folds
 
-    def draw_train_val_distribution(self, train_lists, val_lists):
-        """ 画出各个折的训练集与验证集的数据分布
+    def save_train_val_distribution(self, train_lists, val_lists, path='split_distribution.json'):
+        """ 保存各个折的训练集与验证集中各个类别的样本数目，画图使用utils/data_analysis.py中的render_split_distribution，
+        不在数据加载时进行
 
         Args:
-            train_lists: list, 每一个数据均为[train_sample, train_label], train_sample: list, 样本名称， train_label: list, 样本类标
-            val_lists: list, 每一个数据均为[val_sample, val_label]， val_sample: list, 样本名称， val_label: list, 样本类标
+            train_lists: list, 每一个数据的最后一项为样本类标
+            val_lists: list, 每一个数据的最后一项为样本类标
+            path: 保存路径
         """
+        split_distribution = {}
         for index, (train_list, val_list) in enumerate(zip(train_lists, val_lists)):
-            train_labels_number = {}
-            for label in train_list[1]:
-                if label in train_labels_number.keys():
-                    train_labels_number[label] += 1
-                else:
-                    train_labels_number[label] = 1
-            self.draw_labels_number(train_labels_number, phase='Train_%s' % index)
-            val_labels_number = {}
-            for label in val_list[1]:
-                if label in val_labels_number.keys():
-                    val_labels_number[label] += 1
-                else:
-                    val_labels_number[label] = 1
-            self.draw_labels_number(val_labels_number, phase='Val_%s' % index)
-
-    def draw_labels_number(self, labels_number, phase='Train'):
-        """ 画图函数
-        Args:
-            labels_number: dict, {label_1: number_1, label_2: number_2, ...}
-            phase: str, 当前模式
-        """
-        labels = labels_number.keys()
-        number = labels_number.values()
-        name = [self.label_to_name[str(label)] for label in labels]
-        
-        plt.figure(figsize=(20, 16), dpi=240)
-        font = FontProperties(fname=r"font/simhei.ttf", size=7)
-        ax1 = plt.subplot(111)
-        x_axis = range(len(labels))
-        rects = ax1.bar(x=x_axis, height=number, width=0.8, label='Label Number')
-        plt.ylabel('Number')
-        plt.xticks([index + 0.13 for index in x_axis], name, fontproperties=font, rotation=270)
-        plt.xlabel('Labels')
-        plt.title('%s: Sample Number of Each Label' % phase)
-        plt.legend()
+            for phase, labels in (('Train_%s' % index, train_list[-1]), ('Val_%s' % index, val_list[-1])):
+                labels_number = collections.Counter(int(label) for label in labels)
+                split_distribution[phase] = {str(label): labels_number[label] for label in sorted(labels_number)}
+        with open(path, 'w') as f:
+            json.dump(split_distribution, f)
 
-        for rect in rects:
-            height = rect.get_height()
-            plt.text(rect.get_x() + rect.get_width() / 2, height+1, str(height), ha="center", va="bottom")
-        plt.savefig('readme/%s.jpg' % phase, dpi=240)
-        
     def get_split(self):
         """对数据集进行划分
         Return:
@@ -344,6 +326,8 @@ class GetDataloader(object):
             print('@ Loading dataset split from %s' % self.load_split_from_file)
             with open(self.load_split_from_file, 'r') as f:
                 train_list, val_list = json.load(f)
+            if self.manifest_path:
+                train_list, val_list = self.filter_split(train_list, val_list)
         else:
             if self.folds_split == 1:
                 train_list, val_list = self.get_data_split_single()
@@ -354,7 +338,34 @@ class GetDataloader(object):
                 json.dump([train_list, val_list], f)
 
         return train_list, val_list
-        
+
+    def filter_split(self, train_list, val_list):
+        """使用清单时，从文件加载的划分只保留清单中的样本，类标以清单为准；清单中新增的样本不在划分中，不参与训练
+
+        Args:
+            train_list: list, 每一个数据均为[train_sample, train_label]
+            val_list: list, 每一个数据均为[val_sample, val_label]
+        Return:
+            过滤后的train_list, val_list
+        """
+        manifest_labels = dict(zip(self.samples, self.labels))
+        split_samples = set()
+        filtered_lists = []
+        for folds in (train_list, val_list):
+            filtered_folds = []
+            for samples, _ in folds:
+                split_samples.update(samples)
+                kept = [sample for sample in samples if sample in manifest_labels]
+                filtered_folds.append([kept, [manifest_labels[sample] for sample in kept]])
+            filtered_lists.append(filtered_folds)
+        removed = len(split_samples - set(manifest_labels))
+        missing = len(set(manifest_labels) - split_samples)
+        print('@ Filtering dataset split with manifest: %d samples not in the manifest are removed, '
+              '%d samples of the manifest are not in the split.' % (removed, missing))
+        if not any(samples for samples, _ in filtered_lists[0]):
+            raise ValueError('No sample of %s is in the manifest %s.' % (self.load_split_from_file, self.manifest_path))
+        return filtered_lists[0], filtered_lists[1]
+
     def get_data_split_single(self):
         """随机划分训练集和验证集
         Return:
@@ -370,7 +381,7 @@ class GetDataloader(object):
         if self.val_official:
             # 如果在验证集中只使用官方的数据集
             for sample_index, sample in enumerate(self.samples):
-                if 'img' in sample:
+                if is_official(sample):
                     split_samples.append(sample)
                     split_labels.append(self.labels[sample_index])
                 else:
@@ -407,7 +418,7 @@ class GetDataloader(object):
         if self.val_official:
             # 如果在验证集中只使用官方的数据集
             for sample_index, sample in enumerate(self.samples):
-                if 'img' in sample:
+                if is_official(sample):
                     split_samples.append(sample)
                     split_labels.append(self.labels[sample_index])
                 else:
@@ -434,28 +445,38 @@ class GetDataloader(object):
             samples: list, 所有的图片名称
             labels: list, 所有的图片对应的类标, 和samples一一对应
         """
+        samples = []
+        labels = []
+        for sample_name, label in self.iterate_samples_labels():
+            if self.selected_labels:
+                # 依据父类别进行过滤
+                parent_label = self.label_to_name[str(label)].split('/')[0]
+                if parent_label in self.selected_labels:
+                    samples.append(sample_name)
+                    labels.append(label) 
+            else:                           
+                samples.append(sample_name)
+                labels.append(label)
+        return samples, labels
+
+    def iterate_samples_labels(self):
+        """ 依次返回(样本名称, 类标)，样本来自清单或者data_root下的标注文件
+        """
+        if self.manifest_path:
+            print('@ Loading samples from manifest %s' % self.manifest_path)
+            for entry in Manifest.load(self.manifest_path):
+                yield entry['path'], int(entry['label'])
+            return
         files_list = os.listdir(self.data_root)
         # 过滤得到标注文件
         annotations_files_list = [f for f in files_list if f.split('.')[1] == 'txt']
-
-        samples = []
-        labels = []
         for annotation_file in annotations_files_list:
             annotation_file_path = os.path.join(self.data_root, annotation_file)
             with open(annotation_file_path, encoding='utf-8-sig') as f:
                 for sample_label in f:
                     sample_name = sample_label.split(', ')[0]
                     label = int(sample_label.split(', ')[1])
-                    if self.selected_labels:
-                        # 依据父类别进行过滤
-                        parent_label = self.label_to_name[str(label)].split('/')[0]
-                        if parent_label in self.selected_labels:
-                            samples.append(sample_name)
-                            labels.append(label) 
-                    else:                           
-                        samples.append(sample_name)
-                        labels.append(label)
-        return samples, labels
+                    yield sample_name, label
 
 
 def multi_scale_transforms(image_size, images, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), auto_aug=False):
@@ -540,9 +561,9 @@ def get_dataloader_from_folder(
     train_dataloader = DataLoader(
         train_dataset,
         batch_size=batch_size,
+        sampler=ResumableRandomSampler(train_dataset),
         num_workers=8,
-        pin_memory=True,
-        shuffle=True
+        pin_memory=True
     )
     val_dataloader = DataLoader(
         val_dataset,
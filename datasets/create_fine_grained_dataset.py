@@ -3,8 +3,7 @@ import os
 import json
 import numpy as np
 from PIL import Image
-import matplotlib.pylab as plt
-from matplotlib.font_manager import FontProperties
+import collections
 from sklearn.model_selection import train_test_split, StratifiedKFold
 from torch.utils.data import Dataset, DataLoader
 import torchvision.transforms as T
@@ -141,7 +140,7 @@ class GetDataloader(object):
             if not test_size:
                 raise ValueError('You must specified test_size when folds_split equal to 1.')
     
-    def get_dataloader(self, batch_size, image_size, mean, std, transforms=None):
+    def get_dataloader(self, batch_size, image_size, mean, std, transforms=None, distribution_path=None):
         """得到数据加载器
         Args:
             batch_size: int, 批量大小
@@ -149,13 +148,15 @@ class GetDataloader(object):
             mean: tuple, 通道均值
             std: tuple, 通道方差
             transforms: callable, 数据增强方式
+            distribution_path: str, 保存各个折的类别数目的路径，为None时不保存
         Return:
             train_dataloader_folds: list, [train_dataloader_0, train_dataloader_1,...]
             valid_dataloader_folds: list, [val_dataloader_0, val_dataloader_1, ...]
         """
         train_lists, val_lists = self.get_split()
         train_dataloader_folds, valid_dataloader_folds = list(), list()
-        self.draw_train_val_distribution(train_lists, val_lists)
+        if distribution_path:
+            self.save_train_val_distribution(train_lists, val_lists, distribution_path)
 
         for train_list, val_list in zip(train_lists, val_lists):
             train_dataset = TrainDataset(self.data_root, train_list[0], train_list[1], train_list[2], image_size,
@@ -180,55 +181,23 @@ class GetDataloader(object):
             valid_dataloader_folds.append(val_dataloader)
         return train_dataloader_folds, valid_dataloader_folds
 
-    def draw_train_val_distribution(self, train_lists, val_lists):
-        """ 画出各个折的训练集与验证集的数据分布
+    def save_train_val_distribution(self, train_lists, val_lists, path='split_distribution.json'):
+        """ 保存各个折的训练集与验证集中各个类别的样本数目，画图使用utils/data_analysis.py中的render_split_distribution，
+        不在数据加载时进行
 
         Args:
-            train_lists: list, 每一个数据均为[train_sample, train_label], train_sample: list, 样本名称， train_label: list, 样本类标
-            val_lists: list, 每一个数据均为[val_sample, val_label]， val_sample: list, 样本名称， val_label: list, 样本类标
+            train_lists: list, 每一个数据的最后一项为样本类标
+            val_lists: list, 每一个数据的最后一项为样本类标
+            path: 保存路径
         """
+        split_distribution = {}
         for index, (train_list, val_list) in enumerate(zip(train_lists, val_lists)):
-            train_labels_number = {}
-            for label in train_list[1]:
-                if label in train_labels_number.keys():
-                    train_labels_number[label] += 1
-                else:
-                    train_labels_number[label] = 1
-            self.draw_labels_number(train_labels_number, phase='Train_%s' % index)
-            val_labels_number = {}
-            for label in val_list[1]:
-                if label in val_labels_number.keys():
-                    val_labels_number[label] += 1
-                else:
-                    val_labels_number[label] = 1
-            self.draw_labels_number(val_labels_number, phase='Val_%s' % index)
+            for phase, labels in (('Train_%s' % index, train_list[-1]), ('Val_%s' % index, val_list[-1])):
+                labels_number = collections.Counter(int(label) for label in labels)
+                split_distribution[phase] = {str(label): labels_number[label] for label in sorted(labels_number)}
+        with open(path, 'w') as f:
+            json.dump(split_distribution, f)
 
-    def draw_labels_number(self, labels_number, phase='Train'):
-        """ 画图函数
-        Args:
-            labels_number: dict, {label_1: number_1, label_2: number_2, ...}
-            phase: str, 当前模式
-        """
-        labels = labels_number.keys()
-        number = labels_number.values()
-        name = [self.label_to_name[str(label)] for label in labels]
-        
-        plt.figure(figsize=(20, 16), dpi=240)
-        font = FontProperties(fname=r"font/simhei.ttf", size=7)
-        ax1 = plt.subplot(111)
-        x_axis = range(len(labels))
-        rects = ax1.bar(x=x_axis, height=number, width=0.8, label='Label Number')
-        plt.ylabel('Number')
-        plt.xticks([index + 0.13 for index in x_axis], name, fontproperties=font, rotation=270)
-        plt.xlabel('Labels')
-        plt.title('%s: Sample Number of Each Label' % phase)
-        plt.legend()
-
-        for rect in rects:
-            height = rect.get_height()
-            plt.text(rect.get_x() + rect.get_width() / 2, height+1, str(height), ha="center", va="bottom")
-        plt.savefig('readme/%s.jpg' % phase, dpi=240)
-        
     def get_split(self):
         """对数据集进行划分
         Return:
@@ -0,0 +1,114 @@
+'''
+该文件的功能：数据集清单（manifest），代替对图片的物理拷贝
+
+清单为jsonl文件，每一行为一个样本：{"path": 图片路径, "label": 类标, "source": 来源, ...}，
+其中path为绝对路径或者相对于数据集根目录的路径；os.path.join(data_root, path)对两种路径都适用，
+因此清单中的样本可以直接交给TrainDataset与ValDataset。
+'''
+import json
+import os
+import numpy as np
+
+
+def is_official(sample):
+    """ 官方数据的样本名称中包含img，样本为清单中的路径时只判断文件名
+    """
+    return 'img' in os.path.basename(sample)
+
+
+class Manifest:
+    """样本清单，每个样本为一个包含path、label、source等字段的dict
+    """
+
+    def __init__(self, entries=None):
+        '''
+        Args:
+            entries: list, 样本，每个样本为dict，至少包含path与label
+        '''
+        self.entries = list(entries) if entries is not None else []
+
+    def add(self, path, label, source='', **extra):
+        ''' 添加一个样本，extra中的字段（如伪标签的得分）一同保存
+        '''
+        entry = {'path': path, 'label': int(label), 'source': source}
+        entry.update(extra)
+        self.entries.append(entry)
+        return entry
+
+    def extend(self, entries):
+        self.entries.extend(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    @property
+    def samples(self):
+        return [entry['path'] for entry in self.entries]
+
+    @property
+    def labels(self):
+        return [entry['label'] for entry in self.entries]
+
+    def class_counts(self, num_classes):
+        ''' 各个类别的样本数目，[num_classes]
+        '''
+        return np.bincount(np.asarray(self.labels, dtype=np.int64), minlength=num_classes)
+
+    def filter(self, function):
+        ''' 返回只包含function(entry)为True的样本的新清单
+        '''
+        return Manifest([entry for entry in self.entries if function(entry)])
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # 先写入临时文件再替换，中断时不会留下不完整的清单
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def append(path, entries):
+        ''' 将样本追加到清单文件的末尾，用于边处理边保存
+        '''
+        with open(path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    @staticmethod
+    def load(path, limit=None):
+        ''' 读取清单文件
+
+        Args:
+            path: str, 清单文件的路径
+            limit: int, 只读取前limit个样本，为None时读取全部
+        '''
+        entries = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if limit is not None and len(entries) >= limit:
+                    break
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+        return Manifest(entries)
+
+    @staticmethod
+    def from_annotations(data_root, source='official'):
+        ''' 由数据集目录中的txt标注文件（每行为"img_1.jpg, 0"）得到清单，路径相对于data_root
+        '''
+        manifest = Manifest()
+        for annotation_file in sorted(os.listdir(data_root)):
+            if not annotation_file.endswith('.txt'):
+                continue
+            with open(os.path.join(data_root, annotation_file), encoding='utf-8-sig') as f:
+                for sample_label in f:
+                    if sample_label.strip():
+                        sample_name, label = sample_label.split(', ')
+                        manifest.add(sample_name, int(label), source)
+        return manifest
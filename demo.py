@@ -121,7 +121,7 @@ class DemoResults(object):
         """
         prepare_model = PrepareModel()
         model = prepare_model.create_model(self.model_type, self.classes_num, 0, pretrained=False)
-        model.load_state_dict(torch.load(self.weight_path)['state_dict'])
+        model = prepare_model.load_chekpoint(model, self.weight_path)
         print('Successfully Loaded from %s' % self.weight_path)
         model = model.cuda()
         model.eval()
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+该文件的功能：基于asyncio的图片爬虫，根据搜索词翻页获取图片链接并下载
+
+* 所有请求共享一个连接池，并限制每个域名的并发连接数目；
+* 每个域名使用一个令牌桶限制请求速率；
+* 连接失败、超时以及429/5xx状态码时按照指数退避重试；
+* 图片以流的方式写入临时文件，下载完成后再重命名，中断时不会留下不完整的图片；
+* 给定ImageValidator时，收到文件头后即检查格式，下载完成后校验解码、尺寸并进行近似去重，
+  不合格与重复的图片不会写入保存目录；
+* 链接与搜索进度保存在sqlite数据库中，中断后再次运行时不会重复获取已经完成的搜索页与图片。
+
+图片保存为"搜索词_编号.jpg"，与predict_download_image.py要求的命名格式相同。
+
+用法：python -m expand_images.async_crawler --label_json_path label_id_name.json --save_path download_images
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import time
+import urllib.parse
+
+import aiohttp
+
+from expand_images.image_validator import ImageValidator, SIGNATURE_BYTES
+
+BAIDU_SEARCH_URL = 'http://image.baidu.com/search/flip?tn=baiduimage&ipn=r&ct=201326592&cl=2&lm=-1&st=-1&fm=result&fr=&sf=1&fmq=1497491098685_R&pv=&ic=0&nc=1&z=&se=1&showtab=0&fb=0&width=&height=&face=0&istype=2&ie=utf-8&ctd=1497491098685%5E00_1519X735&word={keyword}'
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64; rv:55.0) Gecko/20100101 Firefox/55.0'}
+# 需要重试的状态码，其余的4xx状态码直接记为失败
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+class TokenBucket(object):
+    """令牌桶，平均每秒产生rate个令牌，最多积累capacity个令牌
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        Args:
+            rate: float, 每秒的请求数目，小于等于0时不限速
+            capacity: int, 允许的突发请求数目，默认与rate相同
+        """
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class UrlStateDB(object):
+    """保存图片链接与搜索进度的sqlite数据库
+
+    urls表中每个链接的状态为pending（待下载）、done（已下载）、failed（重试后仍失败）或者rejected（未通过校验），
+    已下载图片的pHash保存在phash列中；
+    keywords表记录已经完成翻页的搜索词。
+    """
+    def __init__(self, db_path):
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS urls (id INTEGER PRIMARY KEY, url TEXT UNIQUE, keyword TEXT, '
+            'status TEXT DEFAULT "pending", path TEXT, attempts INTEGER DEFAULT 0, error TEXT, phash TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS keywords (keyword TEXT PRIMARY KEY)')
+        self.connection.commit()
+
+    def add_urls(self, urls, keyword):
+        """添加图片链接，已经存在的链接（包括其他搜索词得到的）被忽略
+        """
+        self.connection.executemany('INSERT OR IGNORE INTO urls (url, keyword) VALUES (?, ?)',
+                                    [(url, keyword) for url in urls])
+        self.connection.commit()
+
+    def finish_keyword(self, keyword):
+        self.connection.execute('INSERT OR IGNORE INTO keywords VALUES (?)', (keyword,))
+        self.connection.commit()
+
+    def finished_keywords(self):
+        return set(row[0] for row in self.connection.execute('SELECT keyword FROM keywords'))
+
+    def pending(self, retry_failed=False):
+        """待下载的链接，list of (id, url, keyword)
+        """
+        status = ('pending', 'failed') if retry_failed else ('pending',)
+        return self.connection.execute(
+            'SELECT id, url, keyword FROM urls WHERE status IN (%s) ORDER BY id' % ','.join('?' * len(status)),
+            status).fetchall()
+
+    def mark(self, url_id, status, attempts, path=None, error=None, phash=None):
+        self.connection.execute(
+            'UPDATE urls SET status = ?, attempts = ?, path = ?, error = ?, phash = ? WHERE id = ?',
+            (status, attempts, path, error, phash, url_id))
+        self.connection.commit()
+
+    def done_hashes(self):
+        """已下载图片的路径与pHash，list of (path, phash)
+        """
+        return self.connection.execute(
+            'SELECT path, phash FROM urls WHERE status = "done" AND phash IS NOT NULL ORDER BY id').fetchall()
+
+    def counts(self):
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM urls GROUP BY status').fetchall())
+
+    def close(self):
+        self.connection.close()
+
+
+class PermanentError(Exception):
+    """不需要重试的错误，如404、返回的不是图片等
+    """
+    pass
+
+
+class RejectedError(PermanentError):
+    """图片未通过ImageValidator的校验
+    """
+    pass
+
+
+class AsyncCrawler(object):
+    def __init__(self, save_path, db_path=None, concurrency=64, per_host=4, rate=10, retries=3, backoff=0.5,
+                 timeout=15, max_bytes=20 * 1024 * 1024, search_url=BAIDU_SEARCH_URL, validator=None):
+        """
+        Args:
+            save_path: 图片的保存路径
+            db_path: 链接状态数据库的路径，默认为save_path下的crawler_state.db
+            concurrency: 同时进行的请求数目，即连接池的大小
+            per_host: 每个域名的最大并发连接数目
+            rate: float, 每个域名每秒的最大请求数目，小于等于0时不限速
+            retries: 失败后的最大重试次数
+            backoff: 第n次重试前等待backoff * 2 ** n秒
+            timeout: 单个请求的超时时间（秒）
+            max_bytes: 单张图片的最大字节数，超过时放弃下载
+            search_url: 搜索页的链接，{keyword}为搜索词
+            validator: ImageValidator, 为None时不校验下载的图片
+        """
+        self.save_path = save_path
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+        self.db = UrlStateDB(db_path or os.path.join(save_path, 'crawler_state.db'))
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.search_url = search_url
+        self.buckets = {}
+        self.validator = validator
+        if validator is not None:
+            # 恢复之前已下载图片的近似去重索引
+            for path, phash in self.db.done_hashes():
+                validator.add(phash, os.path.basename(path))
+
+    def run(self, keywords, page_number=70, retry_failed=False):
+        """爬取所有搜索词的图片
+
+        Args:
+            keywords: list, 搜索词
+            page_number: 每个搜索词的最大翻页数目
+            retry_failed: bool, 是否重新下载之前失败的链接
+        Return:
+            counts: dict, 各个状态的链接数目
+        """
+        return asyncio.run(self.crawl(keywords, page_number, retry_failed))
+
+    async def crawl(self, keywords, page_number=70, retry_failed=False):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HEADERS) as session:
+            # 翻页获取图片链接，已经完成的搜索词不再翻页
+            finished = self.db.finished_keywords()
+            await asyncio.gather(*[self.search_keyword(session, keyword, page_number)
+                                   for keyword in keywords if keyword not in finished])
+
+            # 固定数目的协程从队列中取出链接进行下载，避免同时创建大量的任务
+            queue = asyncio.Queue()
+            for item in self.db.pending(retry_failed):
+                queue.put_nowait(item)
+            print('Downloading %d images.' % queue.qsize())
+            workers = [asyncio.ensure_future(self.download_worker(session, queue)) for _ in range(self.concurrency)]
+            await queue.join()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        counts = self.db.counts()
+        print('Crawling finished: %s' % counts)
+        return counts
+
+    async def search_keyword(self, session, keyword, page_number):
+        """翻页获取单个搜索词的所有图片链接，每一页的链接得到后立即写入数据库
+        """
+        page_url = self.search_url.format(keyword=urllib.parse.quote(keyword, safe='/'))
+        for _ in range(page_number + 1):
+            try:
+                html = (await self.request(session, page_url)).decode('utf-8', errors='ignore')
+            except (PermanentError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # 翻页失败时不记录完成，下一次运行时重新翻页
+                print('Failed to fetch %s: %r' % (page_url, e))
+                return
+            pic_urls, page_url = parse_search_page(html, page_url)
+            self.db.add_urls(pic_urls, keyword)
+            if not page_url:
+                break
+        self.db.finish_keyword(keyword)
+
+    async def download_worker(self, session, queue):
+        while True:
+            url_id, url, keyword = await queue.get()
+            try:
+                await self.download(session, url_id, url, keyword)
+            finally:
+                queue.task_done()
+
+    async def download(self, session, url_id, url, keyword):
+        """下载单张图片，并在数据库中记录结果
+        """
+        image_path = os.path.join(self.save_path, '%s_%d%s' % (keyword, url_id, get_suffix(url)))
+        headers = {'Referer': get_referrer(url)}
+        try:
+            attempts, info = await self.request(session, url, headers=headers, save_path=image_path)
+        except RejectedError as e:
+            self.db.mark(url_id, 'rejected', e.attempts, error=str(e))
+        except (PermanentError, aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            self.db.mark(url_id, 'failed', getattr(e, 'attempts', 0), error=repr(e))
+        else:
+            self.db.mark(url_id, 'done', attempts, path=image_path, phash=info.get('phash'))
+
+    async def request(self, session, url, headers=None, save_path=None):
+        """带重试的GET请求
+
+        Args:
+            save_path: 为None时返回响应的内容，否则将内容以流的方式写入save_path，并返回尝试的次数与图片的校验信息
+        """
+        host = urllib.parse.urlparse(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate)
+        for attempt in range(self.retries + 1):
+            await self.buckets[host].acquire()
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if response.status in RETRY_STATUS:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                          status=response.status, message=response.reason)
+                    if response.status != 200:
+                        raise PermanentError('HTTP %d' % response.status)
+                    if save_path is None:
+                        return await response.read()
+                    if response.content_type.startswith('text/'):
+                        raise PermanentError('Not an image: %s' % response.content_type)
+                    info = await self.stream_to_file(response, save_path)
+                    return attempt + 1, info
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    e.attempts = attempt + 1
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+            except PermanentError as e:
+                e.attempts = attempt + 1
+                raise
+
+    async def stream_to_file(self, response, save_path):
+        """分块写入临时文件，通过校验后重命名
+
+        Return:
+            info: dict, 图片的格式、宽、高与pHash，没有validator时为{}
+        """
+        temp_path = save_path + '.part'
+        size = 0
+        # 只保留文件头用于提前检查格式，完整的校验在下载结束后从磁盘读取
+        head = b''
+        info = {}
+        try:
+            with open(temp_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise PermanentError('Image is larger than %d bytes' % self.max_bytes)
+                    f.write(chunk)
+                    if self.validator is not None and len(head) < SIGNATURE_BYTES:
+                        head += chunk[:SIGNATURE_BYTES - len(head)]
+                        # 收到文件头后立即检查格式，不是图片时不再继续下载
+                        if len(head) == SIGNATURE_BYTES:
+                            reason = self.validator.check_head(head)
+                            if reason:
+                                raise RejectedError(reason)
+            if self.validator is not None:
+                # 解码与哈希在线程池中进行，不阻塞其他下载
+                reason, info = await asyncio.get_event_loop().run_in_executor(
+                    None, self.validator.validate_file, temp_path, os.path.basename(save_path))
+                if reason:
+                    raise RejectedError(reason)
+            os.replace(temp_path, save_path)
+            return info
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def close(self):
+        self.db.close()
+
+
+def parse_search_page(html, page_url):
+    """解析百度图片的翻页搜索结果
+
+    Return:
+        pic_urls: list, 当前页的所有图片链接
+        next_url: str, 下一页的链接，没有下一页时为''
+    """
+    pic_urls = re.findall('"objURL":"(.*?)",', html, re.S)
+    next_urls = re.findall(r'<a href="(.*)" class="n">下一页</a>', html)
+    next_url = urllib.parse.urljoin(page_url, next_urls[0]) if next_urls else ''
+    return pic_urls, next_url
+
+
+def get_suffix(url):
+    """图片链接的后缀名，无法得到时为.jpg
+    """
+    suffix = os.path.splitext(urllib.parse.urlparse(url).path)[1].lower()
+    return suffix if suffix in ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp') else '.jpg'
+
+
+def get_referrer(url):
+    """由图片链接生成referrer，减少403
+    """
+    par = urllib.parse.urlparse(url)
+    if par.scheme:
+        return par.scheme + '://' + par.netloc
+    else:
+        return par.netloc
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--label_json_path', type=str, default='label_id_name.json')
+    parser.add_argument('--save_path', type=str, default='download_images')
+    parser.add_argument('--page_number', type=int, default=70, help='max pages for each keyword')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--per_host', type=int, default=4, help='max connections for each host')
+    parser.add_argument('--rate', type=float, default=10, help='max requests per second for each host')
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--retry_failed', action='store_true', help='retry the failed urls of the last run')
+    parser.add_argument('--min_bytes', type=int, default=1024, help='reject images smaller than min_bytes')
+    parser.add_argument('--min_side', type=int, default=64, help='reject images whose short side is smaller')
+    parser.add_argument('--max_distance', type=int, default=4,
+                        help='max pHash hamming distance of near duplicates, negative to keep duplicates')
+    args = parser.parse_args()
+
+    with open(args.label_json_path, 'r') as f:
+        label = json.load(f).values()
+    keywords = [keyword.split('/')[1] for keyword in label]
+    crawler = AsyncCrawler(args.save_path, concurrency=args.concurrency, per_host=args.per_host, rate=args.rate,
+                           retries=args.retries,
+                           validator=ImageValidator(args.min_bytes, args.min_side, max_distance=args.max_distance))
+    try:
+        crawler.run(keywords, args.page_number, args.retry_failed)
+    finally:
+        crawler.close()
@@ -90,6 +90,7 @@ class Crawler:
             url = 'http://image.baidu.com/search/avatarjson?tn=resultjsonavatarnew&ie=utf-8&word=' + search + '&cg=girl&pn=' + str(
                 pn) + '&rn=60&itg=0&z=0&fr=&width=&height=&lm=-1&ic=0&s=0&st=-1&gsm=1e0000001e'
             # 设置header防ban
+            page = None
             try:
                 time.sleep(self.time_sleep)
                 req = urllib.request.Request(url=url, headers=self.headers)
@@ -112,7 +113,8 @@ class Crawler:
                 print("下载下一页")
                 pn += 60
             finally:
-                page.close()
+                if page is not None:
+                    page.close()
         print("下载任务结束")
         return
 
@@ -1,31 +1,17 @@
-import shutil
 import os
-import tqdm
+from datasets.manifest import Manifest
+from expand_images.compose_dataset import load_pool, link_dataset
 
 
 def combine_dataset(download_root, official_root, combine_root):
-    if os.path.exists(combine_root):
-        print('Removing %s' % combine_root)
-        shutil.rmtree(combine_root)
-        print('Making %s' % combine_root)
-        os.mkdir(combine_root)
-    else:
-        print('Making %s' % combine_root)
-        os.mkdir(combine_root)        
+    """将下载数据与官方数据合并至combine_root，图片以硬链接的方式保存，不再拷贝
 
-    download_files = os.listdir(download_root)
-    tbar = tqdm.tqdm(download_files)
-    for download_file in tbar:
-        scr_file = os.path.join(download_root, download_file)
-        target_file = os.path.join(combine_root, download_file)
-        shutil.copy(scr_file, target_file)
-    
-    official_files = os.listdir(official_root)
-    tbar = tqdm.tqdm(official_files)
-    for official_file in tbar:
-        scr_file = os.path.join(official_root, official_file)
-        target_file = os.path.join(combine_root, official_file)
-        shutil.copy(scr_file, target_file)
+    训练时也可以不生成目录，直接使用compose_dataset.py得到的清单
+    """
+    manifest = Manifest()
+    manifest.extend(load_pool(download_root, 'download').entries)
+    manifest.extend(load_pool(official_root, 'official').entries)
+    link_dataset(manifest, combine_root)
 
 
 if __name__ == "__main__":
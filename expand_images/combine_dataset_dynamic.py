@@ -1,66 +1,26 @@
-import shutil
-import os
-import tqdm
-from utils.data_analysis import DatasetStatistic
 import json
 import random
+from utils.data_analysis import DatasetStatistic
+from expand_images.compose_dataset import compose_dataset, link_dataset, calculate_complement_number
 
 
 #########################
-# 依据类别得分动态拷贝样本 
+# 依据类别得分动态采样样本
 #########################
-def combine_dataset(download_root, official_root, combine_root, labels_to_complement_number):
-    if os.path.exists(combine_root):
-        print('Removing %s' % combine_root)
-        shutil.rmtree(combine_root)
-        print('Making %s' % combine_root)
-        os.mkdir(combine_root)
-    else:
-        print('Making %s' % combine_root)
-        os.mkdir(combine_root)        
-
-    download_files = os.listdir(download_root)
-    tbar = tqdm.tqdm(labels_to_complement_number.items())
-    for label, number in tbar:
-        files_name = [file_name for file_name in download_files if label.split('/')[1] in file_name]
-        selected_number = int(min(number, len(files_name)/2))
-        selected_sample_files = random.sample(
-            [file_name for file_name in files_name if file_name.endswith('jpg')],
-            selected_number
-        )
-        selected_label_files = [file_name.replace('jpg', 'txt') for file_name in selected_sample_files]
-        descript = '%s: sampled: %d / %d' % (label, selected_number, len(files_name) / 2)
-        tbar.set_description(desc=descript)
-        for file_name in selected_sample_files + selected_label_files:
-            scr_file = os.path.join(download_root, file_name)
-            target_file = os.path.join(combine_root, file_name)
-            shutil.copy(scr_file, target_file)
-
-    official_files = os.listdir(official_root)
-    tbar = tqdm.tqdm(official_files)
-    for official_file in tbar:
-        scr_file = os.path.join(official_root, official_file)
-        target_file = os.path.join(combine_root, official_file)
-        shutil.copy(scr_file, target_file)
-
-
-def calculate_complement_number(labels_scores, max_number, min_number):
+def combine_dataset(download_root, official_root, combine_root, labels_to_complement_number,
+                    label_id_json='data/huawei_data/label_id_name.json', seed=0):
+    """官方数据全部保留，下载数据按照各类别的补充数目采样，结果以硬链接的方式保存至combine_root
+
+    Args:
+        labels_to_complement_number: dict, {'大类/大雁塔': 10, ...}
+        label_id_json: 类标与类别名称的对应文件
+        seed: 采样的随机种子，相同时结果相同
     """
-    按照分数计算需要补充的样本数目
-    :param labels_scores: 各个类别的得分
-    :param max_number: 最大补充样本数
-    :param min_number: 最少补充样本上数
-    :return:
-    """
-    max_score = sorted(labels_scores.values())[-1]
-    min_score = sorted(labels_scores.values())[0]
-    labels_to_complement_number = {}
-    for key, value in labels_scores.items():
-        # 得分越高，补充的样本数目越少
-        complement_number = int((max_score - value) / (max_score - min_score) * (max_number - min_number) + min_number)
-        labels_to_complement_number[key] = complement_number
-
-    return labels_to_complement_number
+    manifest, sampled = compose_dataset([official_root], [download_root], labels_to_complement_number,
+                                        label_id_json, seed)
+    for label, (selected_number, number) in sampled.items():
+        print('%d: sampled: %d / %d' % (label, selected_number, number))
+    return link_dataset(manifest, combine_root)
 
 
 if __name__ == "__main__":
@@ -72,6 +32,8 @@ if __name__ == "__main__":
     with open(label_id_json, 'r') as f:
         labels = json.load(f).values()
     labels = [label.split('/')[1] for label in labels]
+    seed = 0
+    random.seed(seed)
     dataset_statistic = DatasetStatistic(data_root, label_id_json)
     thresh = 100
     # 高于样本数目阈值的类别的补充数目
@@ -81,4 +43,4 @@ if __name__ == "__main__":
     # 依据官方数据计算各个类别补充样本的数目
     labels_to_complement_number = dataset_statistic.get_expand_number(thresh, more_than_thresh_number, less_than_thresh_number)
     print(labels_to_complement_number)
-    combine_dataset(download_root, data_root, combine_root, labels_to_complement_number)
+    combine_dataset(download_root, data_root, combine_root, labels_to_complement_number, label_id_json, seed)
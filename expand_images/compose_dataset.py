@@ -0,0 +1,166 @@
+'''
+该文件的功能：由官方数据与下载数据组成训练数据集，结果为清单（manifest）而不是拷贝后的目录
+
+* 每个数据源可以是带有txt标注文件的数据集目录，也可以是清单文件（如predict_download_image.py得到的pseudo_labels.jsonl）；
+* 官方数据全部保留，下载数据按照各类别的补充数目（如calculate_complement_number或DatasetStatistic.get_expand_number
+  的结果）进行采样，给定相同的seed时结果相同；
+* 训练时使用--manifest直接读取清单；需要目录形式的数据集时，使用link_dataset生成硬链接（或软链接）组成的目录。
+
+用法：python -m expand_images.compose_dataset
+'''
+import json
+import os
+import random
+import shutil
+
+from datasets.manifest import Manifest
+from utils.data_analysis import DatasetStatistic
+
+
+def calculate_complement_number(labels_scores, max_number, min_number):
+    """
+    按照分数计算需要补充的样本数目
+    :param labels_scores: 各个类别的得分
+    :param max_number: 最大补充样本数
+    :param min_number: 最少补充样本上数
+    :return:
+    """
+    max_score = sorted(labels_scores.values())[-1]
+    min_score = sorted(labels_scores.values())[0]
+    labels_to_complement_number = {}
+    for key, value in labels_scores.items():
+        # 得分越高，补充的样本数目越少
+        complement_number = int((max_score - value) / (max_score - min_score) * (max_number - min_number) + min_number)
+        labels_to_complement_number[key] = complement_number
+
+    return labels_to_complement_number
+
+
+def load_pool(pool, source):
+    """读取一个数据源中的所有样本，样本路径为绝对路径
+
+    Args:
+        pool: str, 带有txt标注文件的数据集目录或者清单文件
+        source: str, 记录在样本中的来源
+    """
+    if os.path.isdir(pool):
+        manifest = Manifest.from_annotations(pool, source)
+        root = pool
+    else:
+        manifest = Manifest.load(pool)
+        root = os.path.dirname(pool)
+    for entry in manifest:
+        entry['path'] = os.path.abspath(os.path.join(root, entry['path']))
+        entry['source'] = source
+    return manifest
+
+
+def labels_to_index(labels_to_number, label_id_json):
+    """将以类别名称（"大类/小类"或者"小类"）为键的补充数目转换为以类标为键
+    """
+    with open(label_id_json, 'r') as f:
+        label_id_name = json.load(f)
+    name_to_index = {}
+    for index, name in label_id_name.items():
+        name_to_index[name] = int(index)
+        name_to_index[name.split('/')[-1]] = int(index)
+    return {name_to_index[name]: number for name, number in labels_to_number.items()}
+
+
+def compose_dataset(official_pools, download_pools, labels_to_complement_number, label_id_json, seed=0):
+    """组成数据集
+
+    Args:
+        official_pools: list, 全部保留的数据源
+        download_pools: list, 按照补充数目采样的数据源
+        labels_to_complement_number: dict, {'大类/大雁塔': 10, ...}，各类别从download_pools中采样的数目，
+            样本数目不足时全部保留，未给出的类别不采样
+        label_id_json: 类标与类别名称的对应文件
+        seed: 采样的随机种子
+    Return:
+        manifest: Manifest, 样本路径为绝对路径
+        sampled: dict, {类标: (采样数目, 可用数目)}
+    """
+    manifest = Manifest()
+    seen = set()
+    for pool in official_pools:
+        for entry in load_pool(pool, 'official'):
+            if entry['path'] not in seen:
+                seen.add(entry['path'])
+                manifest.entries.append(entry)
+
+    # 按照类标一次性分组，而不是对每个类别扫描一遍所有文件
+    candidates = {}
+    for pool in download_pools:
+        for entry in load_pool(pool, 'download'):
+            if entry['path'] not in seen:
+                seen.add(entry['path'])
+                candidates.setdefault(entry['label'], []).append(entry)
+
+    rng = random.Random(seed)
+    sampled = {}
+    for label, number in sorted(labels_to_index(labels_to_complement_number, label_id_json).items()):
+        # 排序后再采样，结果与文件系统的遍历顺序无关
+        label_candidates = sorted(candidates.get(label, []), key=lambda entry: entry['path'])
+        selected_number = min(number, len(label_candidates))
+        manifest.extend(rng.sample(label_candidates, selected_number))
+        sampled[label] = (selected_number, len(label_candidates))
+    return manifest, sampled
+
+
+def link_dataset(manifest, link_root, symlink=False):
+    """由清单生成硬链接组成的数据集目录，每个样本带有一个"样本名, 类标"格式的txt标注文件
+
+    Args:
+        manifest: Manifest, 样本路径为绝对路径
+        link_root: 目标目录，已经存在时先删除（其中只有链接，删除不影响原始图片）
+        symlink: bool, 使用软链接，跨文件系统时需要使用
+    Return:
+        Manifest, 样本路径为相对于link_root的样本名
+    """
+    if os.path.exists(link_root):
+        print('Removing %s' % link_root)
+        shutil.rmtree(link_root)
+    print('Making %s' % link_root)
+    os.makedirs(link_root)
+    linked = Manifest()
+    for entry in manifest:
+        image_name = os.path.basename(entry['path'])
+        target_path = os.path.join(link_root, image_name)
+        if os.path.exists(target_path):
+            raise ValueError('Sample name %s is used by more than one source.' % image_name)
+        if symlink:
+            os.symlink(entry['path'], target_path)
+        else:
+            os.link(entry['path'], target_path)
+        with open(os.path.join(link_root, os.path.splitext(image_name)[0] + '.txt'), 'w') as f:
+            f.write(image_name + ', ' + str(entry['label']))
+        linked.entries.append(dict(entry, path=image_name))
+    return linked
+
+
+if __name__ == "__main__":
+    data_root = 'data/huawei_data/train_data'
+    download_pools = ['/media/mxq/data/competition/HuaWei/psudeo_image_huge/pseudo_labels.jsonl']
+    manifest_path = 'data/huawei_data/combine_huge.jsonl'
+    label_id_json = 'data/huawei_data/label_id_name.json'
+    seed = 0
+    # 为空时不生成目录，训练时使用--manifest读取manifest_path
+    link_root = ''
+
+    thresh = 100
+    # 高于样本数目阈值的类别的补充数目
+    more_than_thresh_number = 20
+    # 低于样本数目阈值的类别的补充数目
+    less_than_thresh_number = 100
+    # 依据官方数据计算各个类别补充样本的数目，get_expand_number中的随机数同样由seed决定
+    random.seed(seed)
+    dataset_statistic = DatasetStatistic(data_root, label_id_json)
+    labels_to_complement_number = dataset_statistic.get_expand_number(thresh, more_than_thresh_number, less_than_thresh_number)
+    manifest, sampled = compose_dataset([data_root], download_pools, labels_to_complement_number, label_id_json, seed)
+    for label, (selected_number, number) in sampled.items():
+        print('%d: sampled: %d / %d' % (label, selected_number, number))
+    manifest.save(manifest_path)
+    print('Saving %d samples to %s' % (len(manifest), manifest_path))
+    if link_root:
+        link_dataset(manifest, link_root)
@@ -5,7 +5,7 @@ import json
 import tqdm
 
 
-# 将特定文件从一个文件夹拷贝至另一个文件夹
+# 将特定文件从一个文件夹硬链接至另一个文件夹，跨文件系统时拷贝
 src_root = '/media/mxq/data/competition/HuaWei/choose_image'
 target_root = '/media/mxq/data/competition/HuaWei/cleaned_pesudeo_image'
 keywords_file = '/media/mxq/data/competition/HuaWei/2.json'
@@ -17,5 +17,8 @@ for keyword in keywords:
     tbar = tqdm.tqdm(files_name)
     for file_name in tbar:
         target_name = os.path.join(target_root, file_name.split('/')[-1])
-        shutil.copy(file_name, target_name)
+        try:
+            os.link(file_name, target_name)
+        except OSError:
+            shutil.copy(file_name, target_name)
         tbar.set_description(desc=file_name)
\ No newline at end of file
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+该文件的功能：在图片下载完成时对其进行校验与近似去重，不合格与重复的图片不会进入保存目录
+
+依次进行以下检查，任意一项不满足时拒绝：
+* 文件大小不小于min_bytes；
+* 由文件头的前若干个字节判断格式，只接受常见的图片格式；
+* 图片能够完整解码，且短边不小于min_side、像素数目不超过max_pixels；
+* 64位感知哈希（pHash）与已接受图片的汉明距离大于max_distance，近似重复的检索使用BK树。
+
+async_crawler.py在每张图片下载完成后调用ImageValidator；也可以单独运行本文件，对已经下载的目录进行一次性清洗：
+python -m expand_images.image_validator --image_path download_images --rejected_path rejected_images
+"""
+import argparse
+import io
+import os
+import shutil
+import threading
+
+import numpy as np
+from PIL import Image
+
+# 文件头到图片格式的映射
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tif'),
+    (b'MM\x00*', 'tif'),
+)
+# 判断格式所需的最少字节数
+SIGNATURE_BYTES = 12
+
+
+def sniff_format(head):
+    """由文件的前SIGNATURE_BYTES个字节判断图片格式
+
+    Args:
+        head: bytes, 文件头
+    Return:
+        str, 图片格式，不是图片时为None
+    """
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def _dct_matrix(n):
+    """n点DCT-II的正交变换矩阵，二维DCT为C @ X @ C.T
+    """
+    k = np.arange(n).reshape(-1, 1)
+    i = np.arange(n).reshape(1, -1)
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT_MATRIX = _dct_matrix(32)
+
+
+def phash(image):
+    """64位感知哈希：灰度图缩放至32x32，取二维DCT左上角8x8的低频系数，与除直流分量外的中位数比较
+
+    Args:
+        image: PIL.Image
+    Return:
+        int, 64位哈希
+    """
+    pixels = np.asarray(image.convert('L').resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low_frequency = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:8, :8].reshape(-1)
+    bits = low_frequency > np.median(low_frequency[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree(object):
+    """以汉明距离为度量的BK树，用于检索与给定哈希距离不超过阈值的所有哈希
+    """
+    def __init__(self):
+        # 每个节点为[哈希, 数据, {距离: 子节点}]
+        self.root = None
+        self.size = 0
+
+    def add(self, hash_value, item):
+        self.size += 1
+        node = [hash_value, item, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming_distance(hash_value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, hash_value, max_distance):
+        """
+        Return:
+            list of (距离, 数据)，按照距离从小到大排序
+        """
+        results = []
+        candidates = [self.root] if self.root is not None else []
+        while candidates:
+            node = candidates.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance:
+                results.append((distance, node[1]))
+            # 由三角不等式，只有与当前节点距离在[distance - max_distance, distance + max_distance]内的子树可能包含结果
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    candidates.append(child)
+        return sorted(results, key=lambda result: result[0])
+
+    def __len__(self):
+        return self.size
+
+
+class ImageValidator(object):
+    """图片校验与近似去重，可以在多个线程中同时调用validate
+    """
+    def __init__(self, min_bytes=1024, min_side=64, max_pixels=Image.MAX_IMAGE_PIXELS, max_distance=4):
+        """
+        Args:
+            min_bytes: 最小文件大小，bytes
+            min_side: 图片短边的最小长度
+            max_pixels: 图片的最大像素数目
+            max_distance: 与已接受图片的pHash汉明距离不超过max_distance时视为重复，小于0时不去重
+        """
+        self.min_bytes = min_bytes
+        self.min_side = min_side
+        self.max_pixels = max_pixels
+        self.max_distance = max_distance
+        self.index = BKTree()
+        self.lock = threading.Lock()
+
+    def check_head(self, head):
+        """下载过程中收到前SIGNATURE_BYTES个字节时调用，不是图片时可以提前放弃下载
+
+        Return:
+            str, 拒绝的原因，通过时为''
+        """
+        return '' if sniff_format(head) else 'unknown format'
+
+    def validate(self, data, name):
+        """校验图片，通过时将其加入近似去重的索引
+
+        Args:
+            data: bytes, 图片文件的内容
+            name: 图片的名称，重复时在拒绝原因中给出与之重复的图片名称
+        Return:
+            reason: str, 拒绝的原因，通过时为''
+            info: dict, 图片的格式、宽、高与pHash，解码失败时为{}
+        """
+        return self._validate(len(data), data[:SIGNATURE_BYTES], io.BytesIO(data), name)
+
+    def validate_file(self, path, name):
+        """与validate相同，但直接从磁盘上的文件解码，不需要将整个文件读入内存
+
+        Args:
+            path: 图片文件的路径
+            name: 图片的名称，重复时在拒绝原因中给出与之重复的图片名称
+        """
+        with open(path, 'rb') as f:
+            head = f.read(SIGNATURE_BYTES)
+            f.seek(0)
+            return self._validate(os.path.getsize(path), head, f, name)
+
+    def _validate(self, size, head, source, name):
+        if size < self.min_bytes:
+            return 'file size %d < %d' % (size, self.min_bytes), {}
+        image_format = sniff_format(head)
+        if image_format is None:
+            return 'unknown format', {}
+        try:
+            with Image.open(source) as image:
+                width, height = image.size
+                if width * height > self.max_pixels:
+                    return 'too many pixels: %dx%d' % (width, height), {}
+                # JPEG按照缩小的尺度解码，仍然需要读取整个文件，可以发现截断等错误
+                image.draft('RGB', (64, 64))
+                image.load()
+                hash_value = phash(image)
+        except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+            return 'decode error: %s' % e, {}
+        info = {'format': image_format, 'width': width, 'height': height, 'phash': '%016x' % hash_value}
+        if min(width, height) < self.min_side:
+            return 'image size %dx%d < %d' % (width, height, self.min_side), info
+        if self.max_distance >= 0:
+            with self.lock:
+                duplicates = self.index.search(hash_value, self.max_distance)
+                if duplicates:
+                    return 'duplicate of %s (distance %d)' % (duplicates[0][1], duplicates[0][0]), info
+                self.index.add(hash_value, name)
+        return '', info
+
+    def add(self, phash_hex, name):
+        """将已经接受的图片加入索引，用于中断后继续时恢复索引
+        """
+        with self.lock:
+            self.index.add(int(phash_hex, 16), name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_path', type=str, required=True)
+    parser.add_argument('--rejected_path', type=str, default='', help='move rejected images here, only report if empty')
+    parser.add_argument('--min_bytes', type=int, default=1024)
+    parser.add_argument('--min_side', type=int, default=64)
+    parser.add_argument('--max_distance', type=int, default=4)
+    args = parser.parse_args()
+
+    validator = ImageValidator(args.min_bytes, args.min_side, max_distance=args.max_distance)
+    if args.rejected_path and not os.path.exists(args.rejected_path):
+        os.makedirs(args.rejected_path)
+    rejected = 0
+    images = sorted(name for name in os.listdir(args.image_path) if not name.endswith('.txt'))
+    for image_name in images:
+        image_file = os.path.join(args.image_path, image_name)
+        reason, _ = validator.validate_file(image_file, image_name)
+        if reason:
+            rejected += 1
+            print('Rejecting %s: %s' % (image_name, reason))
+            if args.rejected_path:
+                shutil.move(image_file, os.path.join(args.rejected_path, image_name))
+    print('Rejected %d/%d images.' % (rejected, len(images)))
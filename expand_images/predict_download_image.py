@@ -5,107 +5,221 @@ import torch.nn.functional as F
 import numpy as np
 import os
 import json
+import hashlib
 import tqdm
 import shutil
 from PIL import Image, ImageFont, ImageDraw
+from torch.utils.data import Dataset, DataLoader, Subset
 from models.build_model import PrepareModel
+from datasets.manifest import Manifest
 from config import get_classify_config
+from utils.embedding_index import EmbeddingIndex
+
+
+# 爬取图片的标注类别与label_id_name.json中类别名称不同时的映射
+ANNOTATION_ALIASES = {'浆水鱼鱼': '凉鱼', '酥饺': '蜜饯张口酥饺'}
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class DownloadImageDataset(Dataset):
+    """爬取图片的数据集，图片解码失败时不抛出异常，而是返回全零图片并标记为解码失败
+    """
+    def __init__(self, samples_root, images_name, image_size, mean, std):
+        self.samples_root = samples_root
+        self.images_name = images_name
+        self.transforms = T.Compose([
+            T.Resize(image_size),
+            T.ToTensor(),
+            T.Normalize(mean, std)
+        ])
+        self.image_size = image_size
+
+    def __getitem__(self, index):
+        """
+        Return:
+            index: 样本在images_name中的下标
+            image: 图片，解码失败时为全零
+            decoded: bool, 图片是否解码成功
+            error: str, 解码失败的原因
+        """
+        image_path = os.path.join(self.samples_root, self.images_name[index])
+        try:
+            with Image.open(image_path) as image:
+                image = self.transforms(image.convert('RGB'))
+            return index, image, True, ''
+        except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+            return index, torch.zeros(3, *self.image_size), False, '%s: %s' % (type(e).__name__, e)
+
+    def __len__(self):
+        return len(self.images_name)
 
 
 #############################################
-# 进行伪标签预测，并将大于设定阈值的样本移动到指定目录
+# 进行伪标签预测，并将大于设定阈值的样本写入清单或者硬链接至指定目录
 #############################################
 class PredictDownloadImage(object):
-    def __init__(self, model_type, classes_num, weight_path, image_size, label_json_path, mean=[], std=[]):
+    def __init__(self, model_type, classes_num, weight_path, image_size, label_json_path, mean=[], std=[],
+                 head='linear', index_path=None, index_method='centroid'):
+        """
+        Args:
+            head: str, 模型分类层的类型，linear/arcface/sphereface/cosface
+            index_path: str, build_embedding_index.py得到的嵌入特征索引，不为None时按照最近邻分类，
+                并拒识与预测类别的类中心距离过远的样本，此时不再使用softmax阈值
+            index_method: str, 最近邻分类的方式，centroid/knn
+        """
         self.model_type = model_type
         self.classes_num = classes_num
         self.weight_path = weight_path
         self.image_size = image_size
         self.mean = mean
         self.std = std
+        self.head = head
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model, self.label_dict = self.__prepare__(label_json_path)
+        # 类别名称（如：大雁塔）到类标的映射
+        self.name_to_index = {label.split('/')[1]: int(index) for index, label in self.label_dict.items()}
+        self.embedding_index = None
+        self.index_path = index_path
+        self.index_method = index_method
+        if index_path:
+            print('@ Using embedding index: %s' % index_path)
+            self.embedding_index = EmbeddingIndex.load(index_path)
 
-    def predict_multi_smaples(self, samples_root, thresh={}, save_path=''):
-        """预测多张样本的伪标签，并将保留下的样本存放至指定的目录下
+    def predict_multi_smaples(self, samples_root, thresh={}, save_path='', batch_size=64, num_workers=8,
+                              link_images=False, resume=True, save_interval=20):
+        """按批预测多张样本的伪标签，保留下的样本写入save_path下的清单pseudo_labels.jsonl，
+        并在save_path下生成决策报告pseudo_label_report.json
 
         Args:
-            samples_root: 原始样本的路径
-            thresh: dir, {'大雁塔': 0.95, ...}
+            samples_root: 原始样本的路径，样本名称的格式为"大雁塔_xxx.jpg"
+            thresh: dir, {'大雁塔': 0.95, ...}，未给出阈值的类别不保留任何样本；使用嵌入特征索引时不使用
             save_path: 保存路径
+            batch_size: 每一批推理的样本数目
+            num_workers: 解码图片的进程数目
+            link_images: bool, 为True时将保留的样本硬链接（跨文件系统时拷贝）至save_path，
+                并按照原有格式生成类标文件，可以直接作为数据集目录使用
+            resume: bool, 为True时从save_path下的进度文件继续处理中断的任务，否则重新开始
+            save_interval: 每处理save_interval个batch保存一次清单与进度
+        Return:
+            report: dict, 决策报告，包括解码失败、各原因的拒绝数目以及各类别的保留比例
         """
-        samples_list = os.listdir(samples_root)
-        samples_list = set([sample.split('.')[0] for sample in samples_list])
-        images_name = [sample + '.jpg' for sample in samples_list]
-        predict_results = []
-        tbar = tqdm.tqdm(images_name)
-        if not os.path.exists(save_path):
+        manifest_path = os.path.join(save_path, 'pseudo_labels.jsonl')
+        state_path = os.path.join(save_path, 'pseudo_label_state.json')
+        report_path = os.path.join(save_path, 'pseudo_label_report.json')
+        images_name = sorted(image_name for image_name in os.listdir(samples_root)
+                             if image_name.lower().endswith(IMAGE_EXTENSIONS))
+
+        settings = self.__settings__(images_name, thresh)
+        state = None
+        if resume and os.path.exists(state_path):
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+            if state.get('settings') != settings:
+                print('The images, weights, thresholds or embedding index have changed, restarting.')
+                state = None
+        if state is None:
+            if os.path.exists(save_path):
+                print('Removing %s' % save_path)
+                shutil.rmtree(save_path)
             print('Making %s' % save_path)
-            os.mkdir(save_path)
+            os.makedirs(save_path)
+            state = {'settings': settings, 'next_index': 0, 'num_entries': 0,
+                     'report': self.__empty_report__()}
+            open(manifest_path, 'w').close()
         else:
-            print('Removing %s' % save_path)
-            shutil.rmtree(save_path)
-            print('Making %s' % save_path)
-            os.mkdir(save_path)
-        for image_name in tbar:
-            label = image_name.split('_')[0]
-            if label == '浆水鱼鱼':
-                label = '凉鱼'
-            elif label == '酥饺':
-                label = '蜜饯张口酥饺'
-            current_thresh = thresh[label]
-            image_path = os.path.join(samples_root, image_name)
-            index, predict_label, remain = self.predict_single_sample(label, image_path, thresh=current_thresh)
-            if remain:
-                descript = 'Remain: %s' % image_name
-                self.save_image_label(save_path, image_path, image_name, predict_label, index)
-            else:
-                descript = 'Removing: %s' % image_name
-            tbar.set_description(desc=descript)
-        return predict_results
+            print('Resuming from %d/%d images.' % (state['next_index'], len(images_name)))
+            # 丢弃上一次保存进度之后追加的样本
+            Manifest.load(manifest_path, limit=state['num_entries']).save(manifest_path)
+        report = state['report']
 
-    def predict_single_sample(self, annotation, sample_path, thresh=0.6):
-        """对单张样本进行预测
+        # 各类别的阈值，[classes_num]
+        thresh_tensor = torch.ones(self.classes_num)
+        for label, current_thresh in thresh.items():
+            if label in self.name_to_index:
+                thresh_tensor[self.name_to_index[label]] = current_thresh
+
+        dataset = DownloadImageDataset(samples_root, images_name, self.image_size, self.mean, self.std)
+        indices = list(range(state['next_index'], len(images_name)))
+        data_loader = DataLoader(Subset(dataset, indices), batch_size=batch_size, num_workers=num_workers,
+                                 pin_memory=self.device.type == 'cuda', shuffle=False)
+        entries = []
+        tbar = tqdm.tqdm(data_loader, initial=state['next_index'] // batch_size,
+                         total=(len(images_name) + batch_size - 1) // batch_size)
+        for batch_index, (indexes, images, decoded, errors) in enumerate(tbar):
+            annotations = [self.__annotation__(images_name[index]) for index in indexes.tolist()]
+            annotated = torch.tensor([self.name_to_index.get(annotation, -1) for annotation in annotations])
+            predicts, scores, accepted, reasons = self.predict_batch(images, decoded, annotated, thresh_tensor)
+
+            for index, annotation, label, error in zip(indexes.tolist(), annotations, annotated.tolist(), errors):
+                if error:
+                    report['failed_decode'][images_name[index]] = error
+                if label >= 0:
+                    report['classes'].setdefault(annotation, {'total': 0, 'accepted': 0})['total'] += 1
+            for reason, mask in reasons.items():
+                report['rejected'][reason] += int(mask.sum())
+            for i in torch.nonzero(accepted).view(-1).tolist():
+                image_name = images_name[indexes[i].item()]
+                report['classes'][annotations[i]]['accepted'] += 1
+                image_path = os.path.abspath(os.path.join(samples_root, image_name))
+                if link_images:
+                    self.save_image_label(save_path, image_path, image_name, None, predicts[i].item())
+                entries.append({'path': image_path, 'label': predicts[i].item(), 'source': 'pseudo',
+                                'score': round(scores[i].item(), 6)})
+            report['accepted'] += int(accepted.sum())
+            tbar.set_description(desc='Accepted %d/%d' % (report['accepted'], indexes[-1].item() + 1))
+
+            if (batch_index + 1) % save_interval == 0 or batch_index == len(data_loader) - 1:
+                state['next_index'] = indexes[-1].item() + 1
+                state['num_entries'] += len(entries)
+                self.__save_state__(manifest_path, entries, state_path, state)
+                entries = []
+
+        report['total'] = len(images_name)
+        for counts in report['classes'].values():
+            counts['rate'] = counts['accepted'] / counts['total']
+        with open(report_path, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print('Accepted %d/%d images, %d failed to decode, rejected: %s. Report is saved to %s.' % (
+            report['accepted'], report['total'], len(report['failed_decode']), report['rejected'], report_path))
+        return report
+
+    def predict_batch(self, images, decoded, annotated, thresh_tensor):
+        """对一批样本进行预测，并按照各类别的阈值决定是否保留
 
         Args:
-            annotation: 标注的标签
-            sample_path: 样本路径
-            rank: 返回前rank个预测结果
+            images: 图片，[batch_size, 3, H, W]
+            decoded: bool tensor, [batch_size], 图片是否解码成功
+            annotated: long tensor, [batch_size], 标注的类标，未知的类别为-1
+            thresh_tensor: float tensor, [classes_num], 各类别的阈值
         Returns:
-            index: 预测的类别标号
-            label: 真实类标，如：大雁塔
-            remain: bool, True: 保留， False: 不保留
+            predicts: long tensor, [batch_size], 预测的类标
+            scores: float tensor, [batch_size], 预测类别的得分
+            accepted: bool tensor, [batch_size], True: 保留， False: 不保留
+            reasons: dict, 各拒绝原因对应的bool tensor，每个被拒绝的样本只计入第一个原因
         """
-        try:
-            image = Image.open(sample_path).convert('RGB')
-            transforms = T.Compose([
-                T.Resize(self.image_size),
-                T.ToTensor(),
-                T.Normalize(self.mean, self.std)
-            ])
-            image = transforms(image)
-            image = torch.unsqueeze(image, dim=0).cuda()
-            output = self.model(image)
-            output = torch.squeeze(output)
-            predicts = F.softmax(output)
-            predicts_numpy = predicts.cpu().detach().numpy()
-            indexs = np.argsort(predicts_numpy)
-            index = indexs[-1]
-            predict_label = self.label_dict[str(index)]
-            score = predicts_numpy[index]
-            # 得分大于阈值且预测出的标签和标注的标签相同时保留
-            if score > thresh and predict_label.split('/')[1] == annotation:
-                remain = True
+        with torch.no_grad():
+            images = images.to(self.device, non_blocking=True)
+            if self.embedding_index is not None:
+                embeddings = self.model.get_embedding(images).float().cpu()
+                predicts, scores, below_thresh = self.embedding_index.classify(embeddings, method=self.index_method)
             else:
-                remain = False
-        except:
-            remain = False
-            index = -1
-            predict_label = -1
+                scores, predicts = F.softmax(self.model(images), dim=1).max(dim=1)
+                scores, predicts = scores.float().cpu(), predicts.cpu()
+                # 得分需要大于标注类别的阈值
+                below_thresh = scores <= thresh_tensor[annotated.clamp(min=0)]
 
-        return index, predict_label, remain
+        failed = ~decoded
+        unknown = ~failed & (annotated < 0)
+        mismatch = ~failed & ~unknown & (predicts != annotated)
+        low_score = ~failed & ~unknown & ~mismatch & below_thresh
+        # 图片解码成功，预测出的标签和标注的标签相同，且得分大于阈值（未被拒识）时保留
+        accepted = ~(failed | unknown | mismatch | low_score)
+        reasons = {'failed_decode': failed, 'unknown_annotation': unknown, 'label_mismatch': mismatch,
+                   'low_score': low_score}
+        return predicts, scores, accepted, reasons
 
     def save_image_label(self, save_path, image_path, image_name, label, index):
-        """保存图片和类别文件
+        """保存图片和类别文件，图片以硬链接的方式保存，跨文件系统时拷贝
 
         Args:
             save_path: 保存根目录
@@ -114,19 +228,70 @@ class PredictDownloadImage(object):
             label: 真实类别名称
             index: 类别索引
         """
-        label_file_name = image_name.replace('jpg', 'txt')
+        label_file_name = os.path.splitext(image_name)[0] + '.txt'
         label_file_path = os.path.join(save_path, label_file_name)
         with open(label_file_path, 'w') as f:
             line = image_name + ', ' + str(index)
             f.writelines(line)
         save_image_path = os.path.join(save_path, image_name)
-        shutil.copy(image_path, save_image_path)
+        # 中断后继续时链接可能已经存在
+        if os.path.exists(save_image_path):
+            os.remove(save_image_path)
+        try:
+            os.link(image_path, save_image_path)
+        except OSError:
+            shutil.copy(image_path, save_image_path)
+
+    def __annotation__(self, image_name):
+        """由样本名称得到标注的类别名称
+        """
+        label = image_name.split('_')[0]
+        return ANNOTATION_ALIASES.get(label, label)
+
+    def __empty_report__(self):
+        return {
+            'total': 0,
+            'accepted': 0,
+            'rejected': {'failed_decode': 0, 'unknown_annotation': 0, 'label_mismatch': 0, 'low_score': 0},
+            'failed_decode': {},
+            'classes': {}
+        }
+
+    def __settings__(self, images_name, thresh):
+        """决定伪标签结果的全部设置，与进度文件中的不同时不能继续之前的任务
+
+        Args:
+            images_name: list, 排序后的图片名称，只保存其摘要
+            thresh: dir, 各类别的阈值
+        """
+        def file_stat(path):
+            stat = os.stat(path)
+            return [path, stat.st_size, stat.st_mtime_ns]
+
+        return {
+            'images': [len(images_name), hashlib.md5('\n'.join(images_name).encode('utf-8')).hexdigest()],
+            'weight': file_stat(self.weight_path),
+            'model_type': self.model_type,
+            'image_size': list(self.image_size),
+            'thresh': dict(thresh),
+            'index': file_stat(self.index_path) if self.index_path else None,
+            'index_method': self.index_method
+        }
+
+    def __save_state__(self, manifest_path, entries, state_path, state):
+        """先追加清单再保存进度，进度文件中记录的清单样本数目不会超过清单文件中实际的数目
+        """
+        Manifest.append(manifest_path, entries)
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(state_path + '.tmp', state_path)
 
     def __prepare__(self, label_json_path):
         prepare_model = PrepareModel()
-        model = prepare_model.create_model(self.model_type, self.classes_num, 0, pretrained=False)
-        model.load_state_dict(torch.load(self.weight_path)['state_dict'])
-        model = model.cuda()
+        model = prepare_model.create_model(self.model_type, self.classes_num, 0, pretrained=False, head=self.head)
+        # 与训练时相同的加载方式，支持剪枝后的权重与EMA权重
+        model = prepare_model.load_chekpoint(model, self.weight_path)
+        model = model.to(self.device)
         model.eval()
 
         # 得到类标到真实标注的映射
@@ -164,6 +329,8 @@ if __name__ == "__main__":
     samples_root = ''
     save_path = ''
     labels_score_file = 'checkpoints/se_resnext101_32x4d/log-2019-12-17T18-24-58/classes_acc.json'
+    # 使用build_embedding_index.py得到的索引时，按照与类中心的距离拒识，不再使用softmax阈值
+    index_path = None
 
     thresh_max = 0.90
     thresh_min = 0.90
@@ -173,5 +340,6 @@ if __name__ == "__main__":
         labels_score = json.load(f)
     labels_thresh = compute_labels_thresh(labels_score, thresh_max, thresh_min)
     print(labels_thresh)
-    predict_download_images = PredictDownloadImage(config.model_type, config.num_classes, weight_path, config.image_size, label_json_path, mean=mean, std=std)
+    predict_download_images = PredictDownloadImage(config.model_type, config.num_classes, weight_path, config.image_size, label_json_path, mean=mean, std=std,
+                                                   head=config.head, index_path=index_path)
     predict_download_images.predict_multi_smaples(samples_root, thresh=labels_thresh, save_path=save_path)
\ No newline at end of file
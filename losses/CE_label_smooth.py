@@ -1,5 +1,33 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+
+def smooth_cross_entropy(log_probs, targets, epsilon):
+    """每个样本的标签平滑交叉熵，不需要构造one-hot矩阵
+
+    Equation: loss_i = -(1 - epsilon) * log_probs[i, y_i] - epsilon / N * sum_j log_probs[i, j]
+
+    Args:
+        log_probs: log_softmax之后的预测矩阵，维度为[batch_size, num_classes]，可以位于任意设备上
+        targets: 真实类标，维度为[batch_size]
+        epsilon: 平滑系数
+    Return:
+        loss: 每个样本的损失，维度为[batch_size]
+    """
+    nll = -log_probs.gather(1, targets.view(-1, 1).to(log_probs.device)).view(-1)
+    return (1 - epsilon) * nll - epsilon * log_probs.mean(dim=1)
+
+
+def hard_mining(loss, ratio):
+    """只保留损失最大的ratio比例的样本，并按照样本取均值
+
+    Args:
+        loss: 每个样本的损失，维度为[batch_size]
+        ratio: 保留的样本比例
+    """
+    selected_number = max(int(loss.size(0) * ratio), 1)
+    return loss.topk(selected_number)[0].sum() / selected_number
 
 
 class CrossEntropyLabelSmooth(nn.Module):
@@ -12,33 +40,30 @@ class CrossEntropyLabelSmooth(nn.Module):
     Args:
         num_classes (int): number of classes.
         epsilon (float): weight.
+        use_gpu (bool): unused, the loss is computed on the device of the inputs.
     """
     def __init__(self, num_classes, epsilon=0.1, use_gpu=True):
         super(CrossEntropyLabelSmooth, self).__init__()
         self.num_classes = num_classes
         self.epsilon = epsilon
         self.use_gpu = use_gpu
-        self.logsoftmax = nn.LogSoftmax(dim=1)
 
     def forward(self, inputs, targets):
         """
         Args:
             inputs: prediction matrix (before softmax) with shape (batch_size, num_classes)
-            targets: ground truth labels with shape (num_classes)
+            targets: ground truth labels with shape (batch_size)
         """
-        log_probs = self.logsoftmax(inputs)
-        '''
-        scatter_第一个参数为1表示分别对每行填充；targets.unsqueeze(1)得到的维度为[num_classes, 1]；
-        填充方法为：取出targets的第i行中的第一个元素（每行只有一个元素），记该值为j；则前面tensor中的(i,j)元素填充1；
-        最终targets的维度为[batch_size, num_classes]，每一行代表一个样本，若该样本类别为j，则只有第j元素为1，其余元素为0
-        '''
-        targets = torch.zeros(log_probs.size()).scatter_(1, targets.unsqueeze(1).data.cpu(), 1)
-        if self.use_gpu:
-            targets = targets.cuda()
-        targets = (1 - self.epsilon) * targets + self.epsilon / self.num_classes
-        # mean(0)表示缩减第0维，也就是按列求均值，得到维度为[num_classes]，得到该batch内每一个类别的损失，再求和
-        loss = (- targets * log_probs).mean(0).sum()
-        return loss
+        return self.forward_log_probs(F.log_softmax(inputs, dim=1), targets)
+
+    def forward_log_probs(self, log_probs, targets):
+        """
+        Args:
+            log_probs: log_softmax之后的预测矩阵，维度为[batch_size, num_classes]
+            targets: ground truth labels with shape (batch_size)
+        """
+        # 各个样本的损失按照样本取均值，与按照类别求均值再求和相同
+        return smooth_cross_entropy(log_probs, targets, self.epsilon).mean()
 
 
 class CrossEntropyLabelSmoothHardMining(nn.Module):
@@ -51,41 +76,52 @@ class CrossEntropyLabelSmoothHardMining(nn.Module):
     Args:
         num_classes (int): number of classes.
         epsilon (float): weight.
+        ratio (float): ratio of the hardest samples used in the loss.
+        use_gpu (bool): unused, the loss is computed on the device of the inputs.
     """
     def __init__(self, num_classes, epsilon=0.1, ratio=0.6, use_gpu=True):
         super(CrossEntropyLabelSmoothHardMining, self).__init__()
         self.num_classes = num_classes
         self.epsilon = epsilon
         self.use_gpu = use_gpu
-        self.logsoftmax = nn.LogSoftmax(dim=1)
         self.ratio = ratio
 
     def forward(self, inputs, targets):
         """
         Args:
             inputs: prediction matrix (before softmax) with shape (batch_size, num_classes)
-            targets: ground truth labels with shape (num_classes)
+            targets: ground truth labels with shape (batch_size)
         """
-        log_probs = self.logsoftmax(inputs)
-        '''
-        scatter_第一个参数为1表示分别对每行填充；targets.unsqueeze(1)得到的维度为[num_classes, 1]；
-        填充方法为：取出targets的第i行中的第一个元素（每行只有一个元素），记该值为j；则前面tensor中的(i,j)元素填充1；
-        最终targets的维度为[batch_size, num_classes]，每一行代表一个样本，若该样本类别为j，则只有第j元素为1，其余元素为0
-        '''
-        targets = torch.zeros(log_probs.size()).scatter_(1, targets.unsqueeze(1).data.cpu(), 1)
-        if self.use_gpu:
-            targets = targets.cuda()
-        targets = (1 - self.epsilon) * targets + self.epsilon / self.num_classes
-        # 先求各个样本的损失
-        loss = (- targets * log_probs).sum(1)
-        selected_number = int(inputs.size(0) * self.ratio)
-        # 按照样本取均值
-        loss = torch.sort(loss, descending=True)[0][:selected_number].sum() / selected_number
-        return loss
+        return self.forward_log_probs(F.log_softmax(inputs, dim=1), targets)
+
+    def forward_log_probs(self, log_probs, targets):
+        """
+        Args:
+            log_probs: log_softmax之后的预测矩阵，维度为[batch_size, num_classes]
+            targets: ground truth labels with shape (batch_size)
+        """
+        # 先求各个样本的损失，再只保留损失最大的一部分样本
+        return hard_mining(smooth_cross_entropy(log_probs, targets, self.epsilon), self.ratio)
 
 
 if __name__ == '__main__':
-    criterion = CrossEntropyLabelSmoothHardMining(54)
-    input = torch.Tensor(5, 54).cuda()
-    target = torch.ones(5).long()
-    loss = criterion(input, target)
+    # 与构造one-hot矩阵的原实现比较
+    def original_smooth_loss(inputs, targets, num_classes, epsilon=0.1):
+        log_probs = F.log_softmax(inputs, dim=1)
+        targets = torch.zeros(log_probs.size()).scatter_(1, targets.unsqueeze(1).data.cpu(), 1)
+        targets = (1 - epsilon) * targets + epsilon / num_classes
+        return (- targets * log_probs).mean(0).sum(), (- targets * log_probs).sum(1)
+
+    torch.manual_seed(0)
+    num_classes = 54
+    for batch_size in (2, 5, 64):
+        inputs = torch.randn(batch_size, num_classes) * 3
+        targets = torch.randint(0, num_classes, (batch_size,))
+        expected, expected_per_sample = original_smooth_loss(inputs, targets, num_classes)
+        selected_number = int(batch_size * 0.6)
+        expected_hard = torch.sort(expected_per_sample, descending=True)[0][:selected_number].sum() / selected_number
+        loss = CrossEntropyLabelSmooth(num_classes)(inputs, targets)
+        hard_loss = CrossEntropyLabelSmoothHardMining(num_classes)(inputs, targets)
+        print('batch_size %d: smooth error %.2e, hard mining error %.2e' % (
+            batch_size, (loss - expected).abs().item(), (hard_loss - expected_hard).abs().item()))
+        assert torch.allclose(loss, expected, atol=1e-5) and torch.allclose(hard_loss, expected_hard, atol=1e-5)
@@ -3,6 +3,28 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def angular_margin_logits(cosine, labels, loss_type, s, m, eps=1e-7):
+    '''
+    Replace the target logit by its margin version, the other logits are s * cos(theta).
+    Cross entropy on the result equals the Angular Penalty Softmax Loss:
+        L = numerator - log(exp(numerator) + sum_{j != y} exp(s * cos(theta_j)))
+
+    Args:
+        cosine: cos(theta), shape (N, num_classes)
+        labels: shape (N)
+        loss_type: 'arcface', 'sphereface' or 'cosface'
+    '''
+    labels = labels.view(-1, 1)
+    cos_target = cosine.gather(1, labels)
+    if loss_type == 'cosface':
+        numerator = s * (cos_target - m)
+    if loss_type == 'arcface':
+        numerator = s * torch.cos(torch.acos(torch.clamp(cos_target, -1. + eps, 1 - eps)) + m)
+    if loss_type == 'sphereface':
+        numerator = s * torch.cos(m * torch.acos(torch.clamp(cos_target, -1. + eps, 1 - eps)))
+    return (s * cosine).scatter(1, labels, numerator)
+
+
 class AngularPenaltySMLoss(nn.Module):
 
     def __init__(self, in_features, out_features, loss_type='arcface', eps=1e-7, s=None, m=None):
@@ -42,21 +64,54 @@ class AngularPenaltySMLoss(nn.Module):
         assert len(x) == len(labels)
         assert torch.min(labels) >= 0
         assert torch.max(labels) < self.out_features
-        
-        for W in self.fc.parameters():
-            W = F.normalize(W, p=2, dim=1)
-
-        x = F.normalize(x, p=2, dim=1)
-
-        wf = self.fc(x)
-        if self.loss_type == 'cosface':
-            numerator = self.s * (torch.diagonal(wf.transpose(0, 1)[labels]) - self.m)
-        if self.loss_type == 'arcface':
-            numerator = self.s * torch.cos(torch.acos(torch.clamp(torch.diagonal(wf.transpose(0, 1)[labels]), -1.+self.eps, 1-self.eps)) + self.m)
-        if self.loss_type == 'sphereface':
-            numerator = self.s * torch.cos(self.m * torch.acos(torch.clamp(torch.diagonal(wf.transpose(0, 1)[labels]), -1.+self.eps, 1-self.eps)))
-
-        excl = torch.cat([torch.cat((wf[i, :y], wf[i, y+1:])).unsqueeze(0) for i, y in enumerate(labels)], dim=0)
-        denominator = torch.exp(numerator) + torch.sum(torch.exp(self.s * excl), dim=1)
-        L = numerator - torch.log(denominator)
-        return -torch.mean(L)
+
+        logits = angular_margin_logits(self.cosine(x), labels, self.loss_type, self.s, self.m, self.eps)
+        return F.cross_entropy(logits, labels)
+
+    def cosine(self, x):
+        '''
+        cosine similarity between the normalized features and the normalized class weights, shape (N, out_features)
+        '''
+        return F.linear(F.normalize(x, p=2, dim=1), F.normalize(self.fc.weight, p=2, dim=1))
+
+    def logits(self, x):
+        '''
+        s * cos(theta) without margin, used at inference
+        '''
+        return self.s * self.cosine(x)
+
+
+class MarginCosineLoss(nn.Module):
+
+    def __init__(self, loss_type='arcface', scale=30.0, m=None, eps=1e-7):
+        '''
+        Angular Penalty Softmax Loss on the output of models.custom_model.CosineLinear.
+
+        The head outputs scale * cos(theta), the margin is only added to the target class,
+        so the logits used at inference time are the same as the head outputs.
+
+        Args:
+            loss_type: 'arcface', 'sphereface' or 'cosface'
+            scale: the same scale as the CosineLinear head
+            m: margin, default 0.5 for arcface, 1.35 for sphereface and 0.35 for cosface
+        '''
+        super(MarginCosineLoss, self).__init__()
+        loss_type = loss_type.lower()
+        assert loss_type in ['arcface', 'sphereface', 'cosface']
+        self.loss_type = loss_type
+        self.scale = scale
+        if loss_type == 'arcface':
+            self.m = 0.5 if m is None else m
+        if loss_type == 'sphereface':
+            self.m = 1.35 if m is None else m
+        if loss_type == 'cosface':
+            self.m = 0.35 if m is None else m
+        self.eps = eps
+
+    def forward(self, logits, labels):
+        '''
+        logits: scale * cos(theta), shape (N, num_classes)
+        labels: shape (N)
+        '''
+        logits = angular_margin_logits(logits / self.scale, labels, self.loss_type, self.scale, self.m, self.eps)
+        return F.cross_entropy(logits, labels.view(-1))
@@ -1,48 +1,62 @@
 import torch
-from torch import nn 
+from torch import nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 
 
 class MultiFocalLoss(nn.Module):
     """多分类focal loss
     """
     def __init__(self, gamma=0, alpha=None, size_average=True):
+        """
+        Args:
+            gamma: 调制系数
+            alpha: 各个类别的权重，float、int时为二分类的[alpha, 1-alpha]，也可以为list或者tensor
+            size_average: True时按照样本取均值，否则求和
+        """
         super(MultiFocalLoss, self).__init__()
         self.gamma = gamma
-        self.alpha = alpha
-        if isinstance(alpha, (float, int)): self.alpha = torch.Tensor([alpha, 1-alpha])
-        if isinstance(alpha, list): self.alpha = torch.Tensor(alpha)
         self.size_average = size_average
+        self.register_buffer('alpha', None)
+        self.set_alpha(alpha)
+
+    def set_alpha(self, alpha):
+        """ 设置各个类别的权重，为None时所有类别的权重相同
+        """
+        if isinstance(alpha, (float, int)):
+            alpha = [alpha, 1 - alpha]
+        self.alpha = torch.as_tensor(alpha, dtype=torch.float) if alpha is not None else None
 
     def forward(self, input, target):
         """
         Args:
-            input: 模型的输入，取softmax后，表示对应样本属于各类的概率
+            input: 模型的输出，维度为[batch_size, num_classes]或者[batch_size, num_classes, H, W]
             target: 真实类标
         """
         if input.dim() > 2:
             input = input.view(input.size(0), input.size(1), -1)  # N,C,H,W => N,C,H*W
             input = input.transpose(1, 2)    # N,C,H*W => N,H*W,C
             input = input.contiguous().view(-1, input.size(2))   # N,H*W,C => N*H*W,C
-        target = target.view(-1, 1)
+        return self.forward_log_probs(F.log_softmax(input, dim=1), target)
 
-        logpt = F.log_softmax(input)
+    def forward_log_probs(self, log_probs, target):
+        """
+        Args:
+            log_probs: log_softmax之后的预测矩阵，维度为[batch_size, num_classes]
+            target: 真实类标
+        """
+        target = target.view(-1, 1).to(log_probs.device)
         # 沿给定轴dim，将输入索引张量index指定位置的值进行聚合。即取出真实类标对应的预测概率，logpt维度为[batch]
-        logpt = logpt.gather(1, target)
-        logpt = logpt.view(-1)
-        # exp()对数据取指数，因为上面使用了log_softmax函数
-        pt = Variable(logpt.data.exp())
+        logpt = log_probs.gather(1, target).view(-1)
+        # exp()对数据取指数，因为上面使用了log_softmax函数；调制系数不参与梯度的计算
+        pt = logpt.detach().exp()
 
         if self.alpha is not None:
-            if self.alpha.type() != input.data.type():
-                self.alpha = self.alpha.type_as(input.data)
-            # 沿给定轴dim，将输入索引张量index指定位置的值进行聚合。即取出真实类标对应的alpha，at维度为[batch]
-            at = self.alpha.gather(0, target.data.view(-1))
-            logpt = logpt * Variable(at)
+            # 取出真实类标对应的alpha，at维度为[batch]
+            at = self.alpha.to(device=log_probs.device, dtype=log_probs.dtype).gather(0, target.view(-1))
+            logpt = logpt * at
 
         loss = -1 * (1-pt)**self.gamma * logpt
-        if self.size_average: 
+        if self.size_average:
             return loss.mean()
-        else: 
-            return loss.sum()
\ No newline at end of file
+        else:
+            return loss.sum()
@@ -1,16 +1,40 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from losses.CE_label_smooth import CrossEntropyLabelSmooth, CrossEntropyLabelSmoothHardMining
 from losses.focal_loss import MultiFocalLoss
+from losses.kd_loss import KnowledgeDistillationLoss
+from losses.arcface_loss import MarginCosineLoss
+
+
+# 这些损失函数都可以由同一个log_softmax的结果计算，Loss中只计算一次
+LOG_PROB_LOSSES = ['CrossEntropy', 'SmoothCrossEntropy', 'SmoothCrossEntropyHardMining', 'FocalLoss']
+
+
+def class_alpha(class_counts, power=0.5):
+    """ 依据各个类别的样本数目计算类别权重，alpha正比于count^(-power)，并归一化为均值为1
+
+    Args:
+        class_counts: list or tensor, 各个类别的样本数目
+        power: float, 为0时所有类别的权重相同，为1时与样本数目成反比
+    Return:
+        alpha: float tensor, [num_classes]
+    """
+    counts = torch.as_tensor(class_counts, dtype=torch.float).clamp(min=1)
+    alpha = counts.pow(-power)
+    return alpha * len(alpha) / alpha.sum()
 
 
 class Loss(nn.Module):
-    def __init__(self, model_name, loss_name, num_classes):
+    def __init__(self, model_name, loss_name, num_classes, kd_temperature=4.0, margin_scale=30.0, margin=None):
         """
 
         :param model_name: 模型的名称；类型为str
         :param loss_name: 损失的名称；类型为str
         :param num_classes: 网络的参数
+        :param kd_temperature: 知识蒸馏损失KD的温度；类型为float
+        :param margin_scale: ArcFace/SphereFace/CosFace损失的缩放系数，需与余弦分类层相同；类型为float
+        :param margin: ArcFace/SphereFace/CosFace损失的间隔，为None时使用默认值；类型为float
         """
         super(Loss, self).__init__()
         self.model_name = model_name
@@ -27,6 +51,10 @@ class Loss(nn.Module):
                 loss_function = CrossEntropyLabelSmoothHardMining(num_classes=num_classes)
             elif loss_type == 'FocalLoss':
                 loss_function = MultiFocalLoss(gamma=2)
+            elif loss_type == 'KD':
+                loss_function = KnowledgeDistillationLoss(temperature=kd_temperature)
+            elif loss_type in ['ArcFace', 'SphereFace', 'CosFace']:
+                loss_function = MarginCosineLoss(loss_type.lower(), scale=margin_scale, m=margin)
             else:
                 assert "loss: {} not support yet".format(self.loss_name)
 
@@ -40,40 +68,72 @@ class Loss(nn.Module):
         if len(self.loss_struct) > 1:
             self.loss_struct.append({'type': 'Total', 'weight': 0, 'function': None})
 
+        # 损失函数中没有需要并行计算的参数，不再使用DataParallel
         self.loss_module = nn.ModuleList([l['function'] for l in self.loss_struct if l['function'] is not None])
 
         # self.log的维度为[1, len(self.loss)]，前面几个分别存放某次迭代各个损失函数的损失值，最后一个存放某次迭代损失值之和
         self.log, self.log_sum = torch.zeros(len(self.loss_struct)), torch.zeros(len(self.loss_struct))
 
-        if torch.cuda.is_available():
-            self.loss_module = torch.nn.DataParallel(self.loss_module)
-            self.loss_module.cuda()
+    def set_class_counts(self, class_counts, power=0.5):
+        """ 依据各个类别的样本数目设置FocalLoss的类别权重alpha
+
+        :param class_counts: 各个类别的样本数目；类型为list或者tensor
+        :param power: alpha正比于count^(-power)；类型为float
+        """
+        alpha = class_alpha(class_counts, power)
+        for l in self.loss_struct:
+            if l['type'] == 'FocalLoss':
+                l['function'].set_alpha(alpha)
+        return alpha
 
-    def forward(self, outputs, labels):
+    def forward(self, outputs, labels, teacher_logits=None):
         """
 
         :param outputs: 网络的输出，具体维度和网络有关
         :param labels: 数据的真实类标，具体维度和网络有关
+        :param teacher_logits: 教师网络的输出，维度与outputs相同；为None时（如验证阶段）不计算KD损失
         :return loss_sum: 损失函数之和，未经过item()函数，可用于反向传播
         """
-        losses = []
+        losses, indexes = [], []
+        log_probs = None
         # 计算每一个损失函数的损失值
         for i, l in enumerate(self.loss_struct):
-            if l['type'] in ['CrossEntropy', 'SmoothCrossEntropy', 'FocalLoss', 'SmoothCrossEntropyHardMining']:
+            if l['type'] in LOG_PROB_LOSSES:
+                # 所有基于log_softmax的损失函数共用一次log_softmax
+                if log_probs is None:
+                    log_probs = F.log_softmax(outputs, dim=1)
+                if l['type'] == 'CrossEntropy':
+                    loss = F.nll_loss(log_probs, labels.to(log_probs.device))
+                else:
+                    loss = l['function'].forward_log_probs(log_probs, labels)
+
+            elif l['type'] in ['ArcFace', 'SphereFace', 'CosFace']:
+                # 在目标类别的logit上施加间隔后再计算log_softmax
                 loss = l['function'](outputs, labels)
-                effective_loss = l['weight'] * loss
-                losses.append(effective_loss)
-                self.log[i] = effective_loss.item()
-                self.log_sum[i] += self.log[i]
+
+            elif l['type'] == 'KD':
+                # 带温度的log_softmax，不能与上面的共用
+                if teacher_logits is None:
+                    self.log[i] = 0
+                    continue
+                loss = l['function'](outputs, teacher_logits)
 
             # 保留接口
             else:
-                pass
+                continue
+            losses.append(l['weight'] * loss)
+            indexes.append(i)
 
+        if not losses:
+            # 例如验证阶段只有KD损失
+            return outputs.new_zeros(())
         loss_sum = sum(losses)
+        # 各个损失值一次性拷贝到CPU，而不是每个损失函数都同步一次
+        values = torch.stack([loss.detach() for loss in losses] + [loss_sum.detach()]).float().cpu()
+        self.log[indexes] = values[:-1]
         if len(self.loss_struct) > 1:
-            self.log[-1] = loss_sum.item()
-            self.log_sum[-1] += loss_sum.item()
+            self.log[-1] = values[-1]
+        self.log_sum += self.log
 
         return loss_sum
 
@@ -111,3 +171,33 @@ class Loss(nn.Module):
         self.log_sum = torch.zeros(len(self.loss_struct))
         return ''.join(descript)
 
+    def log_state_dict(self):
+        """ 得到当前epoch中累计的损失值，用于断点续训
+
+        :return: 存放累计损失值的字典；类型为dict
+        """
+        return {'log_sum': self.log_sum.clone()}
+
+    def load_log_state_dict(self, state_dict):
+        """ 恢复由log_state_dict得到的累计损失值
+
+        :param state_dict: 存放累计损失值的字典；类型为dict
+        """
+        self.log_sum = state_dict['log_sum'].clone()
+
+
+if __name__ == '__main__':
+    # 与各个损失函数分别计算log_softmax的结果比较
+    torch.manual_seed(0)
+    num_classes = 54
+    loss_name = '1*CrossEntropy+1*SmoothCrossEntropy+0.5*FocalLoss+0.3*SmoothCrossEntropyHardMining'
+    criterion = Loss('resnet50', loss_name, num_classes)
+    criterion.set_class_counts(torch.randint(10, 200, (num_classes,)))
+    outputs = torch.randn(32, num_classes, requires_grad=True)
+    labels = torch.randint(0, num_classes, (32,))
+    loss = criterion(outputs, labels)
+    grad = torch.autograd.grad(loss, outputs)[0]
+    expected = sum(l['weight'] * l['function'](outputs, labels) for l in criterion.loss_struct if l['function'] is not None)
+    expected_grad = torch.autograd.grad(expected, outputs)[0]
+    print(criterion.record_loss_iteration())
+    print('loss error: %.2e, grad error: %.2e' % ((loss - expected).abs().item(), (grad - expected_grad).abs().max().item()))
@@ -0,0 +1,29 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class KnowledgeDistillationLoss(nn.Module):
+    """Knowledge distillation loss.
+
+    Reference:
+    Hinton et al. Distilling the Knowledge in a Neural Network. NIPS 2014 Workshop.
+    Equation: loss = T^2 * KL(softmax(teacher / T) || softmax(student / T)).
+
+    Args:
+        temperature (float): softmax temperature, the T^2 factor keeps the gradient scale independent of T.
+    """
+    def __init__(self, temperature=4.0):
+        super(KnowledgeDistillationLoss, self).__init__()
+        self.temperature = temperature
+
+    def forward(self, inputs, teacher_logits):
+        """
+        Args:
+            inputs: student prediction matrix (before softmax) with shape (batch_size, num_classes)
+            teacher_logits: teacher prediction matrix (before softmax) with shape (batch_size, num_classes)
+        """
+        log_probs = F.log_softmax(inputs / self.temperature, dim=1)
+        teacher_log_probs = F.log_softmax(teacher_logits.to(inputs.dtype) / self.temperature, dim=1)
+        loss = F.kl_div(log_probs, teacher_log_probs, reduction='batchmean', log_target=True)
+        return loss * self.temperature ** 2
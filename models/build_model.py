@@ -1,14 +1,35 @@
+import copy
 import torch
 import torch.optim as optim
 from torch.optim import lr_scheduler
 from models.custom_model import CustomModel
 from models.custom_attention_model import CustomLocalAttentionModel
-from utils.radam import RAdam
+from models.channel_pruning import apply_prune_config
+from utils.radam import RAdam, PlainRAdam, AdamW
 from utils.warmup_scheduler import GradualWarmupScheduler
-from utils.torchtools.optim import RangerLars, Ranger
+from utils.torchtools.optim import RangerLars, Ranger, Lamb, Novograd
+from utils.torchtools.optim import ForeachRAdam, ForeachPlainRAdam, ForeachAdamW, ForeachLamb, ForeachNovograd, \
+    ForeachRangerLars, ForeachRanger
 from utils.torchtools.lr_scheduler import DelayerScheduler, DelayedCosineAnnealingLR
 
 
+def get_state_dict(checkpoint, use_ema=None):
+    """从权重文件的内容中选出模型参数
+
+    Args:
+        checkpoint: dict, 权重文件的内容
+        use_ema: 是否使用EMA权重，为None时若最优模型是按照EMA权重选出的（ema_eval为True），则使用EMA权重
+    Return:
+        state_dict: 模型参数
+    """
+    if use_ema is None:
+        use_ema = checkpoint.get('ema_eval', False)
+    if use_ema and 'ema_state_dict' in checkpoint:
+        print('Using EMA weights.')
+        return checkpoint['ema_state_dict']
+    return checkpoint['state_dict']
+
+
 def convert_layers(model, layer_type_old, layer_type_new, convert_weights=False, num_groups=None):
     for name, module in reversed(model._modules.items()):
         if len(list(module.children())) > 0:
@@ -28,6 +49,154 @@ def convert_layers(model, layer_type_old, layer_type_new, convert_weights=False,
     return model
 
 
+def _replace_module(model, name, new_module):
+    parent = model
+    path = name.split('.')
+    for child_name in path[:-1]:
+        parent = getattr(parent, child_name)
+    setattr(parent, path[-1], new_module)
+
+
+def fold_batchnorm(model, input_size=(224, 224)):
+    """将紧跟在卷积层之后的BatchNorm2d层折叠进卷积层的权重与偏置中，并替换为Identity
+
+    通过一次前向传播记录每个BN层的输入由哪个卷积层产生，因此与模块的命名方式无关；只折叠能够证明安全的卷积-BN对：
+    * 卷积层的输出在进入BN层之前没有被原地修改（如ReLU(inplace=True)、x += ...），即张量的_version不变；
+    * 卷积层的输出在计算图中只有BN层一个使用者，否则残差、注意力等分支的输入会因为折叠而改变。
+    GroupNorm（convert_layers的结果）以及位于卷积层之前的BN层（如dpn、densenet中的BN-ReLU-Conv）无法折叠，保持不变。
+
+    Args:
+        model: 处于eval模式的模型，将被原地修改
+        input_size: [height, width], 记录网络结构时使用的输入大小
+    Return:
+        folded: int, 折叠的BN层数目
+        skipped: list, 无法折叠的归一化层的名称
+    """
+    names = {module: name for name, module in model.named_modules()}
+    producers, candidates, calls, handles = {}, [], {}, []
+    outputs = []
+
+    def conv_hook(module, inputs, output):
+        calls[module] = calls.get(module, 0) + 1
+        producers[id(output)] = (module, output._version, output.grad_fn)
+        # 保留输出的引用，避免其id在前向传播过程中被其他张量复用
+        outputs.append(output)
+
+    def bn_hook(module, inputs):
+        calls[module] = calls.get(module, 0) + 1
+        producer = producers.get(id(inputs[0]))
+        if producer is not None and inputs[0]._version == producer[1]:
+            candidates.append((producer[0], module, producer[2]))
+
+    for module in model.modules():
+        if isinstance(module, torch.nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, torch.nn.BatchNorm2d):
+            handles.append(module.register_forward_pre_hook(bn_hook))
+    device = next(model.parameters()).device
+    # 需要记录计算图，用于统计每个卷积层输出的使用者数目
+    inputs = torch.zeros(1, 3, input_size[0], input_size[1], device=device, requires_grad=True)
+    with torch.enable_grad():
+        result = model(inputs)
+    for handle in handles:
+        handle.remove()
+    consumers = _count_consumers(result)
+
+    pairs = [(conv, bn) for conv, bn, grad_fn in candidates if grad_fn is not None and consumers.get(grad_fn, 0) == 1]
+
+    folded_bns = set()
+    for conv, bn in pairs:
+        # 被多次调用的卷积层或BN层折叠后会改变其他位置的输出
+        if calls[conv] != 1 or calls[bn] != 1 or not bn.track_running_stats:
+            continue
+        std = torch.sqrt(bn.running_var + bn.eps)
+        scale = bn.weight / std if bn.affine else 1 / std
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        bias = (bias - bn.running_mean) * scale
+        if bn.affine:
+            bias = bias + bn.bias
+        conv.weight = torch.nn.Parameter((conv.weight * scale.view(-1, 1, 1, 1)).detach())
+        conv.bias = torch.nn.Parameter(bias.detach())
+        _replace_module(model, names[bn], torch.nn.Identity())
+        folded_bns.add(bn)
+
+    skipped = [name for module, name in names.items()
+               if isinstance(module, (torch.nn.BatchNorm2d, torch.nn.GroupNorm)) and module not in folded_bns]
+    return len(folded_bns), skipped
+
+
+def _count_consumers(outputs):
+    """从网络的输出反向遍历计算图，统计每个节点被多少个节点使用
+
+    Args:
+        outputs: tensor或者由tensor组成的tuple/list
+    Return:
+        consumers: dict, 计算图节点 -> 使用者数目
+    """
+    tensors = outputs if isinstance(outputs, (tuple, list)) else [outputs]
+    stack = [tensor.grad_fn for tensor in tensors if torch.is_tensor(tensor) and tensor.grad_fn is not None]
+    consumers, visited = {}, set(stack)
+    while stack:
+        node = stack.pop()
+        for next_node, _ in node.next_functions:
+            if next_node is None:
+                continue
+            consumers[next_node] = consumers.get(next_node, 0) + 1
+            if next_node not in visited:
+                visited.add(next_node)
+                stack.append(next_node)
+    return consumers
+
+
+def fuse_model_for_inference(model, input_size=(224, 224), jit=False, check=True, atol=1e-3):
+    """推理前的优化：折叠Conv-BN，去除推理时不起作用的Dropout；jit为True时进一步融合Conv-ReLU
+
+    分类层中的Linear-ReLU-Linear之间存在非线性激活，无法合并为一个Linear，仅去除其中的Dropout；
+    Conv-ReLU、Conv-Add-ReLU以及SpatialAttention2d中的1x1卷积与激活函数的融合由torch.jit.optimize_for_inference完成。
+
+    Args:
+        model: 加载了权重的模型，不会被修改
+        input_size: [height, width], 输入图片的大小
+        jit: bool, 是否转换为冻结的TorchScript模型，需要PyTorch 1.10及以上；转换后的模型无法再使用DataParallel
+        check: bool, 是否检查优化后的模型与原模型输出的一致性
+        atol: float, 一致性检查允许的最大绝对误差
+    Return:
+        fused_model: 优化后的模型，处于eval模式
+    """
+    model.eval()
+    fused_model = copy.deepcopy(model)
+    folded, skipped = fold_batchnorm(fused_model, input_size)
+    print('@ Folding %d BatchNorm layers into convolutions, %d normalization layers can not be folded.' % (
+        folded, len(skipped)))
+    for name, module in list(fused_model.named_modules()):
+        if isinstance(module, torch.nn.Dropout):
+            _replace_module(fused_model, name, torch.nn.Identity())
+    if jit:
+        if not hasattr(torch.jit, 'optimize_for_inference'):
+            raise RuntimeError('torch.jit.optimize_for_inference is not available in PyTorch %s.' % torch.__version__)
+        print('@ Using frozen TorchScript model.')
+        device = next(fused_model.parameters()).device
+        with torch.no_grad():
+            traced = torch.jit.trace(fused_model, torch.zeros(1, 3, input_size[0], input_size[1], device=device))
+        fused_model = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    if check:
+        error = check_fusion(model, fused_model, input_size)
+        if error > atol:
+            raise RuntimeError('Fused model differs from the original model, max error %g.' % error)
+        print('Max output error of the fused model: %g' % error)
+    return fused_model
+
+
+def check_fusion(model, fused_model, input_size=(224, 224), batch_size=2):
+    """ 返回随机输入下优化后的模型与原模型输出之间的最大绝对误差
+    """
+    device = next(model.parameters()).device
+    inputs = torch.randn(batch_size, 3, input_size[0], input_size[1], device=device)
+    model.eval()
+    with torch.no_grad():
+        return (model(inputs) - fused_model(inputs)).abs().max().item()
+
+
 class PrepareModel:
     """准备模型和优化器
     """
@@ -35,16 +204,20 @@ class PrepareModel:
     def __init__(self):
         pass
 
-    def create_model(self, model_type, classes_num, drop_rate=0, pretrained=True, bn_to_gn=False):
+    def create_model(self, model_type, classes_num, drop_rate=0, pretrained=True, bn_to_gn=False, head='linear',
+                     margin_scale=30.0):
         """创建模型
         Args:
             model_type: str, 模型类型
             classes_num: int, 类别数目
             drop_rate: float, 分类层中的drop out系数
             pretrained: bool, 是否使用预训练模型
+            head: str, 分类层的类型，linear/arcface/sphereface/cosface
+            margin_scale: float, 余弦分类层输出的缩放系数
         """
         print('Creating model: {}'.format(model_type))
-        model = CustomModel(model_type, classes_num, drop_rate=drop_rate, pretrained=pretrained)
+        model = CustomModel(model_type, classes_num, drop_rate=drop_rate, pretrained=pretrained, head=head,
+                            margin_scale=margin_scale)
         if bn_to_gn:
             convert_layers(model, torch.nn.BatchNorm2d, torch.nn.GroupNorm, True, num_groups=16)
         return model
@@ -76,43 +249,54 @@ class PrepareModel:
         """
         ignored_params = list(map(id, model.module.classifier.parameters()))
         base_params = filter(lambda p: id(p) not in ignored_params and p.requires_grad, model.module.parameters())
+        params = [
+            {'params': base_params, 'lr': 0.1 * config.lr},
+            {'params': model.module.classifier.parameters(), 'lr': config.lr}
+        ]
         print('Creating optimizer: %s' % config.optimizer)
+        multi_tensor = config.multi_tensor and config.optimizer not in ('Adam', 'SGD')
+        if multi_tensor and not next(model.parameters()).is_cuda:
+            # 与torch.optim相同，CPU上multi-tensor操作一次性分配所有中间结果，反而比逐个参数更新更慢
+            print('@ Multi-tensor optimizer only pays off on CUDA, using the per-param implementation on CPU.')
+            multi_tensor = False
+        elif multi_tensor:
+            # 使用multi-tensor实现，state与原实现相同，两者保存的权重可以互相加载
+            print('@ Using multi-tensor optimizer.')
         if config.optimizer == 'Adam':
-            optimizer = optim.Adam(
-                [
-                    {'params': base_params, 'lr': 0.1 * config.lr},
-                    {'params': model.module.classifier.parameters(), 'lr': config.lr}
-                ], weight_decay=config.weight_decay)
+            optimizer = optim.Adam(params, weight_decay=config.weight_decay)
         elif config.optimizer == 'SGD':
-            optimizer = optim.SGD(
-                [
-                    {'params': base_params, 'lr': 0.1 * config.lr},
-                    {'params': model.module.classifier.parameters(), 'lr': config.lr}
-                ], weight_decay=config.weight_decay, momentum=0.9)
+            optimizer = optim.SGD(params, weight_decay=config.weight_decay, momentum=0.9)
         elif config.optimizer == 'RAdam':
-            optimizer = RAdam(
-                [
-                    {'params': base_params, 'lr': 0.1 * config.lr},
-                    {'params': model.module.classifier.parameters(), 'lr': config.lr}                    
-                ], weight_decay=config.weight_decay
-            )
+            optimizer = (ForeachRAdam if multi_tensor else RAdam)(params, weight_decay=config.weight_decay)
+        elif config.optimizer == 'PlainRAdam':
+            optimizer = (ForeachPlainRAdam if multi_tensor else PlainRAdam)(params, weight_decay=config.weight_decay)
+        elif config.optimizer == 'AdamW':
+            optimizer = (ForeachAdamW if multi_tensor else AdamW)(params, weight_decay=config.weight_decay)
+        elif config.optimizer == 'Lamb':
+            optimizer = (ForeachLamb if multi_tensor else Lamb)(params, weight_decay=config.weight_decay)
+        elif config.optimizer == 'Novograd':
+            optimizer = (ForeachNovograd if multi_tensor else Novograd)(params, weight_decay=config.weight_decay)
         elif config.optimizer == 'RangerLars':
-            optimizer = RangerLars(
-                [
-                    {'params': base_params, 'lr': 0.1 * config.lr},
-                    {'params': model.module.classifier.parameters(), 'lr': config.lr}                    
-                ], weight_decay=config.weight_decay                
-            )
+            optimizer = (ForeachRangerLars if multi_tensor else RangerLars)(
+                params, weight_decay=config.weight_decay, **self.__lookahead_kwargs(config))
         elif config.optimizer == 'Ranger':
-            optimizer = Ranger(
-                [
-                    {'params': base_params, 'lr': 0.1 * config.lr},
-                    {'params': model.module.classifier.parameters(), 'lr': config.lr}                    
-                ], weight_decay=config.weight_decay                 
-            )
+            optimizer = (ForeachRanger if multi_tensor else Ranger)(
+                params, weight_decay=config.weight_decay, **self.__lookahead_kwargs(config))
+        else:
+            raise ValueError('Unsupported optimizer: %s' % config.optimizer)
 
         return optimizer
 
+    def __lookahead_kwargs(self, config):
+        """Lookahead相关的参数：是否展平参数，以及慢权重的数据类型"""
+        if config.lookahead_flatten:
+            print('@ Using flattened Lookahead buffers.')
+        slow_dtype = None
+        if config.lookahead_slow_dtype:
+            print('@ Keeping Lookahead slow weights in %s.' % config.lookahead_slow_dtype)
+            slow_dtype = getattr(torch, config.lookahead_slow_dtype)
+        return {'flatten': config.lookahead_flatten, 'slow_dtype': slow_dtype}
+
     def create_lr_scheduler(
             self,
             lr_scheduler_type,
@@ -163,8 +347,20 @@ class PrepareModel:
 
         return my_lr_scheduler
 
-    def load_chekpoint(self, model, weight_path):
+    def load_chekpoint(self, model, weight_path, use_ema=None):
+        """加载权重
+
+        Args:
+            model: 模型
+            weight_path: 权重路径
+            use_ema: 是否加载EMA权重，为None时若最优模型是按照EMA权重选出的，则加载EMA权重
+        Return:
+            model: 加载了权重的模型，权重经过通道剪枝时为剪枝后的模型
+        """
         print('Loading weight from %s.' % weight_path)
-        weight = torch.load(weight_path)
-        model.load_state_dict(weight['state_dict'])
+        weight = torch.load(weight_path, map_location='cpu')
+        if 'prune_config' in weight:
+            # 剪枝后的权重，先将模型裁剪为相同的结构
+            model = apply_prune_config(model, weight['prune_config'])
+        model.load_state_dict(get_state_dict(weight, use_ema))
         return model
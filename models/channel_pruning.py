@@ -0,0 +1,400 @@
+'''
+该文件的功能：根据BN层的缩放系数gamma对CustomModel的骨干网络进行通道剪枝（network slimming）
+
+稀疏训练（--sparsity）将不重要通道的gamma压向0，本文件按照|gamma|在全网络范围内排序，
+将低于阈值的通道从卷积、BN、下采样分支、SE模块与分类层中真正删除，得到更小更快的模型。
+
+支持由conv1/bn1/conv2/bn2[/conv3/bn3]组成的残差块（torchvision的ResNet/ResNeXt、pretrainedmodels的
+resnet/se_resnet/se_resnext系列），conv2可以为分组卷积。
+'''
+import copy
+import math
+import time
+from collections import OrderedDict
+
+import torch
+from torch import nn
+
+
+class ChannelChain:
+    """一组必须同时剪枝的通道
+
+    由bns中各层的|gamma|决定通道的重要性；out_modules的输出通道、in_modules的输入通道与之一一对应。
+    """
+
+    def __init__(self, name, bns, out_modules, in_modules, groups=1, next_bn=None, residual=False):
+        '''
+        Args:
+            name: str, 第一个BN层在模型中的名称，用于在重建模型时找到对应的通道组
+            bns: list, 决定通道重要性的BN层，剪枝时同时删除这些层的通道
+            out_modules: list, 输出这组通道的卷积层（与SE模块中的fc2）
+            in_modules: list, 以这组通道为输入的卷积层或全连接层
+            groups: int, 分组卷积的组数，每一组保留相同数目的通道
+            next_bn: BN层, in_modules[0]之后的BN层，用于补偿被删除通道的偏置
+            residual: bool, 是否为残差分支上的通道
+        '''
+        self.name = name
+        self.bns = bns
+        self.out_modules = out_modules
+        self.in_modules = in_modules
+        self.groups = groups
+        self.next_bn = next_bn
+        self.residual = residual
+
+    @property
+    def channels(self):
+        return self.bns[0].num_features
+
+    def importance(self):
+        ''' 每个通道的重要性：各BN层|gamma|的最大值
+        '''
+        return torch.stack([bn.weight.detach().abs().float().cpu() for bn in self.bns]).max(dim=0)[0]
+
+
+def _is_block(module):
+    return all(isinstance(getattr(module, name, None), nn.Conv2d) for name in ('conv1', 'conv2')) and \
+        all(isinstance(getattr(module, name, None), nn.BatchNorm2d) for name in ('bn1', 'bn2'))
+
+
+def _block_output(block):
+    ''' 返回残差块中最后一个卷积层与BN层
+    '''
+    if isinstance(getattr(block, 'conv3', None), nn.Conv2d):
+        return block.conv3, block.bn3
+    return block.conv2, block.bn2
+
+
+def _downsample(block):
+    downsample = getattr(block, 'downsample', None)
+    if downsample is None:
+        return None, None
+    conv, bn = downsample[0], downsample[1]
+    if not isinstance(conv, nn.Conv2d) or not isinstance(bn, nn.BatchNorm2d) or conv.groups != 1:
+        return None, None
+    return conv, bn
+
+
+def get_channel_chains(model, prune_residual=False):
+    """找到模型中所有可以剪枝的通道组
+
+    Args:
+        model: CustomModel
+        prune_residual: bool, 是否剪枝残差分支上的通道，这些通道贯穿整个stage，需要同时修改下采样分支、
+            SE模块、下一个stage的输入与分类层
+    Return:
+        chains: list, ChannelChain
+    """
+    if not hasattr(model, 'feature_layer') or model.model_name.startswith('efficientnet'):
+        raise ValueError('Channel pruning does not support model: %s' % getattr(model, 'model_name', type(model)))
+    names = {module: name for name, module in model.named_modules()}
+    stages = [stage for stage in model.feature_layer.children()
+              if isinstance(stage, nn.Sequential) and len(stage) and all(_is_block(block) for block in stage)]
+    if not stages:
+        raise ValueError('No residual blocks found in model: %s' % model.model_name)
+
+    chains = []
+    # 残差块内部的通道：conv1 -> bn1 -> conv2 [-> bn2 -> conv3]
+    for stage in stages:
+        for block in stage:
+            conv_out, _ = _block_output(block)
+            # conv2为depthwise卷积时，输入通道与输出通道一一对应，暂不支持
+            if block.conv2.in_channels // block.conv2.groups > 1:
+                chains.append(ChannelChain(names[block.bn1], [block.bn1], [block.conv1], [block.conv2],
+                                           groups=block.conv2.groups, next_bn=block.bn2))
+            if conv_out is not block.conv2 and block.conv2.out_channels // block.conv2.groups > 1:
+                chains.append(ChannelChain(names[block.bn2], [block.bn2], [block.conv2], [block.conv3],
+                                           groups=block.conv2.groups, next_bn=block.bn3))
+
+    if not prune_residual:
+        return chains
+
+    # 残差分支上的通道：同一个stage中所有块的输出与下采样分支相加，必须同时剪枝
+    chain = None
+    for stage in stages:
+        for index, block in enumerate(stage):
+            downsample_conv, downsample_bn = _downsample(block)
+            if index == 0 and downsample_conv is not None:
+                if chain is not None:
+                    chain.in_modules += [block.conv1, downsample_conv]
+                    chains.append(chain)
+                chain = ChannelChain(names[downsample_bn], [downsample_bn], [downsample_conv], [], residual=True)
+            elif chain is not None:
+                # 没有下采样分支时，当前块的输入即为上一个块的输出
+                chain.in_modules.append(block.conv1)
+            if chain is None:
+                # 第一个stage没有下采样分支时，残差通道与stem相连，不剪枝
+                continue
+            conv_out, bn_out = _block_output(block)
+            chain.bns.append(bn_out)
+            chain.out_modules.append(conv_out)
+            se_module = getattr(block, 'se_module', None)
+            if se_module is not None:
+                chain.in_modules.append(se_module.fc1)
+                chain.out_modules.append(se_module.fc2)
+    if chain is not None:
+        chain.in_modules.append(model.classifier[0])
+        chains.append(chain)
+    return chains
+
+
+def global_threshold(importances, prune_ratio):
+    """所有可剪枝通道按照重要性排序后的剪枝阈值，重要性不超过阈值的通道被剪掉
+
+    Args:
+        importances: list, 每个通道组的通道重要性
+        prune_ratio: float, 剪掉的通道占所有可剪枝通道的比例
+    Return:
+        threshold: float, 不剪枝时为-1
+    """
+    all_importance = torch.cat(importances).sort()[0]
+    prune_number = min(int(len(all_importance) * prune_ratio), len(all_importance))
+    return all_importance[prune_number - 1].item() if prune_number > 0 else -1.
+
+
+def compute_keep_indices(model, prune_ratio, prune_residual=False, min_keep_ratio=0.1):
+    """按照|gamma|在全网络范围内的排序，计算每个通道组需要保留的通道
+
+    Args:
+        model: CustomModel
+        prune_ratio: float, 剪掉的通道占所有可剪枝通道的比例
+        prune_residual: bool, 是否剪枝残差分支上的通道
+        min_keep_ratio: float, 每个通道组至少保留的通道比例，避免某一层被整层剪掉
+    Return:
+        keep_indices: OrderedDict, 通道组名称 -> 保留的通道序号
+    """
+    chains = get_channel_chains(model, prune_residual)
+    importances = [chain.importance() for chain in chains]
+    threshold = global_threshold(importances, prune_ratio)
+
+    keep_indices = OrderedDict()
+    for chain, importance in zip(chains, importances):
+        min_keep = max(int(math.ceil(chain.channels * min_keep_ratio)), chain.groups)
+        keep_number = max(int((importance > threshold).sum().item()), min_keep)
+        # 分组卷积中每一组保留相同数目的通道，在组内按照重要性选择
+        per_group = max(int(round(keep_number / chain.groups)), 1)
+        group_importance = importance.view(chain.groups, -1)
+        per_group = min(per_group, group_importance.shape[1])
+        local = group_importance.topk(per_group, dim=1)[1].sort(dim=1)[0]
+        offset = torch.arange(chain.groups).unsqueeze(1) * group_importance.shape[1]
+        keep_indices[chain.name] = (local + offset).view(-1).tolist()
+    return keep_indices
+
+
+def _slice_parameter(module, name, index, dim):
+    tensor = getattr(module, name)
+    if tensor is None:
+        return
+    sliced = tensor.detach().index_select(dim, index.to(tensor.device)).clone()
+    if isinstance(tensor, nn.Parameter):
+        setattr(module, name, nn.Parameter(sliced, requires_grad=tensor.requires_grad))
+    else:
+        setattr(module, name, sliced)
+
+
+def _prune_bn(bn, index):
+    for name in ('weight', 'bias', 'running_mean', 'running_var'):
+        _slice_parameter(bn, name, index, 0)
+    bn.num_features = len(index)
+
+
+def _prune_output(module, index):
+    _slice_parameter(module, 'weight', index, 0)
+    _slice_parameter(module, 'bias', index, 0)
+    if isinstance(module, nn.Linear):
+        module.out_features = len(index)
+    else:
+        module.out_channels = len(index)
+
+
+def _prune_input(module, index):
+    if isinstance(module, nn.Linear):
+        _slice_parameter(module, 'weight', index, 1)
+        module.in_features = len(index)
+        return
+    groups = module.groups
+    if groups == 1:
+        _slice_parameter(module, 'weight', index, 1)
+    else:
+        # 分组卷积：weight的第二维为组内的输入通道，每一组分别选择
+        in_per_group = module.in_channels // groups
+        local = index.view(groups, -1) - torch.arange(groups).unsqueeze(1) * in_per_group
+        weight = module.weight.detach()
+        out_per_group = weight.shape[0] // groups
+        weight = weight.view(groups, out_per_group, in_per_group, *weight.shape[2:])
+        gather_index = local.to(weight.device).view(groups, 1, -1, 1, 1).expand(
+            -1, out_per_group, -1, *weight.shape[3:])
+        weight = weight.gather(2, gather_index).reshape(groups * out_per_group, -1, *weight.shape[3:])
+        module.weight = nn.Parameter(weight.clone(), requires_grad=module.weight.requires_grad)
+    module.in_channels = len(index)
+
+
+def _compensate(chain, removed):
+    ''' 被删除的通道gamma接近0，经过BN与ReLU后近似为常数relu(beta)，将其对下一层卷积输出的贡献
+    合并到下一层BN的running_mean中
+    '''
+    bn = chain.bns[0]
+    conv = chain.in_modules[0]
+    constant = torch.relu(bn.bias.detach()[removed])
+    weight = conv.weight.detach().sum(dim=(2, 3))
+    groups = conv.groups
+    in_per_group = conv.in_channels // groups
+    out_per_group = conv.out_channels // groups
+    delta = torch.zeros(conv.out_channels, dtype=weight.dtype, device=weight.device)
+    for channel, value in zip(removed.tolist(), constant.tolist()):
+        group = channel // in_per_group
+        outputs = slice(group * out_per_group, (group + 1) * out_per_group)
+        delta[outputs] += weight[outputs, channel - group * in_per_group] * value
+    chain.next_bn.running_mean.sub_(delta.to(chain.next_bn.running_mean.dtype))
+
+
+@torch.no_grad()
+def prune_model(model, keep_indices, prune_residual=False, compensate=True):
+    """按照keep_indices原地删除模型中的通道
+
+    Args:
+        model: CustomModel
+        keep_indices: dict, 由compute_keep_indices得到，或者从剪枝后的权重文件中读取
+        prune_residual: bool, 与compute_keep_indices中的取值相同
+        compensate: bool, 是否将被删除通道的偏置补偿到下一层BN中，仅对残差块内部的通道有效；
+            重建模型后会加载剪枝后的权重，此时不需要补偿
+    Return:
+        model: 剪枝后的模型，model.prune_config中记录了重建模型所需的信息
+    """
+    # 对已经剪枝过的模型再次剪枝时，将通道序号换算为相对于原始模型的序号，重建时只需裁剪一次
+    previous = getattr(model, 'prune_config', None)
+    original_indices = {}
+    if previous is not None:
+        prune_residual = prune_residual or previous['prune_residual']
+        original_indices = dict(previous['keep_indices'])
+    for name, indices in keep_indices.items():
+        if name in original_indices:
+            original_indices[name] = [original_indices[name][i] for i in indices]
+        else:
+            original_indices[name] = list(indices)
+
+    for chain in get_channel_chains(model, prune_residual):
+        if chain.name not in keep_indices:
+            continue
+        index = torch.tensor(keep_indices[chain.name], dtype=torch.long)
+        if len(index) == chain.channels:
+            continue
+        if compensate and chain.next_bn is not None:
+            mask = torch.ones(chain.channels, dtype=torch.bool)
+            mask[index] = False
+            _compensate(chain, mask.nonzero().view(-1))
+        for bn in chain.bns:
+            _prune_bn(bn, index)
+        for module in chain.out_modules:
+            _prune_output(module, index)
+        for module in chain.in_modules:
+            _prune_input(module, index)
+    model.prune_config = {
+        'model_type': model.model_name,
+        'prune_residual': prune_residual,
+        'keep_indices': original_indices
+    }
+    return model
+
+
+def apply_prune_config(model, prune_config):
+    """根据权重文件中保存的prune_config将新建的模型裁剪为相同的结构，之后即可加载剪枝后的权重
+
+    Args:
+        model: 与剪枝前结构相同的CustomModel
+        prune_config: dict, prune_model生成的model.prune_config
+    Return:
+        model: 结构与剪枝后的模型相同的模型
+    """
+    current = getattr(model, 'prune_config', None)
+    if current == prune_config:
+        return model
+    if current is not None:
+        raise ValueError('The model has been pruned with a different config.')
+    print('Applying channel pruning config.')
+    return prune_model(model, prune_config['keep_indices'], prune_config['prune_residual'], compensate=False)
+
+
+def count_flops(model, input_size):
+    """统计卷积层与全连接层的乘加次数
+
+    Args:
+        model: 模型
+        input_size: list, [height, width]
+    Return:
+        flops: int, 单张图片的乘加次数
+        params: int, 参数数目
+    """
+    flops = []
+
+    def conv_hook(module, inputs, output):
+        kernel = module.weight.shape[1] * module.weight.shape[2] * module.weight.shape[3]
+        flops.append(output.numel() // output.shape[0] * kernel)
+
+    def linear_hook(module, inputs, output):
+        flops.append(module.in_features * module.out_features)
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+    device = next(model.parameters()).device
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(torch.zeros(1, 3, *input_size, device=device))
+    model.train(training)
+    for handle in handles:
+        handle.remove()
+    return sum(flops), sum(p.numel() for p in model.parameters())
+
+
+def measure_latency(model, input_size, batch_size=1, repeat=10, warmup=2):
+    """在CPU上测量前向传播耗时的中位数（毫秒）
+
+    Args:
+        model: 模型
+        input_size: list, [height, width]
+        batch_size: int, batch大小
+        repeat: int, 重复次数
+        warmup: int, 预热次数
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    inputs = torch.randn(batch_size, 3, *input_size)
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeat):
+            start = time.perf_counter()
+            model(inputs)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1000
+
+
+if __name__ == '__main__':
+    from models.custom_model import CustomModel
+
+    model = CustomModel('se_resnext50_32x4d', num_classes=54, pretrained=False).eval()
+    # 模拟稀疏训练之后的gamma分布
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.weight.data.uniform_(0, 1).pow_(4)
+            module.running_mean.data.normal_(0, 0.1)
+    inputs = torch.randn(2, 3, 224, 224)
+    for prune_residual in (False, True):
+        pruned = copy.deepcopy(model)
+        keep_indices = compute_keep_indices(pruned, 0.3, prune_residual=prune_residual)
+        prune_model(pruned, keep_indices, prune_residual=prune_residual)
+        flops, params = count_flops(model, [224, 224])
+        pruned_flops, pruned_params = count_flops(pruned, [224, 224])
+        with torch.no_grad():
+            error = (model(inputs) - pruned(inputs)).abs().max().item()
+        # 按照prune_config重建模型并加载剪枝后的权重，结果必须与剪枝后的模型完全相同
+        rebuilt = apply_prune_config(CustomModel('se_resnext50_32x4d', num_classes=54, pretrained=False),
+                                     pruned.prune_config).eval()
+        rebuilt.load_state_dict(pruned.state_dict())
+        with torch.no_grad():
+            rebuild_error = (rebuilt(inputs) - pruned(inputs)).abs().max().item()
+        print('prune_residual: %s, GFLOPs: %.2f -> %.2f, params: %.1fM -> %.1fM, output error: %.4f, rebuild error: %g' % (
+            prune_residual, flops / 1e9, pruned_flops / 1e9, params / 1e6, pruned_params / 1e6, error, rebuild_error))
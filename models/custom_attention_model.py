@@ -47,8 +47,8 @@ class WeightedSum2d(nn.Module):
             'err: h, w of tensors x({}) and weights({}) must be the same.' \
                 .format(x.size, weights.size)
         y = x * weights  # element-wise multiplication
-        y = y.view(-1, x.size(1), x.size(2) * x.size(3))  # b x c x hw
-        return torch.sum(y, dim=2).view(-1, x.size(1), 1, 1)  # b x c x 1 x 1
+        # sum over h, w directly instead of view(b, c, hw), which also works for channels_last tensors
+        return torch.sum(y, dim=(2, 3), keepdim=True)  # b x c x 1 x 1
 
     def __repr__(self):
         return self.__class__.__name__
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 from PIL import Image
 import torch
 import torch.nn.functional as F
@@ -9,7 +10,9 @@ from metric.metrics_manager import MetricsManager
 import log
 logger = log.getLogger(__name__)
 
-from model.deploy_models.build_model import PrepareModel
+from model.deploy_models.build_model import PrepareModel, fuse_model_for_inference
+from model.deploy_models.embedding_index import EmbeddingIndex
+from model.deploy_models.profiling import PhaseTimer, format_summary
 
 
 class ImageClassificationService(PTServingBaseService):
@@ -24,6 +27,16 @@ class ImageClassificationService(PTServingBaseService):
         self.classes_num = 54
 
         self.use_cuda = False
+        # 分类层的类型，linear/arcface/sphereface/cosface
+        self.head = 'linear'
+        # 权重所在目录下存在build_embedding_index.py得到的索引时，按照最近的类中心分类
+        self.embedding_index = None
+        # CPU上使用channels_last内存格式，oneDNN的卷积更快；需要PyTorch 1.5及以上
+        self.channels_last = not torch.cuda.is_available() and hasattr(torch, 'channels_last')
+        # 每处理[]个请求在日志中输出一次各阶段（解码、变换、拷贝、前向传播、后处理）的平均耗时，0时不统计
+        self.profile_interval = 0
+        self.timer = PhaseTimer(enabled=self.profile_interval > 0)
+        self.requests_number = 0
         self.label_id_name_dict = \
             {
                 "0": "工艺品/仿唐三彩",
@@ -132,16 +145,29 @@ class ImageClassificationService(PTServingBaseService):
         post_time_in_ms = (time.time() - infer_end_time) * 1000
         logger.info('postprocess time: ' + str(post_time_in_ms) + 'ms')
         if self.model_name + '_LatencyInference' in MetricsManager.metrics:
-            MetricsManager.metrics[self.model_name + '_LatencyInference'].update(post_time_in_ms)
+            MetricsManager.metrics[self.model_name + '_LatencyInference'].update(infer_in_ms)
 
         # Update overall latency metric
         if self.model_name + '_LatencyOverall' in MetricsManager.metrics:
-            MetricsManager.metrics[self.model_name + '_LatencyOverall'].update(pre_time_in_ms + post_time_in_ms)
+            MetricsManager.metrics[self.model_name + '_LatencyOverall'].update(pre_time_in_ms + infer_in_ms + post_time_in_ms)
 
         logger.info('latency: ' + str(pre_time_in_ms + infer_in_ms + post_time_in_ms) + 'ms')
         data['latency_time'] = pre_time_in_ms + infer_in_ms + post_time_in_ms
+        self.report_phases()
         return data
 
+    def report_phases(self):
+        """每处理profile_interval个请求，在日志中输出一次各阶段的平均耗时
+        """
+        if not self.timer.enabled:
+            return
+        with self.timer.lock:
+            self.requests_number += 1
+            report = self.requests_number % self.profile_interval == 0
+        if report:
+            logger.info('phase time of the last %d requests: %s' % (
+                self.profile_interval, format_summary(self.timer.flush())))
+
     def _inference(self, data):
         """实际推理请求方法
         """
@@ -149,17 +175,35 @@ class ImageClassificationService(PTServingBaseService):
 
         # 对单张样本得到预测结果
         img = data["input_img"]
+        self.timer.mark()
         img = img.unsqueeze(0)
+        if self.channels_last:
+            img = img.contiguous(memory_format=torch.channels_last)
         if self.use_cuda:
             img = img.cuda()
+        self.timer.lap('h2d')
         with torch.no_grad():
+            if self.embedding_index is not None:
+                model = self.model.module if isinstance(self.model, torch.nn.DataParallel) else self.model
+                embeddings = model.get_embedding(img).cpu()
+                self.timer.lap('forward')
+                predicts, _, rejected = self.embedding_index.classify(embeddings)
+                if rejected[0].item():
+                    logger.info('Far from all the class centroids')
+                pred_label = predicts[0].item()
+                result = {'result': self.label_id_name_dict[str(pred_label)]}
+                self.timer.lap('postprocess')
+                logger.info(result['result'])
+                return result
             pred_score = self.model(img)
+            self.timer.lap('forward')
             pred_score = F.softmax(pred_score.data, dim=1)
             if pred_score is not None:
                 pred_label = torch.argsort(pred_score[0], descending=True)[:1][0].item()
                 result = {'result': self.label_id_name_dict[str(pred_label)]}
             else:
                 result = {'result': 'predict score is None'}
+            self.timer.lap('postprocess')
         logger.info('result:' + str(pred_label))
         return result
 
@@ -167,18 +211,27 @@ class ImageClassificationService(PTServingBaseService):
         """准备模型
         """
         prepare_model = PrepareModel()
-        model = prepare_model.create_model('se_resnext101_32x4d', self.classes_num, drop_rate=0, pretrained=False)
-
+        model = prepare_model.create_model('se_resnext101_32x4d', self.classes_num, drop_rate=0, pretrained=False,
+                                           head=self.head)
+
+        # 权重文件中含有EMA权重且最优模型是按照EMA权重选出时，直接加载EMA权重
+        model = prepare_model.load_chekpoint(model, self.model_path)
+        # 折叠BN层等推理优化，并检查与原模型输出的一致性
+        model = fuse_model_for_inference(model, input_size=[416, 416])
+        logger.info('Using fused model for inference')
+        if self.channels_last:
+            logger.info('Using channels_last memory format')
+            model = model.to(memory_format=torch.channels_last)
+        index_path = os.path.join(os.path.dirname(self.model_path), 'embedding_index.npz')
+        if os.path.exists(index_path):
+            logger.info('Using embedding index for inference')
+            self.embedding_index = EmbeddingIndex.load(index_path)
         if torch.cuda.is_available():
             logger.info('Using GPU for inference')
             self.use_cuda = True
-            checkpoint = torch.load(self.model_path)
-            model.load_state_dict(checkpoint['state_dict'])
             model = torch.nn.DataParallel(model).cuda()
         else:
             logger.info('Using CPU for inference')
-            checkpoint = torch.load(self.model_path, map_location='cpu')
-            model.load_state_dict(checkpoint['state_dict'])
 
         return model
 
@@ -188,8 +241,11 @@ class ImageClassificationService(PTServingBaseService):
         preprocessed_data = {}
         for k, v in data.items():
             for _, file_content in v.items():
-                img = Image.open(file_content)
-                img = self.transforms(img)
+                with self.timer.phase('decode'):
+                    img = Image.open(file_content)
+                    img.load()
+                with self.timer.phase('transform'):
+                    img = self.transforms(img)
                 preprocessed_data[k] = img
         return preprocessed_data
 
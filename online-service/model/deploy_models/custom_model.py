@@ -6,18 +6,39 @@ from efficientnet_pytorch import EfficientNet
 import model.deploy_models.resnext as resnext
 
 
+class CosineLinear(nn.Module):
+    """输出特征与各类别权重之间的余弦相似度乘以scale，用于ArcFace/SphereFace/CosFace等在余弦相似度上施加间隔的损失函数
+    """
+    def __init__(self, in_features, out_features, scale=30.0):
+        super(CosineLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.scale = scale
+        self.weight = nn.Parameter(torch.empty(out_features, in_features))
+        nn.init.xavier_uniform_(self.weight)
+
+    def forward(self, x):
+        return self.scale * F.linear(F.normalize(x, p=2, dim=1), F.normalize(self.weight, p=2, dim=1))
+
+    def extra_repr(self):
+        return 'in_features={}, out_features={}, scale={}'.format(self.in_features, self.out_features, self.scale)
+
+
 class CustomModel(nn.Module):
-    def __init__(self, model_name, num_classes, drop_rate=0, pretrained=True):
+    def __init__(self, model_name, num_classes, drop_rate=0, pretrained=True, head='linear', margin_scale=30.0):
         """
         Args:
             model_name: model_name: resnet模型的名称；类型为str
             num_classes: num_classes: 类别数目；类型为int
             drop_rate: float, 分类层中的drop out系数
             pretrained: bool, 是否使用预训练权重
+            head: str, 分类层的类型，linear: 全连接层；arcface/sphereface/cosface: 余弦分类层，需配合对应的损失使用
+            margin_scale: float, 余弦分类层输出的缩放系数
         """
         super(CustomModel, self).__init__()
         self.model_name = model_name
         self.num_classes = num_classes
+        self.head = head
 
         if self.model_name.startswith('efficientnet'):
             if pretrained:
@@ -52,10 +73,19 @@ class CustomModel(nn.Module):
 
         self.pool = nn.AdaptiveAvgPool2d(output_size=(1, 1))
 
-        add_block = [nn.Linear(in_features, 1024), nn.ReLU()]
-        if drop_rate > 0:
-            add_block += [nn.Dropout(p=drop_rate)]
-        add_block += [nn.Linear(1024, self.num_classes)]
+        if self.head == 'linear':
+            add_block = [nn.Linear(in_features, 1024), nn.ReLU()]
+            if drop_rate > 0:
+                add_block += [nn.Dropout(p=drop_rate)]
+            add_block += [nn.Linear(1024, self.num_classes)]
+        elif self.head in ['arcface', 'sphereface', 'cosface']:
+            # 余弦分类层的输入即为嵌入特征，不经过ReLU，以免特征只分布在第一象限
+            add_block = [nn.Linear(in_features, 1024), nn.BatchNorm1d(1024)]
+            if drop_rate > 0:
+                add_block += [nn.Dropout(p=drop_rate)]
+            add_block += [CosineLinear(1024, self.num_classes, scale=margin_scale)]
+        else:
+            raise ValueError('Unsupported head: %s' % self.head)
         self.classifier = nn.Sequential(*add_block)
 
     def forward(self, x):
@@ -66,16 +96,38 @@ class CustomModel(nn.Module):
 
         Returns: 网络预测的类别；类型为tensor；维度为[batch_size, num_classes]
         """
+        scores = self.classifier(self.get_pooled_features(x))
+        return scores
+
+    def get_pooled_features(self, x):
+        """
+
+        Args:
+            x: 网络的输入；类型为tensor；维度为[batch_size, channel, height, width]
+
+        Returns: 经过全局平均池化的特征；类型为tensor；维度为[batch_size, in_features]
+        """
         # 特征提取部分
         if self.model_name.startswith('efficientnet'):
             global_features = self.feature_layer.extract_features(x)
         else:
             global_features = self.feature_layer(x)
-        # 经过全局平均池化与线性分类层
+        # 经过全局平均池化
         global_features = self.pool(global_features)
-        global_features = global_features.view(global_features.shape[0], -1)
-        scores = self.classifier(global_features)
-        return scores
+        return global_features.view(global_features.shape[0], -1)
+
+    def get_embedding(self, x):
+        """ 用于最近邻分类的L2归一化嵌入特征：全连接分类层时为池化后的特征，余弦分类层时为其输入
+
+        Args:
+            x: 网络的输入；类型为tensor；维度为[batch_size, channel, height, width]
+
+        Returns: 嵌入特征；类型为tensor；维度为[batch_size, embedding_size]
+        """
+        features = self.get_pooled_features(x)
+        if self.head != 'linear':
+            features = self.classifier[:-1](features)
+        return F.normalize(features, p=2, dim=1)
 
     def get_classify_result(self, outputs, labels, device):
         """
@@ -0,0 +1,219 @@
+'''
+该文件的功能：按阶段统计训练与推理的耗时，找出性能瓶颈
+
+* PhaseTimer: 累计各个阶段（读取数据、拷贝到GPU、前向传播、计算损失、反向传播、优化器更新、记录日志、验证、保存权重等）的耗时，
+  周期性地将每个阶段的平均耗时与占总时间的比例写入tensorboard；未启用时phase返回空的上下文，几乎没有开销；
+* create_trace_profiler: 在给定的迭代区间内使用torch.profiler记录算子级别的trace，结果可以在tensorboard的PyTorch Profiler页面查看。
+
+部署时推理服务使用online-service/model/deploy_models下的同名文件，两者的内容应保持一致。
+'''
+import collections
+import contextlib
+import threading
+import time
+
+import torch
+
+
+class _NullContext(object):
+    """不做任何事情的上下文，部署的运行时为Python 3.6，没有contextlib.nullcontext
+    """
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_CONTEXT = _NullContext()
+
+
+class PhaseTimer(object):
+    """按阶段累计耗时，可以在多个线程中同时使用
+
+    阶段可以嵌套，嵌套阶段的名称为"外层/内层"，例如验证时的前向传播记为"validation/forward"；
+    只有最外层的阶段参与计算other（未计时部分）的耗时。
+    """
+    def __init__(self, enabled=False, cuda_sync=False):
+        """
+        Args:
+            enabled: bool, 是否统计耗时
+            cuda_sync: bool, 在阶段的开始与结束时同步CUDA，使异步执行的kernel的耗时计入发起它的阶段，
+                否则这部分耗时会计入之后第一个需要同步的阶段（如.item()所在的阶段）
+        """
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        # 为True时同时使用record_function标注阶段，阶段会显示在torch.profiler的trace中
+        self.record_function = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.totals = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.window_start = time.perf_counter()
+
+    def phase(self, name):
+        """统计with语句中代码的耗时
+
+        Args:
+            name: str, 阶段的名称
+        """
+        if not self.enabled:
+            return NULL_CONTEXT
+        return self._phase(name)
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        stack = self._stack()
+        stack.append(name)
+        full_name = '/'.join(stack)
+        record = torch.autograd.profiler.record_function(full_name) if self.record_function else NULL_CONTEXT
+        self._sync()
+        start = time.perf_counter()
+        try:
+            with record:
+                yield
+        finally:
+            self._sync()
+            self.add(full_name, time.perf_counter() - start)
+            stack.pop()
+
+    def mark(self):
+        """记录当前时刻，与lap配合统计两个时刻之间的耗时，例如等待DataLoader返回下一个batch的时间
+        """
+        if self.enabled:
+            self._sync()
+            self.local.last = time.perf_counter()
+
+    def lap(self, name):
+        """将上一次mark或lap到现在的耗时计入name
+        """
+        if not self.enabled:
+            return
+        self._sync()
+        now = time.perf_counter()
+        last = getattr(self.local, 'last', None)
+        if last is not None:
+            self.add(name, now - last)
+        self.local.last = now
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0.) + seconds
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def flush(self):
+        """返回上一次flush以来的统计结果，并清空统计
+
+        Return:
+            summary: dict, {'wall': 经过的时间(s), 'phases': {阶段: {'count', 'mean_ms', 'share'}}}，
+                share为阶段的总耗时占经过时间的比例，多线程并发时各阶段的比例之和可以大于1
+        """
+        with self.lock:
+            now = time.perf_counter()
+            wall = max(now - self.window_start, 1e-9)
+            totals, counts = self.totals, self.counts
+            self.totals, self.counts = collections.OrderedDict(), collections.OrderedDict()
+            self.window_start = now
+        phases = collections.OrderedDict()
+        for name, total in totals.items():
+            phases[name] = {'count': counts[name], 'mean_ms': total / counts[name] * 1000, 'share': total / wall}
+        if phases:
+            # 未计时部分按照最外层阶段中最大的次数（通常为迭代次数）平均
+            other = max(wall - sum(total for name, total in totals.items() if '/' not in name), 0.)
+            count = max(count for name, count in counts.items() if '/' not in name)
+            phases['other'] = {'count': count, 'mean_ms': other / count * 1000, 'share': other / wall}
+        return {'wall': wall, 'phases': phases}
+
+    def write(self, add_scalar, step, prefix='Profile'):
+        """将上一次flush以来各阶段的平均耗时（ms）与占总时间的比例写入tensorboard
+
+        Args:
+            add_scalar: SummaryWriter.add_scalar
+            step: 横坐标
+            prefix: tensorboard中的标签前缀
+        Return:
+            summary: flush的结果
+        """
+        summary = self.flush()
+        for name, phase in summary['phases'].items():
+            add_scalar('%sMs/%s' % (prefix, name), phase['mean_ms'], step)
+            add_scalar('%sShare/%s' % (prefix, name), phase['share'], step)
+        return summary
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _sync(self):
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+
+
+def merge_summaries(summaries):
+    """合并多次flush的结果，例如将一个epoch中周期性写入tensorboard的结果合并为整个epoch的结果
+    """
+    wall = sum(summary['wall'] for summary in summaries)
+    totals, counts = collections.OrderedDict(), collections.OrderedDict()
+    for summary in summaries:
+        for name, phase in summary['phases'].items():
+            totals[name] = totals.get(name, 0.) + phase['mean_ms'] * phase['count']
+            counts[name] = counts.get(name, 0) + phase['count']
+    phases = collections.OrderedDict()
+    for name, total in totals.items():
+        phases[name] = {'count': counts[name], 'mean_ms': total / counts[name], 'share': total / 1000 / wall}
+    return {'wall': wall, 'phases': phases}
+
+
+def format_summary(summary):
+    """将PhaseTimer.flush的结果中最外层的阶段按照耗时比例从大到小排列为一行文字
+    """
+    phases = [(name, phase) for name, phase in summary['phases'].items() if '/' not in name]
+    phases.sort(key=lambda item: item[1]['share'], reverse=True)
+    return ', '.join('%s: %.1fms (%.1f%%)' % (name, phase['mean_ms'], phase['share'] * 100) for name, phase in phases)
+
+
+def create_trace_profiler(log_dir, wait, steps):
+    """创建torch.profiler，跳过wait次迭代与1次预热迭代后记录steps次迭代的trace
+
+    每次迭代结束时调用step()，训练结束时调用stop()。
+
+    Args:
+        log_dir: trace的保存目录，使用tensorboard --logdir打开
+        wait: int, 开始记录前跳过的迭代次数，跳过的迭代中包含DataLoader启动等一次性的开销
+        steps: int, 记录的迭代次数
+    Return:
+        torch.profiler.profile, 已经开始
+    """
+    from torch.profiler import profile, schedule, tensorboard_trace_handler, ProfilerActivity
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    profiler = profile(
+        activities=activities,
+        schedule=schedule(wait=wait, warmup=1, active=steps, repeat=1),
+        on_trace_ready=tensorboard_trace_handler(log_dir),
+        record_shapes=True,
+        profile_memory=True
+    )
+    profiler.start()
+    return profiler
+
+
+if __name__ == '__main__':
+    timer = PhaseTimer(enabled=True)
+    timer.mark()
+    for _ in range(20):
+        time.sleep(0.002)
+        timer.lap('data')
+        with timer.phase('forward'):
+            time.sleep(0.003)
+        with timer.phase('validation'):
+            with timer.phase('forward'):
+                time.sleep(0.001)
+        timer.mark()
+    summary = timer.flush()
+    print(format_summary(summary))
+    for name, phase in summary['phases'].items():
+        print('%-20s %6d %10.2f ms %8.1f%%' % (name, phase['count'], phase['mean_ms'], phase['share'] * 100))
@@ -0,0 +1,128 @@
+'''
+该文件的功能：对稀疏训练得到的模型进行通道剪枝与微调，并比较剪枝前后的计算量、参数量、CPU耗时与准确率
+
+用法：python prune_classifier.py --weight_path checkpoints/se_resnext101_32x4d/log-xxx/model_best.pth \
+         --prune_ratio 0.3 --prune_epoch 10
+剪枝后的权重中保存了prune_config，PrepareModel.load_chekpoint会据此重建模型，可以直接用于部署
+'''
+import copy
+import os
+import torch
+import tqdm
+
+from config import get_classify_config
+from models.build_model import PrepareModel
+from models.channel_pruning import compute_keep_indices, prune_model, count_flops, measure_latency
+from datasets.create_dataset import GetDataloader
+from datasets.data_augmentation import DataAugmentation
+from train_classifier import TrainVal, load_resume_file, check_resume_folds
+
+
+def evaluate(model, valid_loader, device):
+    """ 计算模型在验证集上的准确率（OA）
+    """
+    model.eval()
+    corrects, total = 0, 0
+    with torch.no_grad():
+        for _, images, labels in tqdm.tqdm(valid_loader, desc='Evaluating'):
+            predicts = model(images.to(device)).argmax(dim=1).cpu()
+            corrects += (predicts == labels).sum().item()
+            total += len(labels)
+    return corrects / total
+
+
+def report(model, valid_loader, device, image_size):
+    """ 返回模型的准确率、乘加次数、参数数目与CPU上单张图片的推理耗时
+    """
+    flops, params = count_flops(model, image_size)
+    return {
+        'OA': evaluate(model, valid_loader, device),
+        'GFLOPs': flops / 1e9,
+        'Params(M)': params / 1e6,
+        'CPU latency(ms)': measure_latency(model, image_size)
+    }
+
+
+def print_report(reports):
+    names = list(reports.keys())
+    print('%-18s' % '' + ''.join('%16s' % name for name in names))
+    for key in reports[names[0]]:
+        print('%-18s' % key + ''.join('%16.4f' % reports[name][key] for name in names))
+
+
+if __name__ == '__main__':
+    config = get_classify_config()
+    if not config.weight_path:
+        raise ValueError('You must specified weight_path of the sparsity trained model.')
+    mean = (0.485, 0.456, 0.406)
+    std = (0.229, 0.224, 0.225)
+    transforms = DataAugmentation(config.erase_prob, full_aug=True, gray_prob=config.gray_prob) \
+        if config.augmentation_flag else None
+    get_dataloader = GetDataloader(
+        config.dataset_root,
+        folds_split=config.n_splits,
+        test_size=config.val_size,
+        only_self=config.only_self,
+        only_official=config.only_official,
+        selected_labels=config.selected_labels,
+        val_official=config.val_official,
+        load_split_from_file=config.load_split_from_file,
+        auto_aug=config.auto_aug,
+        manifest_path=config.manifest
+    )
+    train_dataloaders, val_dataloaders = get_dataloader.get_dataloader(
+        config.batch_size, config.image_size, mean, std, transforms=transforms,
+        multi_scale=config.multi_scale and not config.progressive_resize, val_multi_scale=config.val_multi_scale)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    weight_path = config.weight_path
+    resume_state = None
+    if config.resume:
+        resume_state = load_resume_file(config.resume)
+        check_resume_folds(resume_state, config.selected_fold)
+    for fold_index, [train_loader, valid_loader] in enumerate(zip(train_dataloaders, val_dataloaders)):
+        if fold_index not in config.selected_fold:
+            continue
+        if resume_state is not None and resume_state['fold'] is not None and fold_index < resume_state['fold']:
+            print('@ Skipping fold %d, which is finished before the resume checkpoint.' % fold_index)
+            continue
+        prepare_model = PrepareModel()
+        model = prepare_model.create_model(config.model_type, config.num_classes, drop_rate=config.drop_rate, pretrained=False,
+                                           head=config.head, margin_scale=config.margin_scale)
+        model = prepare_model.load_chekpoint(model, weight_path).to(device)
+        reports = {'original': report(model, valid_loader, device, config.image_size)}
+
+        print('@ Pruning %.2f of the channels, prune_residual: %s.' % (config.prune_ratio, config.prune_residual))
+        model = prune_model(
+            copy.deepcopy(model),
+            compute_keep_indices(model, config.prune_ratio, config.prune_residual, config.prune_min_keep),
+            prune_residual=config.prune_residual
+        )
+        reports['pruned'] = report(model, valid_loader, device, config.image_size)
+
+        save_dir = os.path.join(config.save_path, config.model_type, 'pruned')
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        pruned_path = os.path.join(save_dir, 'pruned_fold%d.pth' % fold_index)
+        torch.save({
+            'state_dict': model.state_dict(),
+            'prune_config': model.prune_config,
+            'max_score': reports['pruned']['OA']
+        }, pruned_path)
+        print('Saving pruned model to %s.' % pruned_path)
+
+        if config.prune_epoch > 0:
+            # 以剪枝后的权重为初始权重进行微调，保存的权重中同样带有prune_config
+            fine_tune_config = copy.copy(config)
+            fine_tune_config.weight_path = pruned_path
+            fine_tune_config.epoch = config.prune_epoch
+            train_val = TrainVal(fine_tune_config, fold_index, resume_state)
+            if resume_state is not None:
+                resume_state = {'fold': resume_state['fold']}
+            if train_val.train(train_loader, valid_loader):
+                # 收到SIGTERM时已经保存了断点，不再微调之后的折
+                break
+            model = prepare_model.load_chekpoint(
+                model, os.path.join(train_val.model_path, 'model_best.pth')).to(device)
+            reports['fine-tuned'] = report(model, valid_loader, device, config.image_size)
+        print_report(reports)
@@ -3,36 +3,48 @@
 '''
 import numpy as np
 import torch
-import shutil
 import os
+from utils.checkpoint_writer import CheckpointWriter
+from utils.profiling import PhaseTimer
 
 
 class Solver:
-    def __init__(self, model, device):
+    def __init__(self, model, device, checkpoint_writer=None, channels_last=False, timer=None):
         ''' 完成solver类的初始化
         Args:
             model: 网络模型
             device: 设备
+            checkpoint_writer: CheckpointWriter, 用于保存权重，为None时同步保存
+            channels_last: bool, 是否将输入转换为channels_last内存格式，此时模型也应转换为channels_last
+            timer: PhaseTimer, 统计拷贝到设备、前向传播、计算损失、反向传播与优化器更新的耗时，为None时不统计
         '''
         self.model = model
         self.device = device
+        self.memory_format = torch.channels_last if channels_last else torch.preserve_format
+        if checkpoint_writer is None:
+            checkpoint_writer = CheckpointWriter(async_save=False)
+        self.checkpoint_writer = checkpoint_writer
+        self.timer = timer if timer is not None else PhaseTimer(enabled=False)
 
-    def forward(self, images):
+    def forward(self, images, model=None):
         ''' 实现网络的前向传播功能
         
         Args:
             images: [batch_size, channel, height, width]
+            model: 使用的模型，为None时使用self.model，例如验证时可以传入EMA模型
             
         Return:
             output: 网络的输出，具体维度和含义与self.model有关，对我们任务而言：
                 若self.model为分割模型，则维度为[batch_size, class_num, height, width]，One-hot数据
                 若self.model为分类模型，则维度为[batch_size, class_num]，One-hot数据
         '''
-        images = images.to(self.device)
-        outputs = self.model(images)
+        with self.timer.phase('h2d'):
+            images = images.to(self.device, memory_format=self.memory_format)
+        with self.timer.phase('forward'):
+            outputs = (self.model if model is None else model)(images)
         return outputs
 
-    def cal_loss(self, predicts, targets, criterion):
+    def cal_loss(self, predicts, targets, criterion, teacher_logits=None):
         ''' 根据真实类标和预测出的类标计算损失
         
         Args:
@@ -42,13 +54,17 @@ class Solver:
                 若为分类模型，则维度为[batch_size, class_num]，真实类标，One-hot数据
 
             criterion: 使用的损失函数
+            teacher_logits: 知识蒸馏时教师网络的输出，维度为[batch_size, class_num]
         Return:
             loss: 计算出的损失值
         '''
-        targets = targets.to(self.device)
-        return criterion(predicts, targets)
+        with self.timer.phase('loss'):
+            targets = targets.to(self.device)
+            if teacher_logits is not None:
+                return criterion(predicts, targets, teacher_logits=teacher_logits.to(self.device))
+            return criterion(predicts, targets)
 
-    def cal_loss_cutmix(self, predicts, targets_a, targets_b, lam, criterion):
+    def cal_loss_cutmix(self, predicts, targets_a, targets_b, lam, criterion, teacher_logits_a=None, teacher_logits_b=None):
         """计算使用cutmix时的损失
 
         Args:
@@ -57,43 +73,68 @@ class Solver:
             targets_b: 类标b
             lam: lambda参数
             criterion: 损失函数
+            teacher_logits_a: 知识蒸馏时样本a对应的教师网络输出
+            teacher_logits_b: 知识蒸馏时样本b对应的教师网络输出
         Return:
             loss: 计算出的损失值        
         """
-        targets_a = targets_a.to(self.device)
-        targets_b = targets_b.to(self.device)
-        return criterion(predicts, targets_a) * lam + criterion(predicts, targets_b) * (1. - lam)
+        return self.cal_loss(predicts, targets_a, criterion, teacher_logits_a) * lam + \
+            self.cal_loss(predicts, targets_b, criterion, teacher_logits_b) * (1. - lam)
 
-    def backword(self, optimizer, loss, sparsity=None):
+    def backword(self, optimizer, loss, sparsity=None, ema=None, regularization=None):
         ''' 实现网络的反向传播
         
         Args:
             optimizer: 模型使用的优化器
             loss: 模型计算出的loss值
+            sparsity: 稀疏训练
+            ema: ModelEma, 在参数更新之后更新滑动平均
+            regularization: Regularization, mode为grad或proximal时在此处施加正则项
         Return:
             None
         '''
-        loss.backward()
-        # 稀疏度训练
-        if sparsity:
-            sparsity.updateBN()
-        optimizer.step()
-        optimizer.zero_grad()
+        with self.timer.phase('backward'):
+            loss.backward()
+        with self.timer.phase('optimizer'):
+            # 稀疏度训练
+            if sparsity:
+                sparsity.updateBN()
+            if regularization and regularization.mode == 'grad':
+                regularization.update_grad()
+            optimizer.step()
+            if regularization and regularization.mode == 'proximal':
+                regularization.proximal_step(optimizer)
+            if ema:
+                ema.update()
+            optimizer.zero_grad()
 
-    def save_checkpoint(self, save_path, state, is_best):
-        ''' 保存模型参数
+    def save_checkpoint(self, save_path, state, is_best, snapshot_path=None, droppable=False):
+        ''' 保存模型参数，state在调用线程中被拷贝到内存，写盘由checkpoint_writer完成
         Args:
             save_path: 要保存的权重路径
             state: 存有模型参数、最大dice等信息的字典
             is_best: 是否为最优模型
+            snapshot_path: 周期性快照的路径，快照以硬链接的形式指向save_path
+            droppable: 写盘过慢时是否可以丢弃本次保存，最优模型、周期性快照与断点不能丢弃
         Return:
             None
         '''
-        torch.save(state, save_path)
         if is_best:
             print('Saving Best Model.')
-            save_best_path = '/'.join(save_path.split('/')[:-1] + ['model_best.pth'])
-            shutil.copyfile(save_path, save_best_path)
+        self.checkpoint_writer.save(save_path, state, is_best, snapshot_path=snapshot_path, droppable=droppable)
+
+    def link_checkpoint(self, source_path, target_path):
+        ''' 在已提交的保存任务完成后，将source_path以硬链接的形式备份到target_path
+        Args:
+            source_path: 源权重路径
+            target_path: 目标路径
+        '''
+        self.checkpoint_writer.link(source_path, target_path)
+
+    def close(self):
+        ''' 等待所有的保存任务完成
+        '''
+        self.checkpoint_writer.close()
     
     def load_checkpoint(self, load_path):
         ''' 保存模型参数
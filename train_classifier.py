@@ -3,18 +3,19 @@ import tqdm
 import datetime
 import os
 import pickle
+import re
 import time
 import numpy as np
 import random
-import shutil
 import torch.nn.functional as F
 from torch.utils.tensorboard import SummaryWriter
 import json
 import codecs
+import signal
 
 from config import get_classify_config
 from solver import Solver
-from utils.set_seed import seed_torch
+from utils.set_seed import seed_torch, get_rng_state, set_rng_state
 from models.build_model import PrepareModel
 from datasets.create_dataset import GetDataloader
 from losses.get_loss import Loss
@@ -24,21 +25,52 @@ from utils.cutmix import generate_mixed_sample
 from datasets.create_dataset import multi_scale_transforms
 from utils.sparsity import Sparsity, Regularization
 from datasets.create_dataset import get_dataloader_from_folder
+from utils.checkpoint_writer import CheckpointWriter
+from utils.sampler import ResumableRandomSampler
+from utils.ema import ModelEma
+from utils.distillation import prepare_teacher_logits
+from utils.profiling import PhaseTimer, create_trace_profiler, format_summary, merge_summaries
+from utils.progressive_resize import ProgressiveResize, resize_loader
+
+
+def load_resume_file(resume_path):
+    """ 读取断点文件，并确定它属于哪一折
+
+    Args:
+        resume_path: str, save_resume_state保存的断点文件
+    Return:
+        state: dict, 断点文件的内容，其中fold为断点所属的折；旧的断点文件中没有fold时由文件名得到，无法确定时为None
+    """
+    print('@ Resuming from %s' % resume_path)
+    state = torch.load(resume_path, map_location='cpu')
+    if state.get('fold') is None:
+        match = re.search(r'resume_fold(\d+)\.pth$', resume_path)
+        state['fold'] = int(match.group(1)) if match else None
+    return state
+
+
+def check_resume_folds(resume_state, selected_fold):
+    """ 断点只能恢复它所属的折，无法确定所属的折时只能选择一折
+    """
+    if resume_state['fold'] is None and len(selected_fold) > 1:
+        raise ValueError('Can not tell which fold the resume checkpoint belongs to, select only one fold to resume.')
 
 
 class TrainVal:
-    def __init__(self, config, fold):
+    def __init__(self, config, fold, resume_state=None):
         """
         Args:
             config: 配置参数
             fold: 当前为第几折
+            resume_state: dict, load_resume_file读取的断点，为None时由config.resume读取；
+                断点属于之前的折时，本折与未断点续训时相同，从头训练并使用新的日志目录
         """
         self.config = config
         self.fold = fold
         self.epoch = config.epoch
         self.num_classes = config.num_classes
         self.lr_scheduler = config.lr_scheduler
-        self.save_interval = 10
+        self.save_interval = config.save_interval
         self.cut_mix = config.cut_mix
         self.beta = config.beta
         self.cutmix_prob = config.cutmix_prob
@@ -50,6 +82,20 @@ class TrainVal:
         self.val_multi_scale = config.val_multi_scale
         self.multi_scale_size = config.multi_scale_size
         self.multi_scale_interval = config.multi_scale_interval
+        # 渐进式调整图片大小，图片由DataLoader直接读取为当前大小，不再使用多尺度训练
+        self.progressive_resize = None
+        # 当前施加在学习率上的倍数，学习率衰减策略看到的始终是倍数为1时的学习率
+        self.lr_scale = 1.
+        if config.progressive_resize:
+            self.multi_scale = False
+            self.progressive_resize = ProgressiveResize(
+                config.image_size,
+                config.progressive_start_size,
+                config.progressive_epochs,
+                config.batch_size,
+                max_batch_size=config.progressive_max_batch_size,
+                lr_scale=config.progressive_lr_scale
+            )
         # 稀疏训练
         self.sparsity = config.sparsity
         self.sparsity_scale = config.sparsity_scale
@@ -61,6 +107,9 @@ class TrainVal:
             print('@ Using cut mix.')
         if self.multi_scale:
             print('@ Using multi scale training.')
+        if self.progressive_resize:
+            print('@ Using progressive resizing from %d to %s in %d epochs.' % (
+                config.progressive_start_size, config.image_size, config.progressive_epochs))
         print('@ Using LOSS: {}'.format(config.loss_name))
 
         # 加载模型
@@ -70,23 +119,36 @@ class TrainVal:
             classes_num=self.num_classes,
             drop_rate=config.drop_rate,
             pretrained=True,
-            bn_to_gn=config.bn_to_gn
+            bn_to_gn=config.bn_to_gn,
+            head=config.head,
+            margin_scale=config.margin_scale
         )
         if config.weight_path:
             self.model = prepare_model.load_chekpoint(self.model, config.weight_path)
+        # channels_last内存格式，需在创建优化器、EMA之前转换，它们的状态与参数的内存格式相同
+        self.channels_last = config.channels_last
+        if self.channels_last:
+            print('@ Using channels_last memory format.')
+            self.model = self.model.to(memory_format=torch.channels_last)
         
         # 稀疏训练
         self.sparsity_train = None
         if config.sparsity:
             print('@ Using sparsity training.')
-            self.sparsity_train = Sparsity(self.model, sparsity_scale=self.sparsity_scale, penalty_type=self.penalty_type)
+            self.sparsity_train = Sparsity(
+                self.model,
+                sparsity_scale=self.sparsity_scale,
+                penalty_type=self.penalty_type,
+                penalty_bias=config.sparsity_bias,
+                schedule=config.sparsity_schedule
+            )
         
         # l1正则化
         self.l1_regular = config.l1_regular
         self.l1_decay = config.l1_decay
         if self.l1_regular:
             print('@ Using l1_regular')
-            self.l1_reg_loss = Regularization(self.model, weight_decay=self.l1_decay, p=1)
+            self.l1_reg_loss = Regularization(self.model, weight_decay=self.l1_decay, p=1, mode=config.l1_mode)
             
         if torch.cuda.is_available():
             self.model = torch.nn.DataParallel(self.model)
@@ -95,6 +157,22 @@ class TrainVal:
         # 加载优化器
         self.optimizer = prepare_model.create_optimizer(config.model_type, self.model, config)
 
+        # 权重滑动平均，在优化器之后创建，优化器可能会替换参数的存储
+        self.ema = None
+        self.ema_eval = False
+        if config.ema:
+            print('@ Using weight EMA.')
+            self.ema = ModelEma(
+                self.model.module,
+                decay=config.ema_decay,
+                interval=config.ema_interval,
+                async_update=config.ema_async
+            )
+            self.ema_eval = config.ema_eval
+            self.ema_model = self.ema.ema_model
+            if torch.cuda.is_available():
+                self.ema_model = torch.nn.DataParallel(self.ema_model)
+
         # 加载衰减策略
         self.exp_lr_scheduler = prepare_model.create_lr_scheduler(
             self.lr_scheduler,
@@ -109,15 +187,70 @@ class TrainVal:
         )
 
         # 加载损失函数
-        self.criterion = Loss(config.model_type, config.loss_name, self.num_classes)
+        self.criterion = Loss(
+            config.model_type,
+            config.loss_name,
+            self.num_classes,
+            kd_temperature=config.kd_temperature,
+            margin_scale=config.margin_scale,
+            margin=config.margin
+        )
+        if any(name in config.loss_name for name in ['ArcFace', 'SphereFace', 'CosFace']) and config.head == 'linear':
+            raise ValueError('ArcFace/SphereFace/CosFace loss must be used with the arcface/sphereface/cosface head.')
+        if config.head != 'linear':
+            print('@ Using %s head.' % config.head)
+
+        # 知识蒸馏，教师网络的输出在train中读取或计算
+        self.distillation = config.distillation
+        self.teacher_logits = None
+        if self.distillation:
+            if 'KD' not in config.loss_name:
+                raise ValueError('loss_name must contain KD when distillation is True, e.g. 0.5*CrossEntropy+0.5*KD')
+            print('@ Using knowledge distillation.')
 
         # 实例化实现各种子函数的 solver 类
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.solver = Solver(self.model, self.device)
+        checkpoint_writer = CheckpointWriter(
+            async_save=config.async_checkpoint,
+            max_queue_size=config.checkpoint_queue_size,
+            keep_last_snapshots=config.keep_last_snapshots
+        )
+        # 按阶段统计耗时，未启用时不统计
+        self.timer = PhaseTimer(enabled=config.profile, cuda_sync=config.profile_sync)
+        if config.profile:
+            print('@ Using phase timers, writing them to tensorboard every %d iterations.' % config.profile_interval)
+        self.solver = Solver(self.model, self.device, checkpoint_writer, channels_last=self.channels_last,
+                             timer=self.timer)
+
+        # 断点续训
+        self.resume_interval = config.resume_interval
+        self.resume_state = None
+        self.stop_requested = False
+        time_stamp = None
+        if resume_state is None and config.resume:
+            resume_state = load_resume_file(config.resume)
+        if resume_state is not None:
+            resume_fold = resume_state['fold']
+            if resume_fold is not None and fold < resume_fold:
+                raise ValueError('The resume checkpoint belongs to fold %d, can not resume fold %d.' % (resume_fold, fold))
+            if resume_fold is None or resume_fold == fold:
+                self.resume_state = resume_state
+                time_stamp = resume_state['time_stamp']
+            else:
+                print('@ Fold %d starts from scratch, the resume checkpoint belongs to fold %d.' % (fold, resume_fold))
 
-        # log初始化
-        self.writer, self.time_stamp = self.init_log()
+        # log初始化，断点续训时沿用之前的日志目录
+        self.writer, self.time_stamp = self.init_log(time_stamp, seed=self.resume_state is None)
         self.model_path = os.path.join(self.config.save_path, self.config.model_type, self.time_stamp)
+        if self.resume_state is not None:
+            # 断点之前保存的周期性快照同样受keep_last_snapshots的限制，按照epoch的先后登记
+            pattern = re.compile(r'%s_epoch(\d+)_fold%d\.pth$' % (re.escape(self.config.model_type), self.fold))
+            snapshots = []
+            for file_name in os.listdir(self.model_path) if os.path.isdir(self.model_path) else []:
+                match = pattern.match(file_name)
+                if match:
+                    snapshots.append((int(match.group(1)), os.path.join(self.model_path, file_name)))
+            checkpoint_writer.add_snapshots([snapshot_path for _, snapshot_path in sorted(snapshots)])
 
         # 初始化分类度量准则类
         with open("online-service/model/label_id_name.json", 'r', encoding='utf-8') as json_file:
@@ -125,50 +258,148 @@ class TrainVal:
         self.classification_metric = ClassificationMetric(self.class_names, self.model_path)
 
         self.max_accuracy_valid = 0
+        self.start_epoch = 0
+        self.global_step = 0
+        if self.resume_state is not None:
+            self.load_resume_state(self.resume_state)
 
     def train(self, train_loader, valid_loader):
         """ 完成模型的训练，保存模型与日志
         Args:
             train_loader: 训练数据的DataLoader
             valid_loader: 验证数据的Dataloader
+        Return:
+            stopped: bool, 是否因收到SIGTERM而在保存断点后提前停止，调用者应随之停止，不再训练之后的折
         """
-        global_step = 0
-        for epoch in range(self.epoch):
+        # 收到SIGTERM（如任务被抢占）时，在当前迭代结束后保存断点并退出；训练结束后恢复原来的处理函数
+        previous_handler = signal.signal(signal.SIGTERM, self.request_stop)
+        try:
+            return self._train(train_loader, valid_loader)
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler if previous_handler is not None else signal.SIG_DFL)
+
+    def _train(self, train_loader, valid_loader):
+        sampler = train_loader.sampler
+        epoch_meter = None
+        if self.resume_state is not None:
+            epoch_meter = self.resume_state['epoch_meter']
+            if isinstance(sampler, ResumableRandomSampler):
+                sampler.load_state_dict(self.resume_state['sampler'])
+            elif epoch_meter is not None:
+                print('@ The train sampler is not resumable, restart epoch %d.' % (self.start_epoch + 1))
+                epoch_meter = None
+            set_rng_state(self.resume_state['rng_state'])
+            self.resume_state = None
+
+        if self.distillation:
+            train_dataset = train_loader.dataset
+            train_dataset.return_index = True
+            store_path = self.config.kd_store or os.path.join(
+                self.config.save_path, 'teacher_logits', 'fold%d' % self.fold)
+            self.teacher_logits = prepare_teacher_logits(self.config, train_dataset, store_path)
+
+        if self.config.class_alpha:
+            print('@ Using per class alpha weights in FocalLoss.')
+            class_counts = np.bincount(train_loader.dataset.label_list, minlength=self.num_classes)
+            self.criterion.set_class_counts(class_counts, self.config.class_alpha_power)
+
+        global_step = self.global_step
+        base_train_loader = train_loader
+        if self.sparsity_train:
+            if self.progressive_resize:
+                self.sparsity_train.total_steps = self.progressive_resize.total_iterations(
+                    len(train_loader.dataset), self.epoch, train_loader.drop_last)
+            else:
+                self.sparsity_train.total_steps = self.epoch * len(train_loader)
+        trace_profiler = None
+        if self.config.profile_trace_steps:
+            trace_dir = os.path.join(self.writer.get_logdir(), 'trace')
+            print('@ Recording torch.profiler trace of %d iterations to %s.' % (self.config.profile_trace_steps, trace_dir))
+            trace_profiler = create_trace_profiler(trace_dir, self.config.profile_trace_wait, self.config.profile_trace_steps)
+            self.timer.record_function = True
+        for epoch in range(self.start_epoch, self.epoch):
             self.model.train()
             epoch += 1
-            images_number, epoch_corrects = 0, 0
-
-            tbar = tqdm.tqdm(train_loader)
             image_size = self.image_size
+            if self.progressive_resize:
+                image_size, batch_size, lr_scale = self.progressive_resize(epoch - 1)
+                train_loader = resize_loader(base_train_loader, image_size, batch_size)
+                self.set_lr_scale(lr_scale)
+                print('@ Progressive resizing: image size: %s, batch size: %d, lr x%.2f' % (image_size, batch_size, lr_scale))
+                self.writer.add_scalar('ImageSize', image_size[0], epoch)
+                self.writer.add_scalar('BatchSize', batch_size, epoch)
+            images_number, epoch_corrects = 0, 0
             l1_regular_loss = 0
             loss_with_l1_regular = 0
-            for i, (images, labels) in enumerate(tbar):
+            start_iteration = 0
+            if isinstance(sampler, ResumableRandomSampler):
+                sampler.set_epoch(epoch)
+                if epoch_meter is not None:
+                    # 跳过当前epoch中已经训练过的样本，这些样本不会被读取与解码
+                    start_iteration = epoch_meter['iteration']
+                    images_number = epoch_meter['images_number']
+                    epoch_corrects = epoch_meter['epoch_corrects']
+                    l1_regular_loss = epoch_meter['l1_regular_loss']
+                    loss_with_l1_regular = epoch_meter['loss_with_l1_regular']
+                    sampler.set_start_index(images_number)
+                    epoch_meter = None
+            # 跳过样本后train_loader的长度只包含剩余的迭代次数
+            iterations = start_iteration + len(train_loader)
+
+            tbar = tqdm.tqdm(train_loader, initial=start_iteration, total=iterations)
+            profile_summaries = []
+            self.timer.mark()
+            for i, (images, labels, *indexes) in enumerate(tbar, start_iteration):
+                # 等待DataLoader返回当前batch的时间
+                self.timer.lap('data')
+                teacher_logits = self.teacher_logits[indexes[0]] if self.distillation else None
                 if self.multi_scale:
                     if i % self.multi_scale_interval == 0:
                         image_size = random.choice(self.multi_scale_size)
-                    images = multi_scale_transforms(image_size, images, auto_aug=self.auto_aug)
+                    with self.timer.phase('multi_scale'):
+                        images = multi_scale_transforms(image_size, images, auto_aug=self.auto_aug)
                 if self.cut_mix:
                     # 使用cut_mix
                     r = np.random.rand(1)
                     if self.beta > 0 and r < self.cutmix_prob:
-                        images, labels_a, labels_b, lam = generate_mixed_sample(self.beta, images, labels)
+                        images, labels_a, labels_b, lam, rand_index = generate_mixed_sample(
+                            self.beta, images, labels, return_index=True)
                         labels_predict = self.solver.forward(images)
-                        loss = self.solver.cal_loss_cutmix(labels_predict, labels_a, labels_b, lam, self.criterion)
+                        loss = self.solver.cal_loss_cutmix(
+                            labels_predict, labels_a, labels_b, lam, self.criterion,
+                            teacher_logits_a=teacher_logits,
+                            teacher_logits_b=teacher_logits[rand_index] if teacher_logits is not None else None
+                        )
                     else:
                         # 网络的前向传播
                         labels_predict = self.solver.forward(images)
-                        loss = self.solver.cal_loss(labels_predict, labels, self.criterion)
+                        loss = self.solver.cal_loss(labels_predict, labels, self.criterion, teacher_logits)
                 else:
                     # 网络的前向传播
                     labels_predict = self.solver.forward(images)
-                    loss = self.solver.cal_loss(labels_predict, labels, self.criterion)
+                    loss = self.solver.cal_loss(labels_predict, labels, self.criterion, teacher_logits)
                 
+                if self.l1_regular and self.l1_reg_loss.mode == 'loss':
+                    with self.timer.phase('loss'):
+                        current_l1_regular_loss = self.l1_reg_loss(self.model)
+                        loss += current_l1_regular_loss
+                self.solver.backword(
+                    self.optimizer,
+                    loss,
+                    sparsity=self.sparsity_train,
+                    ema=self.ema,
+                    regularization=self.l1_reg_loss if self.l1_regular else None
+                )
+                # 统计准确率、记录损失与更新进度条的耗时
+                self.timer.mark()
                 if self.l1_regular:
-                    current_l1_regular_loss = self.l1_reg_loss(self.model)
-                    loss += current_l1_regular_loss
+                    if self.l1_reg_loss.mode == 'loss':
+                        loss_with_l1_regular += loss.item()
+                    else:
+                        # 正则项由solver直接作用在梯度或参数上，loss中不包含正则项
+                        current_l1_regular_loss = self.l1_reg_loss.last_loss
+                        loss_with_l1_regular += loss.item() + current_l1_regular_loss.item()
                     l1_regular_loss += current_l1_regular_loss.item()
-                    loss_with_l1_regular += loss.item()
-                self.solver.backword(self.optimizer, loss, sparsity=self.sparsity_train)
 
                 images_number += images.size(0)
                 epoch_corrects += self.model.module.get_classify_result(labels_predict, labels, self.device).sum()
@@ -193,67 +424,132 @@ class TrainVal:
                 if self.l1_regular:
                     descript += '[L1RegularLoss: {:.4f}][Loss: {:.4f}]'.format(current_l1_regular_loss.item(), loss.item())
                 tbar.set_description(desc=descript)
+                self.timer.lap('logging')
+
+                if self.stop_requested or (self.resume_interval and (i + 1) % self.resume_interval == 0):
+                    epoch_meter = {
+                        'iteration': i + 1,
+                        'images_number': images_number,
+                        'epoch_corrects': int(epoch_corrects),
+                        'l1_regular_loss': l1_regular_loss,
+                        'loss_with_l1_regular': loss_with_l1_regular
+                    }
+                    with self.timer.phase('checkpoint'):
+                        self.save_resume_state(epoch - 1, global_step, sampler, epoch_meter)
+                    epoch_meter = None
+                if self.stop_requested:
+                    print('@ Stop training at epoch: {}, iteration: {}.'.format(epoch, i + 1))
+                    if trace_profiler is not None:
+                        trace_profiler.stop()
+                    self.solver.close()
+                    self.classification_metric.wait()
+                    return True
+
+                if self.timer.enabled and (i + 1) % self.config.profile_interval == 0:
+                    profile_summaries.append(self.timer.write(self.writer.add_scalar, global_step + i))
+                if trace_profiler is not None:
+                    trace_profiler.step()
+                self.timer.mark()
 
             # 写到tensorboard中
             epoch_acc = epoch_corrects / images_number
             self.writer.add_scalar('TrainAccEpoch', epoch_acc, epoch)
             self.writer.add_scalar('Lr', self.optimizer.param_groups[0]['lr'], epoch)
             if self.l1_regular:
-                l1_regular_loss_epoch = l1_regular_loss / len(train_loader)
-                loss_with_l1_regular_epoch = loss_with_l1_regular / len(train_loader)
+                l1_regular_loss_epoch = l1_regular_loss / iterations
+                loss_with_l1_regular_epoch = loss_with_l1_regular / iterations
                 self.writer.add_scalar('TrainL1RegularLoss', l1_regular_loss_epoch, epoch)
                 self.writer.add_scalar('TrainLossWithL1Regular', loss_with_l1_regular_epoch, epoch)
-            descript = self.criterion.record_loss_epoch(len(train_loader), self.writer.add_scalar, epoch)
+            descript = self.criterion.record_loss_epoch(iterations, self.writer.add_scalar, epoch)
 
             # Print the log info
             print('[Finish epoch: {}/{}][Average Acc: {:.4}]'.format(epoch, self.epoch, epoch_acc) + descript)
 
             # 验证模型
-            val_accuracy, val_loss, is_best = self.validation(valid_loader, self.val_multi_scale)
+            with self.timer.phase('validation'):
+                val_accuracy, val_loss, is_best = self.validation(valid_loader, self.val_multi_scale, use_ema=self.ema_eval)
 
             # 保存参数
+            self.timer.mark()
             state = {
                 'epoch': epoch,
                 'state_dict': self.model.module.state_dict(),
                 'max_score': self.max_accuracy_valid
             }
+            if self.ema:
+                state['ema_state_dict'] = self.ema.state_dict()
+                state['ema_eval'] = self.ema_eval
+            if hasattr(self.model.module, 'prune_config'):
+                # 剪枝后的模型需要prune_config才能重建
+                state['prune_config'] = self.model.module.prune_config
+            # 周期性快照与当前权重的内容相同，以硬链接的形式保存
+            snapshot_path = None
+            if epoch % self.save_interval == 0:
+                snapshot_path = os.path.join(
+                    self.model_path,
+                    '%s_epoch%d_fold%d.pth' % (self.config.model_type, epoch, self.fold)
+                )
             self.solver.save_checkpoint(
                 os.path.join(
                     self.model_path,
                     '%s_fold%d.pth' % (self.config.model_type, self.fold)
                 ),
                 state,
-                is_best
+                is_best,
+                snapshot_path=snapshot_path,
+                # 周期性快照不能丢弃，否则快照会缺失
+                droppable=snapshot_path is None
             )
-
-            if epoch % self.save_interval == 0:
-                self.solver.save_checkpoint(
-                    os.path.join(
-                        self.model_path,
-                        '%s_epoch%d_fold%d.pth' % (self.config.model_type, epoch, self.fold)
-                    ),
-                    state,
-                    False
-                )
+            self.timer.lap('checkpoint')
 
             # 写到tensorboard中
             self.writer.add_scalar('ValidLoss', val_loss, epoch)
             self.writer.add_scalar('ValidAccuracy', val_accuracy, epoch)
+            if self.sparsity_train:
+                self.sparsity_train.log_gamma(self.writer, epoch, prune_ratio=self.config.prune_ratio,
+                                              prune_residual=self.config.prune_residual,
+                                              min_keep_ratio=self.config.prune_min_keep)
 
             # 每一个epoch完毕之后，执行学习率衰减
+            self.set_lr_scale(1.)
             if self.lr_scheduler == 'ReduceLR':
                 self.exp_lr_scheduler.step(metrics=val_accuracy)
             else:
                 self.exp_lr_scheduler.step()
-            global_step += len(train_loader)
+            global_step += iterations
+
+            # 每一个epoch结束时保存断点
+            with self.timer.phase('checkpoint'):
+                self.save_resume_state(epoch, global_step, sampler)
+            if self.timer.enabled:
+                # 包含本epoch最后不足profile_interval次的迭代、验证与保存权重
+                profile_summaries.append(self.timer.write(self.writer.add_scalar, global_step))
+                print('[Profile epoch: {}] '.format(epoch) + format_summary(merge_summaries(profile_summaries)))
+        if trace_profiler is not None:
+            trace_profiler.stop()
         print('BEST ACC:{}'.format(self.max_accuracy_valid))
         source_path = os.path.join(self.model_path, 'model_best.pth')
         target_path = os.path.join(self.config.save_path, self.config.model_type, 'backup', 'model_best.pth')
-        print('Copy %s to %s' % (source_path, target_path))
-        shutil.copy(source_path, target_path)
-
-    def validation(self, valid_loader, multi_scale=False):
-        self.model.eval()
+        print('Link %s to %s' % (source_path, target_path))
+        self.solver.link_checkpoint(source_path, target_path)
+        self.solver.close()
+        # 等待混淆矩阵图片画完
+        self.classification_metric.wait()
+        return False
+
+    def validation(self, valid_loader, multi_scale=False, use_ema=False):
+        """ 在验证集上验证模型
+        Args:
+            valid_loader: 验证数据的Dataloader
+            multi_scale: 是否进行多尺度验证
+            use_ema: 是否验证EMA权重
+        """
+        if use_ema:
+            self.ema.wait()
+            model = self.ema_model
+        else:
+            model = self.model
+        model.eval()
         labels_predict_all, labels_all = np.empty(shape=(0,)), np.empty(shape=(0,))
         epoch_loss = 0
         with torch.no_grad():
@@ -265,7 +561,7 @@ class TrainVal:
                     for i, (_, images, labels) in enumerate(tbar):
                         images = multi_scale_transforms(image_size, images, auto_aug=False)
                         # 网络的前向传播
-                        labels_predict = self.solver.forward(images)
+                        labels_predict = self.solver.forward(images, model)
                         loss = self.solver.cal_loss(labels_predict, labels, self.criterion)
 
                         epoch_loss += loss
@@ -291,7 +587,7 @@ class TrainVal:
                 tbar = tqdm.tqdm(valid_loader)
                 for i, (_, images, labels) in enumerate(tbar):
                     # 网络的前向传播
-                    labels_predict = self.solver.forward(images)
+                    labels_predict = self.solver.forward(images, model)
                     loss = self.solver.cal_loss(labels_predict, labels, self.criterion)
 
                     epoch_loss += loss
@@ -332,18 +628,95 @@ class TrainVal:
 
             return oa, epoch_loss / len(tbar), is_best
 
-    def init_log(self):
-        # 保存配置信息和初始化tensorboard
-        TIMESTAMP = "log-{0:%Y-%m-%dT%H-%M-%S}".format(datetime.datetime.now())
+    def set_lr_scale(self, lr_scale):
+        ''' 将各参数组的学习率设为倍数为1时的lr_scale倍
+
+        Args:
+            lr_scale: float, 学习率的倍数，学习率衰减前需要恢复为1
+        '''
+        for param_group in self.optimizer.param_groups:
+            param_group['lr'] *= lr_scale / self.lr_scale
+        self.lr_scale = lr_scale
+
+    def request_stop(self, signum, frame):
+        print('@ Received signal %d, saving resume checkpoint after the current iteration.' % signum)
+        self.stop_requested = True
+
+    def save_resume_state(self, epoch, global_step, sampler, epoch_meter=None):
+        ''' 保存断点续训所需的全部状态，断点文件只保留最新的一份
+
+        Args:
+            epoch: int, 已经完成的epoch数目
+            global_step: int, 当前epoch开始时的全局迭代次数
+            sampler: train_loader的sampler
+            epoch_meter: dict, 当前epoch中途的统计量，为None时表示epoch已经结束
+        '''
+        state = {
+            'epoch': epoch,
+            'global_step': global_step,
+            'epoch_meter': epoch_meter,
+            'state_dict': self.model.module.state_dict(),
+            'max_score': self.max_accuracy_valid,
+            'optimizer': self.optimizer.state_dict(),
+            'lr_scheduler': self.exp_lr_scheduler.state_dict(),
+            'loss_log': self.criterion.log_state_dict(),
+            'rng_state': get_rng_state(),
+            'sampler': sampler.state_dict() if isinstance(sampler, ResumableRandomSampler) else None,
+            'time_stamp': self.time_stamp,
+            'fold': self.fold,
+            'lr_scale': self.lr_scale
+        }
+        if self.ema:
+            state['ema_state_dict'] = self.ema.state_dict()
+            state['ema_step_count'] = self.ema.step_count
+        if self.sparsity_train:
+            state['sparsity_step_count'] = self.sparsity_train.step_count
+        self.solver.save_checkpoint(os.path.join(self.model_path, 'resume_fold%d.pth' % self.fold), state, False)
+
+    def load_resume_state(self, state):
+        ''' 恢复由save_resume_state保存的模型、优化器、学习率衰减策略与损失记录，
+        sampler与随机数生成器的状态在train中恢复
+
+        Args:
+            state: dict, 断点文件的内容
+        '''
+        self.model.module.load_state_dict(state['state_dict'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.exp_lr_scheduler.load_state_dict(state['lr_scheduler'])
+        # 优化器中保存的是缩放后的学习率，恢复为倍数为1时的学习率，由train按照当前epoch重新缩放
+        self.lr_scale = state.get('lr_scale', 1.)
+        self.set_lr_scale(1.)
+        self.criterion.load_log_state_dict(state['loss_log'])
+        if self.ema and 'ema_state_dict' in state:
+            self.ema.load_state_dict(state['ema_state_dict'])
+            self.ema.step_count = state['ema_step_count']
+        elif self.ema:
+            # 断点文件中没有EMA权重时，从恢复后的模型权重开始滑动平均
+            self.ema.load_state_dict(self.model.module.state_dict())
+        if self.sparsity_train and 'sparsity_step_count' in state:
+            self.sparsity_train.step_count = state['sparsity_step_count']
+        self.max_accuracy_valid = state['max_score']
+        self.start_epoch = state['epoch']
+        self.global_step = state['global_step']
+        if state['epoch_meter'] is not None:
+            print('@ Resume at epoch: {}, iteration: {}.'.format(self.start_epoch + 1, state['epoch_meter']['iteration']))
+        else:
+            print('@ Resume at epoch: {}.'.format(self.start_epoch + 1))
+
+    def init_log(self, time_stamp=None, seed=True):
+        # 保存配置信息和初始化tensorboard，time_stamp不为None时沿用已有的日志目录
+        TIMESTAMP = time_stamp if time_stamp is not None else "log-{0:%Y-%m-%dT%H-%M-%S}".format(datetime.datetime.now())
         log_dir = os.path.join(self.config.save_path, self.config.model_type, TIMESTAMP)
         writer = SummaryWriter(log_dir=log_dir)
         with codecs.open(os.path.join(log_dir, 'config.json'), 'w', "utf-8") as json_file:
-            json.dump({k: v for k, v in config._get_kwargs()}, json_file, ensure_ascii=False)
+            json.dump({k: v for k, v in self.config._get_kwargs()}, json_file, ensure_ascii=False)
 
-        seed = int(time.time())
-        seed_torch(seed)
-        with open(os.path.join(log_dir, 'seed.pkl'), 'wb') as f:
-            pickle.dump({'seed': seed}, f, -1)
+        # 断点续训时随机数状态由断点文件恢复，不再重新生成种子
+        if seed:
+            seed = int(time.time())
+            seed_torch(seed)
+            with open(os.path.join(log_dir, 'seed.pkl'), 'wb') as f:
+                pickle.dump({'seed': seed}, f, -1)
 
         return writer, TIMESTAMP
 
@@ -355,7 +728,8 @@ if __name__ == "__main__":
     test_size = config.val_size
     only_self = config.only_self
     only_official = config.only_official
-    multi_scale = config.multi_scale
+    # 渐进式调整图片大小时，图片由DataLoader直接读取为当前大小
+    multi_scale = config.multi_scale and not config.progressive_resize
     val_multi_scale = config.val_multi_scale
     val_official = config.val_official
     load_split_from_file = config.load_split_from_file
@@ -391,12 +765,25 @@ if __name__ == "__main__":
             selected_labels=selected_labels,
             val_official=val_official,
             load_split_from_file=load_split_from_file,
-            auto_aug=auto_aug
+            auto_aug=auto_aug,
+            manifest_path=config.manifest
             )
         train_dataloaders, val_dataloaders = get_dataloader.get_dataloader(config.batch_size, config.image_size, mean, std,
                                                                         transforms=transforms, multi_scale=multi_scale, val_multi_scale=val_multi_scale)
 
+    resume_state = None
+    if config.resume:
+        resume_state = load_resume_file(config.resume)
+        check_resume_folds(resume_state, config.selected_fold)
     for fold_index, [train_loader, valid_loader] in enumerate(zip(train_dataloaders, val_dataloaders)):
         if fold_index in config.selected_fold:
-            train_val = TrainVal(config, fold_index)
-            train_val.train(train_loader, valid_loader)
+            if resume_state is not None and resume_state['fold'] is not None and fold_index < resume_state['fold']:
+                print('@ Skipping fold %d, which is finished before the resume checkpoint.' % fold_index)
+                continue
+            train_val = TrainVal(config, fold_index, resume_state)
+            if resume_state is not None:
+                # 之后的折从头训练，只需要断点所属的折，释放断点中的权重
+                resume_state = {'fold': resume_state['fold']}
+            if train_val.train(train_loader, valid_loader):
+                # 收到SIGTERM时已经保存了断点，不再训练之后的折
+                break
@@ -0,0 +1,227 @@
+'''
+该文件的功能：在后台线程中异步、原子地保存权重文件，避免训练因写盘而停顿
+'''
+import os
+import queue
+import shutil
+import threading
+import time
+import torch
+
+
+def snapshot_to_cpu(obj):
+    ''' 将state中的所有tensor拷贝到内存中，得到与训练过程无关的快照
+
+    Args:
+        obj: 任意嵌套的dict/list/tuple，叶子节点可以是tensor
+    Return:
+        与obj结构相同的对象，其中所有tensor均为cpu上独立的拷贝
+    '''
+    if isinstance(obj, torch.Tensor):
+        tensor = obj.detach()
+        # cpu上的tensor需要显式clone，否则后续的训练会修改快照的内容
+        return tensor.cpu() if tensor.is_cuda else tensor.clone()
+    elif isinstance(obj, dict):
+        return type(obj)((key, snapshot_to_cpu(value)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(value) for value in obj)
+    return obj
+
+
+def atomic_save(state, save_path):
+    ''' 先写入临时文件，再通过rename替换目标文件，保证目标文件要么是旧的完整文件，要么是新的完整文件
+
+    Args:
+        state: 待保存的对象
+        save_path: 目标路径
+    '''
+    tmp_path = save_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, save_path)
+
+
+def atomic_link(source_path, target_path):
+    ''' 使用硬链接代替拷贝，硬链接不可用（如跨文件系统）时退化为拷贝
+
+    由于source_path之后总是通过rename被整体替换，已经建立的硬链接仍然指向旧的文件内容，
+    因此硬链接与拷贝的语义是一致的。
+
+    Args:
+        source_path: 源文件路径
+        target_path: 目标文件路径
+    '''
+    target_dir = os.path.dirname(target_path)
+    if target_dir and not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    tmp_path = target_path + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source_path, tmp_path)
+    except OSError:
+        shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, target_path)
+
+
+class CheckpointWriter:
+    """异步保存权重文件
+
+    调用save时只在训练线程中将state拷贝到内存，序列化与写盘在后台线程中完成；
+    最优模型、周期性快照与备份均使用硬链接，不再重复写入完整的文件。
+    """
+
+    def __init__(self, async_save=True, max_queue_size=2, put_timeout=60, keep_last_snapshots=None):
+        '''
+        Args:
+            async_save: bool, 是否在后台线程中保存，为False时在调用线程中同步保存
+            max_queue_size: int, 等待写盘的快照的最大数目，用于限制内存占用
+            put_timeout: float, 队列已满时可以丢弃的任务最多等待的秒数，超时后丢弃本次快照，避免磁盘过慢时训练被长时间阻塞；
+                最优模型、断点等不能丢弃的任务会一直等待
+            keep_last_snapshots: int, 周期性快照最多保留的数目，为None时全部保留
+        '''
+        self.async_save = async_save
+        self.put_timeout = put_timeout
+        self.keep_last_snapshots = keep_last_snapshots
+        self.snapshots = []
+        self.error = None
+        if self.async_save:
+            self.queue = queue.Queue(maxsize=max_queue_size)
+            self.worker = threading.Thread(target=self.__run, daemon=True)
+            self.worker.start()
+
+    def save(self, save_path, state, is_best=False, snapshot_path=None, droppable=False):
+        ''' 保存权重
+
+        Args:
+            save_path: 要保存的权重路径
+            state: 存有模型参数等信息的字典
+            is_best: 是否为最优模型，若是，则在同一目录下建立指向save_path的model_best.pth
+            snapshot_path: 周期性快照的路径，为None时不保存快照
+            droppable: bool, 队列已满且等待超时时是否可以丢弃本次保存，只用于普通的周期性权重；
+                is_best为True或者保存快照时总是不丢弃
+        Return:
+            bool, 本次保存是否被接受（只有可以丢弃的保存会返回False）
+        '''
+        self.__raise_error()
+        # 在拷贝state之前判断是否丢弃，被丢弃的保存不需要付出拷贝到内存的开销
+        if droppable and not is_best and not snapshot_path and not self.__wait_for_slot():
+            print('@ Checkpoint queue is full, skipping %s.' % save_path)
+            return False
+        links = []
+        if is_best:
+            links.append(os.path.join(os.path.dirname(save_path), 'model_best.pth'))
+        if snapshot_path:
+            links.append(snapshot_path)
+        job = ('save', save_path, snapshot_to_cpu(state), links, snapshot_path)
+        return self.__submit(job)
+
+    def link(self, source_path, target_path):
+        ''' 在之前所有的保存任务完成后，建立target_path到source_path的硬链接
+
+        Args:
+            source_path: 源文件路径
+            target_path: 目标文件路径
+        '''
+        self.__raise_error()
+        return self.__submit(('link', source_path, target_path))
+
+    def add_snapshots(self, snapshot_paths):
+        ''' 登记之前（例如断点续训之前）已经保存在磁盘上的周期性快照，使它们同样受keep_last_snapshots的限制
+
+        Args:
+            snapshot_paths: list, 快照路径，按照保存的先后排列
+        '''
+        for snapshot_path in snapshot_paths:
+            if snapshot_path not in self.snapshots:
+                self.snapshots.append(snapshot_path)
+
+    def flush(self):
+        ''' 等待所有的保存任务完成
+        '''
+        if self.async_save:
+            self.queue.join()
+        self.__raise_error()
+
+    def close(self):
+        ''' 完成剩余的保存任务并结束后台线程
+        '''
+        if self.async_save and self.worker.is_alive():
+            self.queue.put(None)
+            self.worker.join()
+        self.__raise_error()
+
+    def __wait_for_slot(self):
+        ''' 等待队列中出现空位，最多等待put_timeout秒；只有训练线程向队列中添加任务，空位出现后不会被其他线程占用
+
+        Return:
+            bool, 是否有空位
+        '''
+        if not self.async_save:
+            return True
+        deadline = time.monotonic() + self.put_timeout
+        while self.queue.full():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def __submit(self, job):
+        if not self.async_save:
+            self.__execute(job)
+            return True
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            print('@ Checkpoint queue is full, waiting to save %s.' % job[1])
+            self.queue.put(job)
+        return True
+
+    def __run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self.__execute(job)
+            except Exception as e:
+                # 将后台线程中的异常保存下来，在训练线程下一次调用时抛出
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def __execute(self, job):
+        if job[0] == 'save':
+            _, save_path, state, links, snapshot_path = job
+            save_dir = os.path.dirname(save_path)
+            if save_dir and not os.path.exists(save_dir):
+                os.makedirs(save_dir)
+            atomic_save(state, save_path)
+            for link_path in links:
+                atomic_link(save_path, link_path)
+            if snapshot_path:
+                self.__apply_retention(snapshot_path)
+        elif job[0] == 'link':
+            _, source_path, target_path = job
+            atomic_link(source_path, target_path)
+
+    def __apply_retention(self, snapshot_path):
+        ''' 只保留最新的keep_last_snapshots个周期性快照
+        '''
+        if snapshot_path in self.snapshots:
+            self.snapshots.remove(snapshot_path)
+        self.snapshots.append(snapshot_path)
+        if self.keep_last_snapshots is None:
+            return
+        while len(self.snapshots) > self.keep_last_snapshots:
+            expired_path = self.snapshots.pop(0)
+            if os.path.exists(expired_path):
+                print('Removing expired checkpoint %s' % expired_path)
+                os.remove(expired_path)
+
+    def __raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
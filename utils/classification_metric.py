@@ -1,6 +1,9 @@
 import json
 import os
 import codecs
+import html
+import multiprocessing
+import concurrent.futures
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib as mpl
@@ -12,7 +15,8 @@ warnings.filterwarnings('ignore')
 
 
 class ClassificationMetric:
-    def __init__(self, labels, save_path, text_flag=1, cmap=plt.cm.Blues, show_pic=False, save_result=True):
+    def __init__(self, labels, save_path, text_flag=1, cmap=plt.cm.Blues, show_pic=False, save_result=True,
+                 async_render=True):
         """
 
         :param labels: 所有的类别名称；类型为list；维度为[n_classes]
@@ -21,6 +25,7 @@ class ClassificationMetric:
         :param cmap: plt中的cmap
         :param show_pic: 是否显示画出的混淆矩阵；类型为bool
         :param save_result: 是否保存画出的混淆矩阵，以及是否存放结果到log文件；类型为bool
+        :param async_render: 是否在单独的进程中画混淆矩阵图片，为False时在当前进程中画图；类型为bool
         """
         self.labels = labels
         self.save_path = save_path
@@ -28,6 +33,9 @@ class ClassificationMetric:
         self.cmap = cmap
         self.show_pic = show_pic
         self.save_result = save_result
+        self.async_render = async_render
+        self.executor = None
+        self.render_future = None
 
     def get_metric(self, y_true, y_pred):
         """
@@ -57,7 +65,10 @@ class ClassificationMetric:
 
     def draw_cm_and_save_result(self, classify_report, my_confusion_matrix, acc_for_each_class, oa, average_accuracy,
                                 kappa):
-        """ 画混淆矩阵并根据self.save_result的值决定是否保存最后结果
+        """ 保存结果与混淆矩阵，并画混淆矩阵
+
+        结果（result.json、classes_acc.json）、原始混淆矩阵（confusion_matrix.npy）与HTML热力图（confusion_matrix.html）
+        立即写入；PNG图片默认在单独的进程中绘制，训练不需要等待matplotlib。
 
         :param classify_report: 分类报告；类型为string / dict
         :param my_confusion_matrix: 混淆矩阵；类型为numpy；维度为[n_classes, n_classes]
@@ -66,55 +77,7 @@ class ClassificationMetric:
         :param average_accuracy: 宏平均（先对每一个类统计指标值，然后在对所有类求算术平均值）；类型为float
         :param kappa: Kappa系数；类型为float
         """
-
-        np.set_printoptions(precision=2)
-        my_confusion_matrix_normalized = my_confusion_matrix.astype('float') / my_confusion_matrix.sum(axis=1) \
-            [:, np.newaxis]
-        plt.figure(figsize=(20, 16), dpi=120)
-
-        ind_array = np.arange(len(self.labels))
-        x, y = np.meshgrid(ind_array, ind_array)
-        # intFlag = 0 # 标记在图片中对文字是整数型还是浮点型
-        for x_val, y_val in zip(x.flatten(), y.flatten()):
-            if self.text_flag == 0:
-                c = my_confusion_matrix[y_val][x_val]
-                # 这里是绘制数字，可以对数字大小和颜色进行修改
-                plt.text(x_val, y_val, "%d" % (c,), color='red', fontsize=8, va='center', ha='center')
-                plt.grid(True, which='minor', linestyle='-')
-            elif self.text_flag == 1:
-                c = my_confusion_matrix_normalized[y_val][x_val]
-                if c > 0.01:
-                    plt.text(x_val, y_val, "%0.2f" % (c,), color='red', fontsize=7, va='center', ha='center')
-                else:
-                    plt.text(x_val, y_val, "%d" % (0,), color='red', fontsize=7, va='center', ha='center')
-                plt.grid(True, which='minor', linestyle='-')
-            else:
-                pass
-
-        if self.text_flag == 0:
-            plt.imshow(my_confusion_matrix, interpolation='nearest', cmap=self.cmap)
-        else:
-            plt.imshow(my_confusion_matrix_normalized, interpolation='nearest', cmap=self.cmap)
-
-        tick_marks = np.array(range(len(self.labels))) + 0.5
-        plt.gca().set_xticks(tick_marks, minor=True)
-        plt.gca().set_yticks(tick_marks, minor=True)
-        plt.gca().xaxis.set_ticks_position('none')
-        plt.gca().yaxis.set_ticks_position('none')
-
-        plt.gcf().subplots_adjust(bottom=0.15)
-        plt.title('Confusion Matrix')
-        plt.colorbar()
-        xlocations = np.array(range(len(self.labels)))
-        font = FontProperties(fname=r"font/simhei.ttf", size=7)
-        plt.xticks(xlocations, self.labels, fontproperties=font, rotation=90)
-        plt.yticks(xlocations, self.labels, fontproperties=font, rotation=0)
-        plt.ylabel('Index of True Classes')
-        plt.xlabel('Index of Predict Classes')
-
         if self.save_result:
-            plt.savefig(os.path.join(self.save_path, 'confusion_matrix'), dpi=200)
-
             result = {'acc_for_each_class': acc_for_each_class.tolist(),
                       'OA': oa, 'AA': average_accuracy, 'kappa': kappa,
                       'classify_report': classify_report,
@@ -128,6 +91,125 @@ class ClassificationMetric:
             with codecs.open(os.path.join(self.save_path, 'classes_acc.json'), 'w', "utf-8") as json_file:
                 json.dump(classes_acc, json_file, ensure_ascii=False)
 
+            np.save(os.path.join(self.save_path, 'confusion_matrix.npy'), my_confusion_matrix)
+            with codecs.open(os.path.join(self.save_path, 'confusion_matrix.html'), 'w', "utf-8") as html_file:
+                html_file.write(confusion_matrix_html(my_confusion_matrix, self.labels))
+
         if self.show_pic:
-            plt.show()
-        plt.close('all')
+            render_confusion_matrix(my_confusion_matrix, self.labels, self.save_path if self.save_result else None,
+                                    self.text_flag, self.cmap.name, show_pic=True)
+        elif self.save_result:
+            if not self.async_render:
+                render_confusion_matrix(my_confusion_matrix, self.labels, self.save_path, self.text_flag, self.cmap.name)
+                return
+            if self.executor is None:
+                # 使用spawn启动画图进程，子进程不会继承父进程的CUDA上下文
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+            # 上一次的图片还没有开始画时直接取消，只画最新的混淆矩阵
+            if self.render_future is not None:
+                self.render_future.cancel()
+            # 直接传递混淆矩阵，而不是confusion_matrix.npy的路径，画图时该文件可能正在被下一次的结果覆盖
+            self.render_future = self.executor.submit(
+                render_confusion_matrix, my_confusion_matrix, self.labels, self.save_path, self.text_flag,
+                self.cmap.name)
+            self.render_future.add_done_callback(log_render_error)
+
+    def wait(self):
+        """ 等待画图进程结束
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            self.render_future = None
+
+
+def log_render_error(future):
+    """ 画图结束时输出画图进程中发生的异常，画图失败不影响训练
+
+    :param future: executor.submit返回的Future
+    """
+    if not future.cancelled() and future.exception() is not None:
+        print('@ Failed to render the confusion matrix: %r' % future.exception())
+
+
+def confusion_matrix_html(my_confusion_matrix, labels):
+    """ 以HTML表格的形式生成归一化混淆矩阵的热力图，颜色按照整个矩阵一次计算
+
+    :param my_confusion_matrix: 混淆矩阵；类型为numpy；维度为[n_classes, n_classes]
+    :param labels: 所有的类别名称；类型为list；维度为[n_classes]
+    :return: HTML字符串
+    """
+    normalized = my_confusion_matrix.astype('float') / np.maximum(my_confusion_matrix.sum(axis=1, keepdims=True), 1)
+    # 由白色线性过渡到深蓝色(8, 48, 107)
+    colors = np.rint(255 - normalized[..., None] * (255 - np.array([8, 48, 107]))).astype(int)
+    hex_colors = np.char.add('#', np.char.add(np.char.add(
+        np.char.zfill(np.char.mod('%x', colors[..., 0]), 2), np.char.zfill(np.char.mod('%x', colors[..., 1]), 2)),
+        np.char.zfill(np.char.mod('%x', colors[..., 2]), 2)))
+    texts = np.where(normalized > 0.01, np.char.mod('%.2f', normalized), '')
+    font_colors = np.where(normalized > 0.5, 'white', 'black')
+    names = [html.escape(str(label)) for label in labels]
+    rows = []
+    for i, name in enumerate(names):
+        cells = ''.join('<td style="background:%s;color:%s" title="%s &rarr; %s: %d">%s</td>' % (
+            hex_colors[i, j], font_colors[i, j], name, names[j], my_confusion_matrix[i, j], texts[i, j])
+            for j in range(len(names)))
+        rows.append('<tr><th>%d %s</th>%s</tr>' % (i, name, cells))
+    header = ''.join('<th>%d</th>' % j for j in range(len(names)))
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Confusion Matrix</title><style>'
+            'table{border-collapse:collapse;font:10px sans-serif}td{width:22px;height:18px;text-align:center;'
+            'border:1px solid #eee}th{font-weight:normal;text-align:right;padding-right:4px}</style></head><body>'
+            '<h3>Confusion Matrix (rows: true classes, columns: predicted classes)</h3>'
+            '<table><tr><th></th>%s</tr>%s</table></body></html>' % (header, ''.join(rows)))
+
+
+def render_confusion_matrix(my_confusion_matrix, labels, save_path, text_flag=1, cmap_name='Blues', show_pic=False):
+    """ 画混淆矩阵，可以在单独的进程中调用
+
+    :param my_confusion_matrix: 混淆矩阵或者保存混淆矩阵的npy文件路径
+    :param labels: 所有的类别名称；类型为list；维度为[n_classes]
+    :param save_path: 图片的保存目录，为None时不保存
+    :param text_flag: text_flag=0标记在图片中对文字是正确个数，text_flag=1标记在图片中对文字是正确率，text_flag=2没有数字；类型为int
+    :param cmap_name: plt中的cmap名称
+    :param show_pic: 是否显示画出的混淆矩阵；类型为bool
+    """
+    if isinstance(my_confusion_matrix, str):
+        my_confusion_matrix = np.load(my_confusion_matrix)
+    if not show_pic:
+        plt.switch_backend('Agg')
+    my_confusion_matrix_normalized = my_confusion_matrix.astype('float') / \
+        np.maximum(my_confusion_matrix.sum(axis=1), 1)[:, np.newaxis]
+    figure = plt.figure(figsize=(20, 16), dpi=120)
+    ax = figure.add_subplot(111)
+    values = my_confusion_matrix if text_flag == 0 else my_confusion_matrix_normalized
+    image = ax.imshow(values, interpolation='nearest', cmap=plt.get_cmap(cmap_name))
+
+    # 只标注非零的单元格，网格线只设置一次
+    if text_flag in (0, 1):
+        for y_val, x_val in zip(*np.nonzero(values > (0 if text_flag == 0 else 0.01))):
+            text = "%d" % values[y_val, x_val] if text_flag == 0 else "%0.2f" % values[y_val, x_val]
+            ax.text(x_val, y_val, text, color='red', fontsize=7, va='center', ha='center')
+    tick_marks = np.array(range(len(labels))) + 0.5
+    ax.set_xticks(tick_marks, minor=True)
+    ax.set_yticks(tick_marks, minor=True)
+    ax.grid(True, which='minor', linestyle='-')
+    ax.xaxis.set_ticks_position('none')
+    ax.yaxis.set_ticks_position('none')
+
+    figure.subplots_adjust(bottom=0.15)
+    ax.set_title('Confusion Matrix')
+    figure.colorbar(image)
+    xlocations = np.array(range(len(labels)))
+    font = FontProperties(fname=r"font/simhei.ttf", size=7) if os.path.exists('font/simhei.ttf') else None
+    ax.set_xticks(xlocations)
+    ax.set_xticklabels(labels, fontproperties=font, rotation=90)
+    ax.set_yticks(xlocations)
+    ax.set_yticklabels(labels, fontproperties=font, rotation=0)
+    ax.set_ylabel('Index of True Classes')
+    ax.set_xlabel('Index of Predict Classes')
+
+    if save_path is not None:
+        figure.savefig(os.path.join(save_path, 'confusion_matrix'), dpi=200)
+    if show_pic:
+        plt.show()
+    plt.close(figure)
@@ -2,21 +2,24 @@ import numpy as np
 import torch
 
 
-def generate_mixed_sample(beta, sample, target):
+def generate_mixed_sample(beta, sample, target, return_index=False):
     """生成cutmix样本和类标
 
     Args:
         beta: beta参数
         sample: 原始样本
         target: 原始类标
+        return_index: 是否同时返回打乱顺序的索引，用于对教师网络的输出等做相同的变换
     Returns:
         sample: 转换后的样本
         target_a: 类标a
         target_b: 类标b
+        lam: 样本a所占的面积比例
+        rand_index: 打乱顺序的索引，仅在return_index为True时返回
     """
     # generate mixed sample
     lam = np.random.beta(beta, beta)
-    rand_index = torch.randperm(sample.size()[0]).cuda()
+    rand_index = torch.randperm(sample.size()[0]).to(sample.device)
     target_a = target
     target_b = target[rand_index]
     bbx1, bby1, bbx2, bby2 = rand_bbox(sample.size(), lam)
@@ -24,6 +27,8 @@ def generate_mixed_sample(beta, sample, target):
     # adjust lambda to exactly match pixel ratio
     lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (sample.size()[-1] * sample.size()[-2]))
     
+    if return_index:
+        return sample, target_a, target_b, lam, rand_index
     return sample, target_a, target_b, lam
 
 
@@ -31,8 +36,8 @@ def rand_bbox(size, lam):
     W = size[2]
     H = size[3]
     cut_rat = np.sqrt(1. - lam)
-    cut_w = np.int(W * cut_rat)
-    cut_h = np.int(H * cut_rat)
+    cut_w = int(W * cut_rat)
+    cut_h = int(H * cut_rat)
 
     # uniform
     cx = np.random.randint(W)
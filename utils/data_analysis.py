@@ -1,23 +1,211 @@
 import os
 import json
+import math
+import collections
+import concurrent.futures
+import hashlib
 import matplotlib.pyplot as plt
 import random
 import imagesize
 from matplotlib.font_manager import FontProperties
+from datasets.manifest import Manifest, is_official
+
+# 图片宽高直方图的区间宽度（像素）
+IMAGE_SIZE_BIN = 64
+# 长宽比直方图的区间宽度
+ASPECT_RATIO_BIN = 0.1
+
+
+def probe_sample(sample_path):
+    """读取图片文件头得到宽高，并得到文件大小
+
+    Returns:
+        width, height, file_size: 无法读取时均为-1
+    """
+    try:
+        file_size = os.path.getsize(sample_path)
+        width, height = imagesize.get(sample_path)
+    except (OSError, ValueError):
+        return -1, -1, -1
+    return width, height, file_size
+
+
+def read_label(label_txt):
+    """读取"样本名, 类标"格式的标注文件，不存在时返回None
+    """
+    try:
+        with open(label_txt, 'r', encoding='utf-8-sig') as label_file:
+            for image_label in label_file:
+                if image_label.strip():
+                    return int(image_label.split(', ')[1])
+    except OSError:
+        return None
+    return None
+
+
+def draw_labels_number(labels_number, label_to_name, phase='Train'):
+    """ 画出各个类别的样本数目
+
+    Args:
+        labels_number: dict, {label_1: number_1, label_2: number_2, ...}
+        label_to_name: dict, 类标到真实名称的映射
+        phase: str, 当前模式，用作标题
+    Return:
+        figure: matplotlib.figure.Figure
+    """
+    labels = list(labels_number.keys())
+    number = list(labels_number.values())
+    name = [label_to_name[str(label)] for label in labels]
+
+    figure = plt.figure(figsize=(20, 16))
+    font = FontProperties(fname=r"font/simhei.ttf", size=7) if os.path.exists('font/simhei.ttf') else None
+    ax1 = figure.add_subplot(111)
+    x_axis = range(len(labels))
+    rects = ax1.bar(x=x_axis, height=number, width=0.8, label='Label Number')
+    ax1.set_ylabel('Number')
+    ax1.set_xticks([index + 0.13 for index in x_axis])
+    ax1.set_xticklabels(name, fontproperties=font, rotation=270)
+    ax1.set_xlabel('Labels')
+    ax1.set_title('%s: Sample Number of Each Label' % phase)
+    ax1.legend()
+
+    for rect in rects:
+        height = rect.get_height()
+        ax1.text(rect.get_x() + rect.get_width() / 2, height+1, str(height), ha="center", va="bottom")
+    return figure
+
+
+def draw_histogram(histogram, title, xlabel):
+    """ 画出以区间起点为键的直方图
+    """
+    keys = sorted(histogram.keys(), key=float)
+    figure = plt.figure(figsize=(12, 6))
+    ax1 = figure.add_subplot(111)
+    ax1.bar(range(len(keys)), [histogram[key] for key in keys], width=0.8)
+    ax1.set_xticks(range(len(keys)))
+    ax1.set_xticklabels(keys, rotation=90)
+    ax1.set_xlabel(xlabel)
+    ax1.set_ylabel('Number')
+    ax1.set_title(title)
+    return figure
 
 
 class DatasetStatistic:
     """对数据集的分布进行统计
+
+    所有统计量（类别数目、各来源的数目、图片宽高与长宽比直方图、文件大小分布）在一次并行遍历中得到，
+    结果缓存在数据集目录或者清单旁边的json文件中，数据集没有变化时直接读取缓存。画图只在需要时进行。
     """
-    def __init__(self, data_root, label_id_json):
+    def __init__(self, data_root, label_id_json, manifest_path=None, cache_path=None, workers=16):
         """
         Args:
             data_root: str, 数据根目录
             label_id_json: str, label_id_json文件目录
+            manifest_path: str, 数据集清单，不为None时统计清单中的样本，清单中的相对路径相对于data_root
+            cache_path: str, 统计结果的缓存文件，默认为清单路径加上.stats.json或者数据根目录加上_stats.json
+            workers: 读取文件的线程数目
         """
         self.data_root = data_root
         self.label_id_json = label_id_json
-    
+        self.manifest_path = manifest_path
+        if cache_path is None:
+            cache_path = manifest_path + '.stats.json' if manifest_path else data_root.rstrip(os.sep) + '_stats.json'
+        self.cache_path = cache_path
+        self.workers = workers
+        self.statistics = None
+
+    def get_statistics(self, refresh=False):
+        """得到数据集的统计量，数据集没有变化时读取缓存
+
+        Args:
+            refresh: bool, 为True时忽略缓存重新统计
+        Returns:
+            statistics: dict, 包括samples、class_counts、source_counts、class_source_counts、width_histogram、
+                height_histogram、aspect_ratio_histogram、file_size_histogram与unreadable
+        """
+        fingerprint = self.get_fingerprint()
+        if self.statistics is not None and self.statistics['fingerprint'] == fingerprint and not refresh:
+            return self.statistics
+        if not refresh and self.cache_path and os.path.exists(self.cache_path):
+            with open(self.cache_path, 'r') as f:
+                statistics = json.load(f)
+            if statistics.get('fingerprint') == fingerprint:
+                self.statistics = statistics
+                return statistics
+        self.statistics = self.compute_statistics()
+        self.statistics['fingerprint'] = fingerprint
+        if self.cache_path:
+            with open(self.cache_path, 'w') as f:
+                json.dump(self.statistics, f, ensure_ascii=False)
+        return self.statistics
+
+    def get_fingerprint(self):
+        """数据集是否变化的依据：清单文件的大小与修改时间，或者数据集目录中每个文件的名称、大小与修改时间；
+        直接修改标注文件的内容时目录的修改时间不变，因此需要逐个文件比较，scandir只读取目录项，开销很小
+        """
+        if self.manifest_path:
+            stat = os.stat(self.manifest_path)
+            return [self.manifest_path, stat.st_size, stat.st_mtime_ns]
+        digest = hashlib.md5()
+        with os.scandir(self.data_root) as entries:
+            files = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                           for entry in entries if entry.is_file())
+        for name, size, mtime_ns in files:
+            digest.update(('%s\t%d\t%d\n' % (name, size, mtime_ns)).encode('utf-8'))
+        return [self.data_root, len(files), digest.hexdigest()]
+
+    def get_samples(self):
+        """得到所有样本的(路径, 类标, 来源)，由目录得到时类标为None，需要读取标注文件
+        """
+        if self.manifest_path:
+            return [(os.path.join(self.data_root, entry['path']), entry['label'], entry.get('source', ''))
+                    for entry in Manifest.load(self.manifest_path)]
+        return [(os.path.join(self.data_root, image_name), None, 'official' if is_official(image_name) else 'self')
+                for image_name in self.get_image_names()]
+
+    def compute_statistics(self):
+        """在线程池中读取所有样本的标注与文件头，一次得到所有的统计量
+        """
+        samples = self.get_samples()
+
+        def probe(sample):
+            sample_path, label, source = sample
+            if label is None:
+                label = read_label(os.path.splitext(sample_path)[0] + '.txt')
+            return (label, source) + probe_sample(sample_path)
+
+        class_counts = collections.Counter()
+        source_counts = collections.Counter()
+        class_source_counts = collections.defaultdict(collections.Counter)
+        width_histogram, height_histogram = collections.Counter(), collections.Counter()
+        aspect_ratio_histogram, file_size_histogram = collections.Counter(), collections.Counter()
+        unreadable = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for sample, (label, source, width, height, file_size) in zip(samples, executor.map(probe, samples)):
+                if label is not None:
+                    class_counts[str(label)] += 1
+                    class_source_counts[str(label)][source] += 1
+                source_counts[source] += 1
+                if width <= 0 or height <= 0:
+                    unreadable.append(sample[0])
+                    continue
+                width_histogram[str(width // IMAGE_SIZE_BIN * IMAGE_SIZE_BIN)] += 1
+                height_histogram[str(height // IMAGE_SIZE_BIN * IMAGE_SIZE_BIN)] += 1
+                aspect_ratio_histogram['%.1f' % (math.floor(width / height / ASPECT_RATIO_BIN) * ASPECT_RATIO_BIN)] += 1
+                # 文件大小按照2的幂次（KB）分组，键为区间的上界
+                file_size_histogram[str(2 ** max(math.ceil(math.log2(max(file_size, 1) / 1024)), 0))] += 1
+        return {
+            'samples': len(samples),
+            'class_counts': dict(class_counts),
+            'source_counts': dict(source_counts),
+            'class_source_counts': {label: dict(counts) for label, counts in class_source_counts.items()},
+            'width_histogram': dict(width_histogram),
+            'height_histogram': dict(height_histogram),
+            'aspect_ratio_histogram': dict(aspect_ratio_histogram),
+            'file_size_histogram': dict(file_size_histogram),
+            'unreadable': unreadable
+        }
+
     def get_expand_number(self, thresh, more_than_thresh_number, less_than_thresh_number):
         """获取每一类别需要额外补充的样本数目
 
@@ -36,7 +224,7 @@ class DatasetStatistic:
                 name_expand_number[str(label_to_name[str(label)])] = more_than_thresh_number
             else:
                 name_expand_number[str(label_to_name[str(label)])] = (less_than_thresh_number - number) + random.sample([5, 10, 15], 1)[0]
-        
+
         return name_expand_number
 
     def get_name_less_than_thresh(self, thresh):
@@ -52,44 +240,17 @@ class DatasetStatistic:
         """得到每一个类别对应的样本数目
 
         Returns:
-            labels_number: dir {1: 256, 2:125, ...}
+            labels_number: dir {1: 256, 2:125, ...}，按照类标排序
         """
-        image_names = self.get_image_names()
-        labels = [self.get_label(os.path.join(self.data_root, image_name)) for image_name in image_names]
-        labels_number = {}
-        for label in labels:
-            if label in labels_number.keys():
-                labels_number[label] += 1
-            else:
-                labels_number[label] = 1
-        return labels_number
+        class_counts = self.get_statistics()['class_counts']
+        return {int(label): class_counts[label] for label in sorted(class_counts, key=int)}
 
     def show_label_number_distr(self):
         """展示样本数目分布
         """
-        labels_number = self.get_label_number()
-        labels = labels_number.keys()
-        number = labels_number.values()
-        label_to_name = self.get_label_to_name()
-        name = [label_to_name[str(label)] for label in labels]
-        
-        font = FontProperties(fname=r"font/simhei.ttf", size=7)
-        ax1 = plt.subplot(111)
-        x_axis = range(len(labels))
-        rects = ax1.bar(x=x_axis, height=number, width=0.8, label='Label Number')
-        plt.ylabel('Number')
-        plt.xticks([index + 0.13 for index in x_axis], name, fontproperties=font, rotation=270)
-        plt.xlabel('Labels')
-        plt.title('Sample Number of Each Label')
-        plt.legend()
-
-        for rect in rects:
-            height = rect.get_height()
-            plt.text(rect.get_x() + rect.get_width() / 2, height+1, str(height), ha="center", va="bottom")
-        mng = plt.get_current_fig_manager()
-        mng.window.showMaximized()        
+        draw_labels_number(self.get_label_number(), self.get_label_to_name(), phase='Dataset')
         plt.show()
-            
+
     def get_image_names(self):
         """得到所用样本名称
         """
@@ -105,11 +266,7 @@ class DatasetStatistic:
         Returns:
             label: 类标
         """
-        label_txt = image_name.replace('jpg', 'txt')
-        with open(label_txt, 'r') as label_file:
-            for image_label in label_file:
-                label = int(image_label.split(', ')[1])
-        return label
+        return read_label(os.path.splitext(image_name)[0] + '.txt')
 
     def get_label_to_name(self):
         """得到类别到真实名称的映射
@@ -119,33 +276,54 @@ class DatasetStatistic:
         return label_to_name
 
     def show_image_aspect_ratio_distr(self):
-        """得到样本长宽比
+        """展示样本长宽比分布
         """
-        aspect_ratio_dict = {}
-
-        image_names = self.get_image_names()
-        for image_name in image_names:
-            sample_path = os.path.join(self.data_root, image_name)
-            width, height = imagesize.get(sample_path)
-            aspect_ratio = width/height
-            if aspect_ratio in aspect_ratio_dict:
-                aspect_ratio_dict[aspect_ratio] += 1
-            else:
-                aspect_ratio_dict[aspect_ratio] = 0
-
-        aspect_ratio_dict_filt = {}
-        for key, value in aspect_ratio_dict.items():
-            if value > 100:
-                aspect_ratio_dict_filt[key] = value
-        del aspect_ratio_dict
-        plt.bar(aspect_ratio_dict_filt.keys(), aspect_ratio_dict_filt.values())
+        draw_histogram(self.get_statistics()['aspect_ratio_histogram'], 'Aspect Ratio of Images', 'Width / Height')
         plt.show()
 
+    def render(self, output_dir='readme'):
+        """将类别数目、图片宽高、长宽比与文件大小的分布保存为图片，不在训练过程中调用
+        """
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        statistics = self.get_statistics()
+        figures = {
+            'label_number': draw_labels_number(self.get_label_number(), self.get_label_to_name(), phase='Dataset'),
+            'width': draw_histogram(statistics['width_histogram'], 'Width of Images', 'Width'),
+            'height': draw_histogram(statistics['height_histogram'], 'Height of Images', 'Height'),
+            'aspect_ratio': draw_histogram(statistics['aspect_ratio_histogram'], 'Aspect Ratio of Images',
+                                           'Width / Height'),
+            'file_size': draw_histogram(statistics['file_size_histogram'], 'File Size of Images', 'File Size (<= KB)')
+        }
+        for name, figure in figures.items():
+            figure.savefig(os.path.join(output_dir, '%s.jpg' % name), dpi=120)
+            plt.close(figure)
+        return list(figures.keys())
+
+
+def render_split_distribution(split_distribution_path, label_id_json, output_dir='readme'):
+    """画出GetDataloader保存的各个折的训练集与验证集的类别分布
+    """
+    with open(split_distribution_path, 'r') as f:
+        split_distribution = json.load(f)
+    with open(label_id_json, 'r') as f:
+        label_to_name = json.load(f)
+    for phase, labels_number in split_distribution.items():
+        figure = draw_labels_number({int(label): number for label, number in labels_number.items()}, label_to_name,
+                                    phase=phase)
+        figure.savefig(os.path.join(output_dir, '%s.jpg' % phase), dpi=240)
+        plt.close(figure)
+
 
 if __name__ == '__main__':
     data_root = 'data/huawei_data/train_data'
     label_id_json = 'data/huawei_data/label_id_name.json'
     dataset_statistic = DatasetStatistic(data_root, label_id_json)
-    dataset_statistic.show_image_aspect_ratio_distr()
+    statistics = dataset_statistic.get_statistics()
+    print('Samples: %d, sources: %s, unreadable: %d' % (
+        statistics['samples'], statistics['source_counts'], len(statistics['unreadable'])))
+    dataset_statistic.render('readme')
+    if os.path.exists('split_distribution.json'):
+        render_split_distribution('split_distribution.json', label_id_json, 'readme')
     # names = dataset_statistic.get_name_less_than_thresh(100)
     # print(names)
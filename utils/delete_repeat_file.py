@@ -1,41 +1,230 @@
 # coding=utf-8
+'''
+该文件的功能：查找数据集中内容完全相同的图片，生成去重计划，确认后再更新数据集划分与清单
 
-import os
-import os.path
+* 只有大小相同的文件才可能重复，因此先按照文件大小分组，只计算大小有重复的文件的MD5；
+* MD5在线程池中按块流式计算，不会将整个文件读入内存；
+* MD5缓存在以(路径, 大小, 修改时间)为键的文件中，再次运行时只计算新增或修改过的文件；
+* 默认只生成去重计划（dry run），使用--apply执行计划：将重复的图片及其标注文件移动到隔离目录，
+  并从dataset_split.json等划分文件与清单中移除，而不是直接删除文件导致划分文件中的样本不存在。
+
+用法：
+python -m utils.delete_repeat_file --data_root data/huawei_data/train_data
+python -m utils.delete_repeat_file --data_root data/huawei_data/train_data --apply --split_files dataset_split.json
+'''
+import argparse
+import collections
+import concurrent.futures
 import hashlib
+import json
+import os
+import shutil
+
+from datasets.manifest import Manifest
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
 
-def get_md5(filename):
+
+def get_md5(filename, chunk_size=1024 * 1024):
+    """按块流式计算文件的MD5
+    """
     m = hashlib.md5()
-    mfile = open(filename, "rb")
-    m.update(mfile.read())
-    mfile.close()
-    md5_value = m.hexdigest()
-    return md5_value
+    with open(filename, 'rb') as mfile:
+        for chunk in iter(lambda: mfile.read(chunk_size), b''):
+            m.update(chunk)
+    return m.hexdigest()
 
 
-if __name__ == '__main__':
-    ipath = "/media/mxq/data/competition/HuaWei/combine_google"
+class HashCache(object):
+    """以(文件名, 大小, 修改时间)为键的MD5缓存，保存为json文件
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.hashes = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                self.hashes = json.load(f)
 
-    filenames = [file for file in os.listdir(ipath) if file.endswith('jpg')]
-    md5_dir = {}
-    count = 0
-    for filename in filenames:
-        current_md5 = get_md5(os.path.join(ipath, filename))
-        if current_md5 in md5_dir.keys():
-            md5_dir[current_md5].append(filename)
-            count += 1
-            os.remove(os.path.join(ipath, filename))
+    def get(self, name, stat):
+        cached = self.hashes.get(name)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        return None
+
+    def set(self, name, stat, md5):
+        self.hashes[name] = [stat.st_size, stat.st_mtime_ns, md5]
+
+    def save(self):
+        if not self.cache_path:
+            return
+        with open(self.cache_path + '.tmp', 'w') as f:
+            json.dump(self.hashes, f)
+        os.replace(self.cache_path + '.tmp', self.cache_path)
+
+
+def find_duplicates(data_root, cache_path=None, workers=8):
+    """查找data_root下内容相同的图片
+
+    Args:
+        data_root: 数据集目录
+        cache_path: MD5缓存文件的路径，为None时不使用缓存
+        workers: 计算MD5的线程数目
+    Return:
+        groups: list, 每一组为内容相同的图片名称，保留的图片排在第一位
+        hashed: int, 本次实际计算MD5的文件数目
+    """
+    stats = {entry.name: entry.stat() for entry in os.scandir(data_root)
+             if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)}
+    # 先按照文件大小分组，大小唯一的文件不可能重复
+    size_groups = collections.defaultdict(list)
+    for name, stat in stats.items():
+        size_groups[stat.st_size].append(name)
+    candidates = [name for names in size_groups.values() if len(names) > 1 for name in names]
+
+    cache = HashCache(cache_path)
+    hashes = {}
+    to_hash = []
+    for name in candidates:
+        md5 = cache.get(name, stats[name])
+        if md5 is None:
+            to_hash.append(name)
         else:
-            md5_dir[current_md5] = [filename]
-    for key, values in md5_dir.items():
-        if len(values) != 1:
-            print(key + ":", values)
-
-    # 删除单个的txt文件
-    filenames = os.listdir(ipath)
-    txt_filenames = [file for file in os.listdir(ipath) if file.endswith('txt')]
-    for txt_filename in txt_filenames:
-        if txt_filename.replace('txt', 'jpg') not in filenames:
-            print(txt_filename)
-            os.remove(os.path.join(ipath, txt_filename))
+            hashes[name] = md5
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, md5 in zip(to_hash, executor.map(get_md5, [os.path.join(data_root, name) for name in to_hash])):
+            hashes[name] = md5
+            cache.set(name, stats[name], md5)
+    # 删除已经不存在的文件的缓存
+    cache.hashes = {name: value for name, value in cache.hashes.items() if name in stats}
+    cache.save()
+
+    md5_groups = collections.defaultdict(list)
+    for name, md5 in hashes.items():
+        md5_groups[(stats[name].st_size, md5)].append(name)
+    groups = [sorted(names, key=keep_priority) for names in md5_groups.values() if len(names) > 1]
+    return sorted(groups), len(to_hash)
+
+
+def keep_priority(name):
+    """重复图片中优先保留官方数据（名称以img_开头），其次保留名称较短的图片
+    """
+    return (not name.startswith('img_'), len(name), name)
+
+
+def make_plan(data_root, groups):
+    """生成去重计划
+
+    Return:
+        plan: dict, remove中每一项为{'name': 重复的图片, 'duplicate_of': 保留的图片, 'annotation': 标注文件或None}，
+            orphan_annotations为没有对应图片的标注文件
+    """
+    files = set(os.listdir(data_root))
+    remove = []
+    for group in groups:
+        for name in group[1:]:
+            annotation = os.path.splitext(name)[0] + '.txt'
+            remove.append({'name': name, 'duplicate_of': group[0],
+                           'annotation': annotation if annotation in files else None})
+    image_stems = set(os.path.splitext(name)[0] for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+    orphan_annotations = sorted(name for name in files
+                                if name.endswith('.txt') and os.path.splitext(name)[0] not in image_stems)
+    return {'data_root': os.path.abspath(data_root), 'remove': remove, 'orphan_annotations': orphan_annotations}
+
+
+def remove_from_split(split, removed):
+    """从数据集划分中移除样本
+
+    Args:
+        split: [train_lists, val_lists]，与dataset_split.json的格式相同
+        removed: set, 被移除的样本名称
+    Return:
+        split: 移除样本后的划分
+        count: int, 被移除的样本数目
+    """
+    count = 0
+    new_split = []
+    for folds in split:
+        new_folds = []
+        for samples, labels in folds:
+            kept = [(sample, label) for sample, label in zip(samples, labels) if sample not in removed]
+            count += len(samples) - len(kept)
+            new_folds.append([[sample for sample, _ in kept], [label for _, label in kept]])
+        new_split.append(new_folds)
+    return new_split, count
+
+
+def apply_plan(plan, split_files=(), manifest_paths=(), quarantine_root=None):
+    """执行去重计划：将重复的图片与其标注文件移动到隔离目录，并从划分文件与清单中移除
+
+    Args:
+        plan: make_plan得到的去重计划
+        split_files: list, 需要更新的数据集划分文件，如dataset_split.json
+        manifest_paths: list, 需要更新的清单文件
+        quarantine_root: 隔离目录，默认为数据集目录加上"_duplicates"后缀
+    """
+    data_root = plan['data_root']
+    quarantine_root = quarantine_root or data_root.rstrip(os.sep) + '_duplicates'
+    if not os.path.exists(quarantine_root):
+        os.makedirs(quarantine_root)
+    removed = set()
+    for item in plan['remove']:
+        image_path = os.path.join(data_root, item['name'])
+        # 计划生成之后文件可能已经变化，只有仍然与保留的图片相同时才移除
+        keep_path = os.path.join(data_root, item['duplicate_of'])
+        if not (os.path.exists(image_path) and os.path.exists(keep_path)
+                and os.path.getsize(image_path) == os.path.getsize(keep_path)
+                and get_md5(image_path) == get_md5(keep_path)):
+            print('Skipping %s, it has changed since the plan was made.' % item['name'])
+            continue
+        shutil.move(image_path, os.path.join(quarantine_root, item['name']))
+        if item['annotation'] and os.path.exists(os.path.join(data_root, item['annotation'])):
+            shutil.move(os.path.join(data_root, item['annotation']), os.path.join(quarantine_root, item['annotation']))
+        removed.add(item['name'])
+    for annotation in plan['orphan_annotations']:
+        if os.path.exists(os.path.join(data_root, annotation)):
+            shutil.move(os.path.join(data_root, annotation), os.path.join(quarantine_root, annotation))
+    print('Moved %d duplicate images and %d orphan annotations to %s' % (
+        len(removed), len(plan['orphan_annotations']), quarantine_root))
+
+    for split_file in split_files:
+        with open(split_file, 'r') as f:
+            split, count = remove_from_split(json.load(f), removed)
+        with open(split_file, 'w') as f:
+            json.dump(split, f)
+        print('Removed %d samples from %s' % (count, split_file))
+    removed_paths = set(os.path.normpath(os.path.join(data_root, name)) for name in removed)
+    for manifest_path in manifest_paths:
+        manifest = Manifest.load(manifest_path)
+        kept = manifest.filter(lambda entry: os.path.normpath(os.path.join(data_root, entry['path'])) not in removed_paths)
+        kept.save(manifest_path)
+        print('Removed %d samples from %s' % (len(manifest) - len(kept), manifest_path))
+    return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', type=str, required=True)
+    parser.add_argument('--plan_path', type=str, default='', help='default: <data_root>_dedup_plan.json')
+    parser.add_argument('--cache_path', type=str, default='', help='default: <data_root>_md5_cache.json')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--apply', action='store_true', help='apply the plan instead of making it')
+    parser.add_argument('--split_files', type=str, nargs='*', default=[])
+    parser.add_argument('--manifests', type=str, nargs='*', default=[])
+    parser.add_argument('--quarantine_root', type=str, default='')
+    args = parser.parse_args()
+
+    data_root = os.path.abspath(args.data_root).rstrip(os.sep)
+    plan_path = args.plan_path or data_root + '_dedup_plan.json'
+    if args.apply:
+        with open(plan_path, 'r') as f:
+            plan = json.load(f)
+        apply_plan(plan, args.split_files, args.manifests, args.quarantine_root or None)
+    else:
+        groups, hashed = find_duplicates(data_root, args.cache_path or data_root + '_md5_cache.json', args.workers)
+        plan = make_plan(data_root, groups)
+        with open(plan_path, 'w') as f:
+            json.dump(plan, f, ensure_ascii=False, indent=2)
+        for group in groups:
+            print('Keeping %s, duplicates: %s' % (group[0], group[1:]))
+        print('Hashed %d files, found %d duplicates and %d orphan annotations. Plan is saved to %s, '
+              'run with --apply to apply it.' % (hashed, len(plan['remove']), len(plan['orphan_annotations']), plan_path))
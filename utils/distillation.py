@@ -0,0 +1,189 @@
+'''
+该文件的功能：知识蒸馏中教师网络输出（logits）的预计算与存储
+
+教师网络（可以是多个模型的集成，并使用水平翻转TTA）只在训练开始前对训练集推理一次，
+输出以float16保存在磁盘上，学生网络的每个epoch直接按照样本索引读取，不再重复教师网络的前向传播。
+'''
+import json
+import os
+import numpy as np
+import torch
+import tqdm
+from torch.utils.data import DataLoader
+
+from models.build_model import PrepareModel
+from datasets.create_dataset import ValDataset
+
+
+def parse_teacher(teacher):
+    ''' 解析教师网络的描述
+
+    Args:
+        teacher: str, model_type:weight_path[:height,width]，如 efficientnet-b5:checkpoints/b5.pth:456,456
+    Return:
+        model_type: str, 模型类型
+        weight_path: str, 权重路径
+        image_size: list or None, 教师网络的输入大小，为None时与学生网络相同
+    '''
+    fields = teacher.split(':')
+    if len(fields) not in (2, 3):
+        raise ValueError('Teacher must be model_type:weight_path[:height,width], got %s' % teacher)
+    image_size = [int(size) for size in fields[2].split(',')] if len(fields) == 3 else None
+    return fields[0], fields[1], image_size
+
+
+class LogitStore:
+    """按照样本名称索引的教师网络输出，以float16存放在磁盘上（.npy存放logits，.json存放样本名称与教师网络信息）
+    """
+
+    def __init__(self, logits, sample_names, meta=None):
+        '''
+        Args:
+            logits: tensor, [样本数目, 类别数目]
+            sample_names: list, 与logits的每一行对应的样本名称
+            meta: dict, 生成这些logits的教师网络与TTA等信息，用于判断缓存是否可以复用
+        '''
+        self.logits = logits
+        self.sample_names = list(sample_names)
+        self.meta = meta or {}
+        self.rows = None
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        np.save(path + '.npy', self.logits.cpu().half().numpy())
+        with open(path + '.json', 'w') as f:
+            json.dump({'sample_names': self.sample_names, 'meta': self.meta}, f, ensure_ascii=False)
+
+    @staticmethod
+    def load(path):
+        ''' 读取由save保存的LogitStore，文件不存在时返回None
+        '''
+        if not (os.path.exists(path + '.npy') and os.path.exists(path + '.json')):
+            return None
+        with open(path + '.json', 'r') as f:
+            info = json.load(f)
+        logits = torch.from_numpy(np.load(path + '.npy'))
+        return LogitStore(logits, info['sample_names'], info['meta'])
+
+    def covers(self, sample_names):
+        names = set(self.sample_names)
+        return all(name in names for name in sample_names)
+
+    def align(self, sample_names):
+        ''' 建立数据集中的样本索引到存储中行号的映射，之后即可使用数据集的索引读取logits
+
+        Args:
+            sample_names: list, 数据集中按照索引排列的样本名称
+        '''
+        row_of_name = {name: row for row, name in enumerate(self.sample_names)}
+        missing = [name for name in sample_names if name not in row_of_name]
+        if missing:
+            raise KeyError('%d samples have no teacher logits, e.g. %s' % (len(missing), missing[0]))
+        self.rows = torch.tensor([row_of_name[name] for name in sample_names], dtype=torch.long)
+        return self
+
+    def __getitem__(self, indexes):
+        ''' 按照数据集中的样本索引读取logits
+
+        Args:
+            indexes: tensor, [batch_size], 数据集中的样本索引
+        Return:
+            logits: float tensor, [batch_size, 类别数目]
+        '''
+        return self.logits[self.rows[indexes]].float()
+
+
+def compute_teacher_logits(teachers, data_root, sample_names, num_classes, image_size, mean, std,
+                           batch_size=32, tta=True, device=None):
+    """使用教师网络（多个时取logits的平均）对样本进行推理
+
+    Args:
+        teachers: list, 教师网络的描述，见parse_teacher
+        data_root: str, 数据集根目录
+        sample_names: list, 样本名称
+        num_classes: int, 类别数目
+        image_size: [height, width], 教师网络未指定输入大小时使用
+        mean: tuple, 通道均值
+        std: tuple, 通道方差
+        batch_size: int, 批量大小
+        tta: bool, 是否对水平翻转后的图片同样进行推理并取平均
+        device: 推理使用的设备
+    Return:
+        logits: tensor, [样本数目, 类别数目]
+    """
+    device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    prepare_model = PrepareModel()
+    ensemble_logits = torch.zeros(len(sample_names), num_classes)
+    for teacher in teachers:
+        model_type, weight_path, teacher_image_size = parse_teacher(teacher)
+        model = prepare_model.create_model(model_type, num_classes, pretrained=False)
+        model = prepare_model.load_chekpoint(model, weight_path).to(device).eval()
+        if torch.cuda.is_available():
+            model = torch.nn.DataParallel(model)
+        # 教师网络使用验证集的预处理方式，类标不会被使用
+        dataset = ValDataset(data_root, sample_names, [0] * len(sample_names), teacher_image_size or image_size,
+                             mean=mean, std=std)
+        loader = DataLoader(dataset, batch_size=batch_size, num_workers=8, pin_memory=True, shuffle=False)
+        start = 0
+        with torch.no_grad():
+            for _, images, _ in tqdm.tqdm(loader, desc='Teacher %s' % model_type):
+                images = images.to(device)
+                logits = model(images)
+                if tta:
+                    logits = (logits + model(images.flip(3))) / 2
+                ensemble_logits[start:start + len(images)] += logits.float().cpu()
+                start += len(images)
+        del model
+    return ensemble_logits / len(teachers)
+
+
+def prepare_teacher_logits(config, dataset, store_path):
+    """读取教师网络的输出；不存在或者教师网络的设置发生变化时重新计算并保存
+
+    Args:
+        config: 配置参数
+        dataset: TrainDataset, 训练集，教师网络使用与之相同的数据根目录、均值与方差
+        store_path: str, 存储路径（不含扩展名）
+    Return:
+        store: 已经与训练集的索引对齐的LogitStore
+    """
+    sample_names = dataset.sample_list
+    # 教师网络实际的输入大小同样决定了输出，未指定输入大小的教师网络随学生网络的image_size变化
+    image_sizes = [parse_teacher(teacher)[2] or [int(size) for size in config.image_size]
+                   for teacher in config.kd_teachers]
+    # 重新训练的教师网络可能覆盖原来的权重文件（如model_best.pth），因此同时比较权重文件的大小与修改时间
+    weight_files = []
+    for teacher in config.kd_teachers:
+        stat = os.stat(parse_teacher(teacher)[1])
+        weight_files.append([stat.st_size, stat.st_mtime_ns])
+    meta = {'teachers': list(config.kd_teachers), 'image_sizes': image_sizes, 'weight_files': weight_files,
+            'tta': config.kd_tta, 'num_classes': config.num_classes}
+    store = LogitStore.load(store_path)
+    # 未指定教师网络时直接使用已有的输出
+    if store is not None and store.covers(sample_names) and (not config.kd_teachers or store.meta == meta):
+        print('@ Loading teacher logits from %s.' % store_path)
+        return store.align(sample_names)
+
+    if not config.kd_teachers:
+        raise ValueError('You must specified kd_teachers when there are no teacher logits in %s.' % store_path)
+    if store is not None and store.meta != meta:
+        print('@ Teachers, their weight files or input sizes changed, the teacher logits in %s are stale.' % store_path)
+    print('@ Computing teacher logits with %s.' % ', '.join(config.kd_teachers))
+    logits = compute_teacher_logits(
+        config.kd_teachers,
+        dataset.data_root,
+        sample_names,
+        config.num_classes,
+        config.image_size,
+        dataset.mean,
+        dataset.std,
+        batch_size=config.batch_size,
+        tta=config.kd_tta
+    )
+    # 与从磁盘读取时的精度保持一致
+    store = LogitStore(logits.half(), sample_names, meta)
+    store.save(store_path)
+    print('@ Saving teacher logits to %s.' % store_path)
+    return store.align(sample_names)
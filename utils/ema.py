@@ -0,0 +1,166 @@
+'''
+该文件的功能：维护模型参数与BN统计量的指数滑动平均（EMA），用于验证与部署
+'''
+import copy
+import queue
+import threading
+import torch
+
+
+def _lerp_(tensors, ends, weight):
+    ''' tensors += weight * (ends - tensors)，优先使用multi-tensor操作
+    '''
+    if hasattr(torch, '_foreach_lerp_'):
+        torch._foreach_lerp_(tensors, ends, weight)
+    elif hasattr(torch, '_foreach_mul_'):
+        torch._foreach_mul_(tensors, 1. - weight)
+        torch._foreach_add_(tensors, ends, alpha=weight)
+    else:
+        for tensor, end in zip(tensors, ends):
+            tensor.mul_(1. - weight).add_(end, alpha=weight)
+
+
+def _copy_(tensors, sources):
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(tensors, sources)
+    else:
+        for tensor, source in zip(tensors, sources):
+            tensor.copy_(source)
+
+
+class ModelEma:
+    """模型权重的指数滑动平均
+
+    ema = decay * ema + (1 - decay) * model，参数与BN的running_mean/running_var均参与滑动平均，
+    num_batches_tracked等整型buffer直接拷贝。每interval步更新一次，此时使用decay ** interval，
+    保证滑动平均的时间尺度与每步更新一致。
+    """
+
+    def __init__(self, model, decay=0.9998, interval=1, async_update=False):
+        '''
+        Args:
+            model: 被跟踪的模型，不要传入DataParallel包装后的模型
+            decay: float, 每一步的衰减系数
+            interval: int, 每隔多少步更新一次
+            async_update: bool, 是否在后台线程中完成滑动平均；训练线程中只将当前权重拷贝到暂存区，
+                会额外占用一份模型参数大小的内存
+        '''
+        self.decay = decay
+        self.interval = interval
+        self.async_update = async_update
+        self.step_count = 0
+        self.error = None
+
+        self.ema_model = copy.deepcopy(model)
+        self.ema_model.eval()
+        for p in self.ema_model.parameters():
+            p.requires_grad_(False)
+
+        # state_dict中同时包含参数与buffer，两者的顺序一一对应，只需要构建一次
+        model_tensors = list(model.state_dict(keep_vars=True).values())
+        ema_tensors = list(self.ema_model.state_dict(keep_vars=True).values())
+        self.model_float, self.ema_float, self.model_other, self.ema_other = [], [], [], []
+        for model_tensor, ema_tensor in zip(model_tensors, ema_tensors):
+            if ema_tensor.is_floating_point():
+                self.model_float.append(model_tensor)
+                self.ema_float.append(ema_tensor.data)
+            else:
+                self.model_other.append(model_tensor)
+                self.ema_other.append(ema_tensor.data)
+
+        if self.async_update:
+            self.staging = [tensor.detach().clone() for tensor in self.model_float]
+            self.stream = torch.cuda.Stream() if self.staging and self.staging[0].is_cuda else None
+            self.queue = queue.Queue(maxsize=1)
+            self.worker = threading.Thread(target=self.__run, daemon=True)
+            self.worker.start()
+
+    @torch.no_grad()
+    def update(self):
+        ''' 在optimizer.step()之后调用
+        '''
+        self.step_count += 1
+        if self.step_count % self.interval != 0:
+            return
+        weight = 1. - self.decay ** self.interval
+        if not self.async_update:
+            _lerp_(self.ema_float, [tensor.detach() for tensor in self.model_float], weight)
+            _copy_(self.ema_other, [tensor.detach() for tensor in self.model_other])
+            return
+
+        # 等待上一次的滑动平均完成后才能覆盖暂存区
+        self.wait()
+        _copy_(self.staging, [tensor.detach() for tensor in self.model_float])
+        _copy_(self.ema_other, [tensor.detach() for tensor in self.model_other])
+        event = None
+        if self.stream is not None:
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((weight, event))
+
+    def wait(self):
+        ''' 等待后台线程中的滑动平均完成，在读取EMA权重之前调用
+        '''
+        if self.async_update:
+            self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def state_dict(self):
+        self.wait()
+        return self.ema_model.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.wait()
+        self.ema_model.load_state_dict(state_dict)
+
+    @torch.no_grad()
+    def __run(self):
+        while True:
+            weight, event = self.queue.get()
+            try:
+                if self.stream is not None:
+                    self.stream.wait_event(event)
+                    with torch.cuda.stream(self.stream):
+                        _lerp_(self.ema_float, self.staging, weight)
+                    self.stream.synchronize()
+                else:
+                    _lerp_(self.ema_float, self.staging, weight)
+            except Exception as e:
+                # 将后台线程中的异常保存下来，在训练线程下一次调用wait时抛出
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
+if __name__ == '__main__':
+    import time
+    import torchvision
+
+    model = torchvision.models.resnet50()
+    model.train()
+    for name, async_update in [('sync', False), ('async', True)]:
+        ema = ModelEma(model, decay=0.99, async_update=async_update)
+        start = time.time()
+        for _ in range(20):
+            ema.update()
+        ema.wait()
+        print('%s update: %.2fms' % (name, (time.time() - start) / 20 * 1000))
+
+    # 与逐个参数计算的结果对比
+    reference = copy.deepcopy(model)
+    ema = ModelEma(model, decay=0.9, interval=2, async_update=True)
+    for step in range(6):
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(torch.randn_like(p) * 0.01)
+        ema.update()
+        if (step + 1) % 2 == 0:
+            with torch.no_grad():
+                for reference_tensor, tensor in zip(reference.state_dict().values(), model.state_dict().values()):
+                    if reference_tensor.is_floating_point():
+                        reference_tensor.mul_(0.9 ** 2).add_(tensor * (1 - 0.9 ** 2))
+    error = max((a.float() - b.float()).abs().max().item()
+                for a, b in zip(reference.state_dict().values(), ema.state_dict().values()))
+    print('max error: %g' % error)
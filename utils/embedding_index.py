@@ -0,0 +1,212 @@
+'''
+该文件的功能：基于L2归一化嵌入特征的检索索引，用于最近邻分类与开集样本（分布外样本）的拒识
+
+训练集的嵌入特征以float16保存在内存中，检索时分块转换为float32并使用矩阵乘法计算余弦相似度；
+样本数目较多时可以使用IVF（倒排文件）索引，只在与查询最相似的n_probe个聚类中检索。
+'''
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def spherical_kmeans(embeddings, n_clusters, iterations=10, seed=0):
+    """ 在单位球面上进行k-means聚类，相似度为余弦相似度
+
+    Args:
+        embeddings: float tensor, [样本数目, 特征维度], 已经L2归一化
+        n_clusters: int, 聚类数目
+        iterations: int, 迭代次数
+        seed: int, 随机种子
+    Return:
+        centroids: float tensor, [n_clusters, 特征维度], L2归一化的聚类中心
+        assignments: long tensor, [样本数目], 每个样本所属的聚类
+    """
+    generator = torch.Generator().manual_seed(seed)
+    centroids = embeddings[torch.randperm(len(embeddings), generator=generator)[:n_clusters]].clone()
+    for _ in range(iterations):
+        assignments = (embeddings @ centroids.t()).argmax(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, embeddings)
+        # 空的聚类保持原来的中心
+        empty = sums.norm(dim=1) == 0
+        sums[empty] = centroids[empty]
+        centroids = F.normalize(sums, p=2, dim=1)
+    assignments = (embeddings @ centroids.t()).argmax(dim=1)
+    return centroids, assignments
+
+
+class EmbeddingIndex:
+    """训练集嵌入特征的检索索引，支持批量top-k检索、按照类中心或者k近邻分类，以及按照与类中心的距离拒识
+    """
+
+    def __init__(self, embeddings, labels, num_classes, n_lists=0, n_probe=8, sample_names=None, thresholds=None):
+        '''
+        Args:
+            embeddings: tensor or ndarray, [样本数目, 特征维度], 以float16保存
+            labels: tensor or ndarray, [样本数目], 样本类标
+            num_classes: int, 类别数目
+            n_lists: int, IVF索引的聚类数目，为0时使用暴力检索
+            n_probe: int, IVF索引检索时访问的聚类数目
+            sample_names: list, 与embeddings的每一行对应的样本名称
+            thresholds: tensor, [num_classes], 各类别的拒识阈值，为None时需调用calibrate
+        '''
+        self.embeddings = F.normalize(torch.as_tensor(embeddings).float(), p=2, dim=1).half()
+        self.labels = torch.as_tensor(labels).long()
+        self.num_classes = num_classes
+        self.sample_names = list(sample_names) if sample_names is not None else None
+        self.thresholds = thresholds
+        self.centroids = self.__class_centroids()
+
+        self.n_lists = min(n_lists, len(self.embeddings))
+        self.n_probe = min(n_probe, self.n_lists)
+        if self.n_lists > 0:
+            self.list_centroids, assignments = spherical_kmeans(self.embeddings.float(), self.n_lists)
+            # 按照所属的聚类对样本排序，每个聚类对应一段连续的行
+            self.list_order = torch.argsort(assignments)
+            counts = torch.bincount(assignments, minlength=self.n_lists)
+            self.list_offsets = torch.cat([torch.zeros(1, dtype=torch.long), counts.cumsum(0)])
+
+    def __class_centroids(self):
+        sums = torch.zeros(self.num_classes, self.embeddings.shape[1]).index_add_(0, self.labels, self.embeddings.float())
+        return F.normalize(sums, p=2, dim=1)
+
+    def search(self, queries, k=10, chunk_size=65536):
+        """ 批量检索与查询最相似的k个训练样本
+
+        Args:
+            queries: float tensor, [查询数目, 特征维度]
+            k: int, 返回的近邻数目
+            chunk_size: int, 暴力检索时每次参与计算的训练样本数目
+        Return:
+            similarities: float tensor, [查询数目, k], 余弦相似度，从大到小排列
+            indexes: long tensor, [查询数目, k], 近邻在训练集中的行号
+        """
+        queries = F.normalize(queries.float(), p=2, dim=1)
+        k = min(k, len(self.embeddings))
+        if self.n_lists > 0:
+            return self.__search_ivf(queries, k)
+        similarities = queries.new_full((len(queries), k), -float('inf'))
+        indexes = torch.zeros(len(queries), k, dtype=torch.long)
+        for start in range(0, len(self.embeddings), chunk_size):
+            chunk = self.embeddings[start:start + chunk_size].float()
+            chunk_similarities, chunk_indexes = (queries @ chunk.t()).topk(min(k, len(chunk)), dim=1)
+            similarities, order = torch.cat([similarities, chunk_similarities], dim=1).topk(k, dim=1)
+            indexes = torch.cat([indexes, chunk_indexes + start], dim=1).gather(1, order)
+        return similarities, indexes
+
+    def __search_ivf(self, queries, k):
+        similarities = queries.new_full((len(queries), k), -float('inf'))
+        indexes = torch.zeros(len(queries), k, dtype=torch.long)
+        probes = (queries @ self.list_centroids.t()).topk(self.n_probe, dim=1)[1]
+        for list_index in range(self.n_lists):
+            query_indexes = (probes == list_index).any(dim=1).nonzero().view(-1)
+            start, end = self.list_offsets[list_index].item(), self.list_offsets[list_index + 1].item()
+            if len(query_indexes) == 0 or start == end:
+                continue
+            rows = self.list_order[start:end]
+            list_similarities, list_indexes = (queries[query_indexes] @ self.embeddings[rows].float().t()).topk(
+                min(k, end - start), dim=1)
+            merged_similarities, order = torch.cat([similarities[query_indexes], list_similarities], dim=1).topk(k, dim=1)
+            merged_indexes = torch.cat([indexes[query_indexes], rows[list_indexes]], dim=1).gather(1, order)
+            similarities[query_indexes] = merged_similarities
+            indexes[query_indexes] = merged_indexes
+        return similarities, indexes
+
+    def centroid_similarities(self, queries):
+        """ 查询与各个类中心之间的余弦相似度，[查询数目, num_classes]
+        """
+        return F.normalize(queries.float(), p=2, dim=1) @ self.centroids.t()
+
+    def classify(self, queries, method='centroid', k=10):
+        """ 对查询进行分类，并按照与预测类别的类中心之间的相似度拒识
+
+        Args:
+            queries: float tensor, [查询数目, 特征维度]
+            method: str, centroid: 最近的类中心；knn: k近邻按照相似度加权投票
+            k: int, knn时使用的近邻数目
+        Return:
+            predicts: long tensor, [查询数目], 预测的类别
+            scores: float tensor, [查询数目], centroid时为与预测类别类中心的相似度，knn时为预测类别所占的投票比例
+            rejected: bool tensor, [查询数目], 与预测类别类中心的相似度低于该类别的阈值时为True；未设置阈值时全为False
+        """
+        centroid_similarities = self.centroid_similarities(queries)
+        if method == 'centroid':
+            scores, predicts = centroid_similarities.max(dim=1)
+        elif method == 'knn':
+            similarities, indexes = self.search(queries, k)
+            votes = torch.zeros(len(queries), self.num_classes).scatter_add_(
+                1, self.labels[indexes], similarities.clamp(min=0))
+            scores, predicts = votes.max(dim=1)
+            scores = scores / votes.sum(dim=1).clamp(min=1e-12)
+        else:
+            raise ValueError('Unsupported method: %s' % method)
+        if self.thresholds is None:
+            rejected = torch.zeros(len(queries), dtype=torch.bool)
+        else:
+            rejected = centroid_similarities.gather(1, predicts.view(-1, 1)).view(-1) < self.thresholds[predicts]
+        return predicts, scores, rejected
+
+    def calibrate(self, quantile=0.01):
+        """ 使用训练样本与其类中心之间相似度的分位数作为各类别的拒识阈值
+
+        Args:
+            quantile: float, 训练样本中被拒识的比例
+        Return:
+            thresholds: float tensor, [num_classes]
+        """
+        similarities = (self.embeddings.float() * self.centroids[self.labels]).sum(dim=1)
+        thresholds = torch.full((self.num_classes,), -1.)
+        for label in self.labels.unique():
+            thresholds[label] = torch.quantile(similarities[self.labels == label], quantile)
+        self.thresholds = thresholds
+        return thresholds
+
+    def save(self, path):
+        np.savez(
+            path,
+            embeddings=self.embeddings.numpy(),
+            labels=self.labels.numpy(),
+            num_classes=self.num_classes,
+            n_lists=self.n_lists,
+            n_probe=self.n_probe,
+            sample_names=np.array(self.sample_names if self.sample_names is not None else []),
+            thresholds=self.thresholds.numpy() if self.thresholds is not None else np.zeros(0)
+        )
+
+    @staticmethod
+    def load(path):
+        ''' 读取由save保存的EmbeddingIndex
+        '''
+        data = np.load(path)
+        return EmbeddingIndex(
+            torch.from_numpy(data['embeddings']),
+            torch.from_numpy(data['labels']),
+            int(data['num_classes']),
+            n_lists=int(data['n_lists']),
+            n_probe=int(data['n_probe']),
+            sample_names=data['sample_names'].tolist() or None,
+            thresholds=torch.from_numpy(data['thresholds']) if data['thresholds'].size else None
+        )
+
+
+if __name__ == '__main__':
+    # 暴力检索与IVF检索的召回率与耗时
+    import time
+    torch.manual_seed(0)
+    num_classes, dim = 54, 1024
+    centers = F.normalize(torch.randn(num_classes, dim), dim=1)
+    labels = torch.randint(0, num_classes, (20000,))
+    embeddings = F.normalize(centers[labels] + 0.05 * torch.randn(len(labels), dim), dim=1)
+    queries = F.normalize(centers[labels[:1000]] + 0.05 * torch.randn(1000, dim), dim=1)
+    brute_force = EmbeddingIndex(embeddings, labels, num_classes)
+    ivf = EmbeddingIndex(embeddings, labels, num_classes, n_lists=128, n_probe=8)
+    for name, index in (('brute force', brute_force), ('ivf', ivf)):
+        start = time.perf_counter()
+        _, indexes = index.search(queries, k=10)
+        print('%-12s search: %.1f ms' % (name, (time.perf_counter() - start) * 1000))
+    recall = np.mean([len(set(a.tolist()) & set(b.tolist())) / 10 for a, b in zip(brute_force.search(queries)[1], indexes)])
+    print('ivf recall@10: %.3f' % recall)
+    brute_force.calibrate(0.01)
+    predicts, _, rejected = brute_force.classify(queries)
+    outliers = F.normalize(torch.randn(1000, dim), dim=1)
+    print('accuracy: %.3f, rejected in-distribution: %.3f, rejected outliers: %.3f' % (
+        (predicts == labels[:1000]).float().mean(), rejected.float().mean(), brute_force.classify(outliers)[2].float().mean()))
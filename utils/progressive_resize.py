@@ -0,0 +1,132 @@
+'''
+该文件的功能：渐进式调整训练图片的大小（progressive resizing）
+
+前期使用较小的图片训练，图片大小在progressive_epochs个epoch内线性增大到最终大小，之后保持不变：
+* 每个batch的像素数目（计算量与显存占用）保持不变，图片较小时batch size按照像素数目的比例增大，不超过max_batch_size；
+* 学习率随batch size缩放，linear为线性缩放，sqrt为按平方根缩放（更适合Adam等自适应优化器），none为不缩放；
+* 图片由DataLoader直接读取为当前的大小，不需要在主进程中再调用multi_scale_transforms。
+
+验证集始终使用最终大小，最后若干个epoch使用最终大小训练，使网络适应测试时的分辨率。
+'''
+import math
+
+from torch.utils.data import DataLoader
+
+
+class ProgressiveResize(object):
+    def __init__(self, final_size, start_size, progressive_epochs, base_batch_size, max_batch_size=None,
+                 lr_scale='sqrt', size_divisor=32):
+        """
+        Args:
+            final_size: [height, width], 最终的图片大小
+            start_size: int, 第一个epoch的图片高度，宽度按照相同的比例缩放
+            progressive_epochs: int, 图片大小由start_size增大到final_size所用的epoch数目
+            base_batch_size: int, 最终大小时的batch size
+            max_batch_size: int, 图片较小时batch size的上限，为None时不限制
+            lr_scale: str, 学习率随batch size的缩放方式，linear/sqrt/none
+            size_divisor: int, 图片大小向下取整为size_divisor的整数倍，与网络的总下采样倍数相同
+        """
+        if lr_scale not in ('linear', 'sqrt', 'none'):
+            raise ValueError('Unsupported lr_scale: %s' % lr_scale)
+        self.final_size = list(final_size)
+        self.start_ratio = min(float(start_size) / final_size[0], 1.)
+        self.progressive_epochs = progressive_epochs
+        self.base_batch_size = base_batch_size
+        self.max_batch_size = max_batch_size
+        self.lr_scale = lr_scale
+        self.size_divisor = size_divisor
+
+    def image_size(self, epoch):
+        """
+        Args:
+            epoch: int, 从0开始的epoch序号
+        Return:
+            [height, width], 当前epoch的图片大小
+        """
+        if epoch >= self.progressive_epochs:
+            return list(self.final_size)
+        ratio = self.start_ratio + (1. - self.start_ratio) * epoch / self.progressive_epochs
+        return [max(self.size_divisor, int(length * ratio) // self.size_divisor * self.size_divisor)
+                for length in self.final_size]
+
+    def batch_size(self, image_size):
+        """保持每个batch的像素数目不变时的batch size
+        """
+        pixels_ratio = float(self.final_size[0] * self.final_size[1]) / (image_size[0] * image_size[1])
+        batch_size = max(int(self.base_batch_size * pixels_ratio), self.base_batch_size)
+        if self.max_batch_size:
+            batch_size = min(batch_size, max(self.max_batch_size, self.base_batch_size))
+        return batch_size
+
+    def lr_multiplier(self, batch_size):
+        """学习率相对于最终大小时的倍数
+        """
+        if self.lr_scale == 'linear':
+            return float(batch_size) / self.base_batch_size
+        if self.lr_scale == 'sqrt':
+            return math.sqrt(float(batch_size) / self.base_batch_size)
+        return 1.
+
+    def __call__(self, epoch):
+        """
+        Return:
+            image_size: [height, width]
+            batch_size: int
+            lr_multiplier: float
+        """
+        image_size = self.image_size(epoch)
+        batch_size = self.batch_size(image_size)
+        return image_size, batch_size, self.lr_multiplier(batch_size)
+
+    def total_iterations(self, samples_number, epochs, drop_last=False):
+        """训练epochs个epoch的总迭代次数，用于需要总步数的策略（如稀疏训练的稀疏系数变化）
+        """
+        total = 0
+        for epoch in range(epochs):
+            batch_size = self(epoch)[1]
+            total += samples_number // batch_size if drop_last else int(math.ceil(samples_number / float(batch_size)))
+        return total
+
+
+def resize_loader(loader, image_size, batch_size):
+    """使用新的图片大小与batch size重新创建训练集的DataLoader，sampler等其它设置保持不变
+
+    每个epoch重新创建DataLoader时会重新启动子进程，子进程中的数据集使用新的图片大小。
+
+    Args:
+        loader: DataLoader, 数据集为TrainDataset，且不使用多尺度训练
+        image_size: [height, width]
+        batch_size: int
+    Return:
+        DataLoader
+    """
+    dataset = loader.dataset
+    if not hasattr(dataset, 'size') or getattr(dataset, 'multi_scale', False):
+        raise ValueError('Progressive resizing needs a TrainDataset created with multi_scale=False.')
+    dataset.size = list(image_size)
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        sampler=loader.sampler,
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+        drop_last=loader.drop_last,
+        timeout=loader.timeout,
+        worker_init_fn=loader.worker_init_fn
+    )
+
+
+if __name__ == '__main__':
+    epochs = 50
+    schedule = ProgressiveResize([416, 416], 224, 30, base_batch_size=24, max_batch_size=96)
+    print('%6s %12s %8s %8s %10s' % ('epoch', 'image size', 'batch', 'lr x', 'cost'))
+    total_cost = 0
+    for epoch in range(epochs):
+        image_size, batch_size, lr_multiplier = schedule(epoch)
+        # 一个epoch的计算量近似与图片的像素数目成正比
+        cost = float(image_size[0] * image_size[1]) / (416 * 416)
+        total_cost += cost
+        print('%6d %12s %8d %8.2f %10.2f' % (epoch + 1, 'x'.join(map(str, image_size)), batch_size, lr_multiplier, cost))
+    print('Relative compute of %d epochs: %.2f (%.1f%% of training at 416x416), %d iterations for 10000 samples.' % (
+        epochs, total_cost, total_cost / epochs * 100, schedule.total_iterations(10000, epochs)))
@@ -52,3 +52,47 @@ class ImbalancedDatasetSampler(torch.utils.data.sampler.Sampler):
     def __len__(self):
         return self.num_samples
         
+
+
+class ResumableRandomSampler(torch.utils.data.sampler.Sampler):
+    """随机打乱样本顺序，每个epoch的顺序只由seed与epoch决定
+
+    因此在断点续训时可以直接跳过当前epoch中已经使用过的样本，被跳过的样本不会被读取与解码。
+    Arguments:
+        data_source (Dataset): 数据集
+        seed (int, optional): 随机种子，为None时由torch的随机数生成器产生
+    """
+
+    def __init__(self, data_source, seed=None):
+        self.data_source = data_source
+        if seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_index(self, start_index):
+        """下一次迭代时跳过前start_index个样本，只生效一次
+        """
+        self.start_index = start_index
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.data_source), generator=generator).tolist()
+        start_index, self.start_index = self.start_index, 0
+        return iter(indices[start_index:])
+
+    def __len__(self):
+        return len(self.data_source) - self.start_index
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'start_index': self.start_index}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+        self.start_index = state_dict['start_index']
@@ -17,4 +17,34 @@ def seed_torch(seed):
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed) # if you are using multi-GPU.
     torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
\ No newline at end of file
+    torch.backends.cudnn.deterministic = True
+
+
+def get_rng_state():
+    ''' 得到random、numpy与torch的随机数生成器状态，用于断点续训
+    return: dict, 各个随机数生成器的状态
+    '''
+    numpy_state = np.random.get_state()
+    state = {
+        'random': random.getstate(),
+        # 将numpy数组转换为list，保证保存的文件中只包含基本类型
+        'numpy': (numpy_state[0], numpy_state[1].tolist()) + tuple(numpy_state[2:]),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    ''' 恢复由get_rng_state得到的随机数生成器状态
+    Args:
+        state: dict, 各个随机数生成器的状态
+    return: None
+    '''
+    random.setstate(state['random'])
+    numpy_state = state['numpy']
+    np.random.set_state((numpy_state[0], np.asarray(numpy_state[1], dtype=np.uint32)) + tuple(numpy_state[2:]))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
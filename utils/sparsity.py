@@ -1,45 +1,161 @@
+import math
 import torch
 from torch import nn
+from models.channel_pruning import get_channel_chains, global_threshold, compute_keep_indices
+
+
+def _add_sign_(tensors, sources, alpha):
+    ''' tensors += alpha * sign(sources)，优先使用multi-tensor操作
+    '''
+    if hasattr(torch, '_foreach_sign'):
+        torch._foreach_add_(tensors, torch._foreach_sign(sources), alpha=alpha)
+    else:
+        for tensor, source in zip(tensors, sources):
+            tensor.add_(torch.sign(source), alpha=alpha)
 
 
 class Sparsity:
     """向模型的BN层添加稀疏惩罚
+
+    BN层只在初始化时查找一次，之后每一步使用一次multi-tensor操作完成所有gamma梯度的更新。
     """
 
-    def __init__(self, model, sparsity_scale=1e-4, penalty_type='L1'):
+    def __init__(self, model, sparsity_scale=1e-4, penalty_type='L1', penalty_bias=False, schedule='constant'):
+        '''
+        Args:
+            model: 模型，在此之后不能再替换其中的BN层（如通道剪枝）
+            sparsity_scale: float, 稀疏惩罚系数
+            penalty_type: str, 惩罚类型，目前只支持L1
+            penalty_bias: bool, 是否同时对BN层的beta施加惩罚，使被剪掉通道的输出更接近0
+            schedule: str, 惩罚系数随训练进度的变化方式：
+                constant: 保持不变；
+                linear: 从0线性增大到sparsity_scale，训练初期不限制网络的学习；
+                cosine: 从sparsity_scale按照余弦曲线减小到0，训练后期恢复准确率
+        '''
+        if penalty_type not in ('L1',):
+            raise ValueError('Unsupported penalty type: %s' % penalty_type)
+        if schedule not in ('constant', 'linear', 'cosine'):
+            raise ValueError('Unsupported sparsity schedule: %s' % schedule)
         self.model = model
         self.sparsity_scale = sparsity_scale
         self.penalty_type = penalty_type
+        self.penalty_bias = penalty_bias
+        self.schedule = schedule
+        # 由训练程序在开始训练时设置，schedule不为constant时使用
+        self.total_steps = None
+        self.step_count = 0
 
-        print('penality_type: %s, sparsity_scale: %.5f' % (self.penalty_type, self.sparsity_scale))
+        bns = [m for m in model.modules() if isinstance(m, nn.BatchNorm2d) and m.affine]
+        self.bn_weights = [m.weight for m in bns]
+        self.bn_biases = [m.bias for m in bns]
+        self.penalty_params = self.bn_weights + self.bn_biases if penalty_bias else self.bn_weights
+
+        print('penality_type: %s, sparsity_scale: %.5f, schedule: %s, penalty_bias: %s, bn layers: %d' % (
+            self.penalty_type, self.sparsity_scale, self.schedule, self.penalty_bias, len(bns)))
+
+    def get_scale(self):
+        ''' 当前训练进度下的惩罚系数
+        '''
+        if self.schedule == 'constant' or not self.total_steps:
+            return self.sparsity_scale
+        progress = min(self.step_count / self.total_steps, 1.)
+        if self.schedule == 'linear':
+            return self.sparsity_scale * progress
+        return self.sparsity_scale * 0.5 * (1 + math.cos(math.pi * progress))
 
     def updateBN(self):
         if self.penalty_type == 'L1':
             self.updateBN_L1()
+        self.step_count += 1
 
+    @torch.no_grad()
     def updateBN_L1(self):
-        for m in self.model.modules():
-            if isinstance(m, nn.BatchNorm2d):
-                m.weight.grad.data.add_(self.sparsity_scale * torch.sign(m.weight.data))  # L1
+        params = [p for p in self.penalty_params if p.grad is not None]
+        if params:
+            _add_sign_([p.grad for p in params], params, self.get_scale())  # L1
+
+    @torch.no_grad()
+    def log_gamma(self, writer, step, prune_ratio=None, prune_residual=False, min_keep_ratio=0.1):
+        ''' 将|gamma|的分布写入tensorboard，用于判断何时可以进行剪枝；只拷贝一次数据到CPU，每个epoch调用一次即可
+
+        Args:
+            writer: SummaryWriter
+            step: int, 横坐标
+            prune_ratio: float, 若指定，记录prune_classifier.py按照该比例剪枝时使用的阈值（只在可剪枝的通道组中排序），
+                以及考虑每层至少保留min_keep_ratio的通道后实际剪掉的比例；阈值接近0时剪枝几乎不损失准确率
+            prune_residual: bool, 与prune_classifier.py的--prune_residual相同
+            min_keep_ratio: float, 与prune_classifier.py的--prune_min_keep相同
+        '''
+        gamma = torch.cat([w.detach().abs().float().view(-1) for w in self.bn_weights]).cpu()
+        writer.add_histogram('Sparsity/BNGamma', gamma, step)
+        writer.add_scalar('Sparsity/Scale', self.get_scale(), step)
+        for threshold in (1e-3, 1e-2, 1e-1):
+            writer.add_scalar('Sparsity/GammaBelow%g' % threshold, (gamma < threshold).float().mean().item(), step)
+        if prune_ratio:
+            try:
+                chains = get_channel_chains(self.model, prune_residual)
+            except ValueError:
+                # 不支持通道剪枝的模型
+                return
+            writer.add_scalar('Sparsity/PruneThreshold',
+                              global_threshold([chain.importance() for chain in chains], prune_ratio), step)
+            keep_indices = compute_keep_indices(self.model, prune_ratio, prune_residual, min_keep_ratio)
+            kept = sum(len(indices) for indices in keep_indices.values())
+            writer.add_scalar('Sparsity/PrunedRatio', 1 - kept / sum(chain.channels for chain in chains), step)
+
+
+def _use_foreach(tensors):
+    ''' 与torch.optim相同，只在GPU上使用multi-tensor操作；CPU上multi-tensor操作会一次性分配所有中间结果，
+    对于卷积权重这样的大张量反而比逐个计算更慢
+    '''
+    return hasattr(torch, '_foreach_norm') and len(tensors) > 0 and tensors[0].is_cuda
+
+
+def _norms(tensors, p):
+    ''' 每个张量的p范数，支持反向传播
+    '''
+    if _use_foreach(tensors):
+        return list(torch._foreach_norm(tensors, p))
+    return [torch.norm(tensor, p=p) for tensor in tensors]
 
 
 class Regularization(torch.nn.Module):
-    def __init__(self, model, weight_decay, p=2):
+    def __init__(self, model, weight_decay, p=2, mode='loss'):
         '''
-        :param model 模型
+        :param model 模型，参数列表只在初始化时获取一次
         :param weight_decay:正则化参数
         :param p: 范数计算中的幂指数值，默认求2范数,
                   当p=0为L2正则化,p=1为L1正则化
+        :param mode: 正则化的施加方式：
+                  loss: 将正则项加到损失函数中，由反向传播得到梯度；
+                  grad: 反向传播之后直接将正则项的梯度加到参数的梯度上，不增加计算图，结果与loss相同；
+                  proximal: 优化器更新之后按照学习率对参数做近端（proximal）收缩，与优化器的自适应缩放解耦
         '''
         super(Regularization, self).__init__()
         if weight_decay <= 0:
             print("param weight_decay can not <=0")
             exit(0)
+        if mode not in ('loss', 'grad', 'proximal'):
+            raise ValueError('Unsupported regularization mode: %s' % mode)
+        if mode == 'proximal' and p not in (1, 2):
+            raise ValueError('Proximal regularization only supports p=1 or p=2.')
         self.model = model
         self.weight_decay = weight_decay
         self.p = p
+        self.mode = mode
         self.weight_list = self.get_weight(model)
+        self.weights = [w for _, w in self.weight_list]
         self.weight_info(self.weight_list)
+        # proximal模式下，按照优化器的参数组划分的参数列表，第一次调用时构建
+        self.group_weights = None
+        # grad与proximal模式下最近一次施加的正则项，只用于记录
+        self.last_loss = self._zero_loss()
+
+    def _zero_loss(self):
+        ''' 没有可施加正则项的参数时的正则项，与参数位于同一设备上，保证last_loss始终为tensor
+        '''
+        device = self.weights[0].device if self.weights else None
+        return torch.zeros((), device=device)
 
     def to(self, device):
         '''
@@ -51,10 +167,10 @@ class Regularization(torch.nn.Module):
         super().to(device)
         return self
 
-    def forward(self, model):
-        self.weight_list = self.get_weight(model)  # 获得最新的权重
-        reg_loss = self.regularization_loss(self.weight_list, self.weight_decay, p=self.p)
-        return reg_loss
+    def forward(self, model=None):
+        ''' 返回正则项，mode为loss时使用
+        '''
+        return self.regularization_loss(self.weights, self.weight_decay, p=self.p)
 
     def get_weight(self, model):
         '''
@@ -69,26 +185,95 @@ class Regularization(torch.nn.Module):
                 weight_list.append(weight)
         return weight_list
 
-    def regularization_loss(self, weight_list, weight_decay, p=2):
+    def regularization_loss(self, weights, weight_decay, p=2):
         '''
-        计算张量范数
-        :param weight_list:
+        计算张量范数，GPU上所有张量的范数由一次multi-tensor操作得到
+        :param weights: 参数列表
         :param p: 范数计算中的幂指数值，默认求2范数
         :param weight_decay:
         :return:
         '''
-        # weight_decay=Variable(torch.FloatTensor([weight_decay]).to(self.device),requires_grad=True)
-        # reg_loss=Variable(torch.FloatTensor([0.]).to(self.device),requires_grad=True)
-        # weight_decay=torch.FloatTensor([weight_decay]).to(self.device)
-        # reg_loss=torch.FloatTensor([0.]).to(self.device)
-        reg_loss = 0
-        for name, w in weight_list:
-            l2_reg = torch.norm(w, p=p)
-            reg_loss = reg_loss + l2_reg
-
+        reg_loss = torch.stack(_norms(weights, p)).sum()
         reg_loss = weight_decay * reg_loss
         return reg_loss
 
+    @torch.no_grad()
+    def update_grad(self):
+        ''' mode为grad时，在反向传播之后、优化器更新之前调用，将正则项的梯度直接加到参数的梯度上，
+        正则项的数值在同一次遍历中得到，保存在last_loss中
+        '''
+        weights = [w for w in self.weights if w.grad is not None]
+        if not weights:
+            self.last_loss = self._zero_loss()
+            return
+        grads = [w.grad for w in weights]
+        if self.p == 1 and _use_foreach(weights):
+            torch._foreach_add_(grads, torch._foreach_sign(weights), alpha=self.weight_decay)
+            reg_loss = torch.stack(torch._foreach_norm(weights, 1)).sum()
+        elif self.p == 1:
+            reg_loss = 0
+            for w, grad in zip(weights, grads):
+                sign = torch.sign(w)
+                grad.add_(sign, alpha=self.weight_decay)
+                # sum(|w|) = <w, sign(w)>，不需要额外的中间结果
+                reg_loss = reg_loss + torch.dot(w.reshape(-1), sign.view(-1))
+        elif self.p == 2:
+            # ||w||_2的梯度为w / ||w||_2
+            norms = _norms(weights, 2)
+            scales = [self.weight_decay / norm.clamp_min(1e-12) for norm in norms]
+            if _use_foreach(weights):
+                torch._foreach_add_(grads, torch._foreach_mul(weights, scales))
+            else:
+                for w, grad, scale in zip(weights, grads, scales):
+                    grad.add_(w, alpha=scale.item())
+            reg_loss = torch.stack(norms).sum()
+        else:
+            # ||w||_p的梯度为sign(w) * |w|^(p-1) / ||w||_p^(p-1)
+            norms = _norms(weights, self.p)
+            for w, grad, norm in zip(weights, grads, norms):
+                grad.add_(torch.sign(w) * w.abs().pow(self.p - 1) / norm.clamp_min(1e-12).pow(self.p - 1),
+                          alpha=self.weight_decay)
+            reg_loss = torch.stack(norms).sum()
+        self.last_loss = self.weight_decay * reg_loss
+
+    @torch.no_grad()
+    def proximal_step(self, optimizer):
+        ''' mode为proximal时，在优化器更新之后调用：
+        p=1时为软阈值 w = sign(w) * max(|w| - lr * weight_decay, 0)；
+        p=2时为整体收缩 w = w * max(1 - lr * weight_decay / ||w||, 0)。
+        收缩后参数的正则项保存在last_loss中
+        '''
+        if self.group_weights is None:
+            ids = set(id(w) for w in self.weights)
+            self.group_weights = [[w for w in group['params'] if id(w) in ids] for group in optimizer.param_groups]
+        reg_loss = self._zero_loss()
+        for group, weights in zip(optimizer.param_groups, self.group_weights):
+            if not weights:
+                continue
+            threshold = group['lr'] * self.weight_decay
+            if self.p == 1 and _use_foreach(weights):
+                shrunk = torch._foreach_abs(weights)
+                torch._foreach_sub_(shrunk, threshold)
+                torch._foreach_clamp_min_(shrunk, 0.)
+                reg_loss = reg_loss + torch.stack(torch._foreach_norm(shrunk, 1)).sum()
+                torch._foreach_mul_(shrunk, torch._foreach_sign(weights))
+                torch._foreach_copy_(weights, shrunk)
+            elif self.p == 1:
+                for w in weights:
+                    shrunk = w.abs().sub_(threshold).clamp_min_(0.)
+                    reg_loss = reg_loss + shrunk.sum()
+                    w.copy_(shrunk.mul_(torch.sign(w)))
+            else:
+                norms = _norms(weights, 2)
+                scales = [(1. - threshold / norm.clamp_min(1e-12)).clamp_min(0.) for norm in norms]
+                if _use_foreach(weights):
+                    torch._foreach_mul_(weights, scales)
+                else:
+                    for w, scale in zip(weights, scales):
+                        w.mul_(scale)
+                reg_loss = reg_loss + sum(norm * scale for norm, scale in zip(norms, scales))
+        self.last_loss = self.weight_decay * reg_loss
+
     def weight_info(self, weight_list):
         '''
         打印权重列表信息
@@ -99,3 +284,32 @@ class Regularization(torch.nn.Module):
         for name, w in weight_list:
             print(name)
         print("---------------------------------------------------")
+
+
+if __name__ == '__main__':
+    import time
+    import pretrainedmodels
+
+    model = pretrainedmodels.se_resnext101_32x4d(pretrained=None)
+    for p in model.parameters():
+        p.grad = torch.randn_like(p)
+    reference = [m.weight.grad.clone() for m in model.modules() if isinstance(m, nn.BatchNorm2d)]
+
+    # 原实现：每一步遍历所有模块，逐层更新
+    start = time.perf_counter()
+    for _ in range(20):
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.weight.grad.data.add_(1e-4 * torch.sign(m.weight.data))
+    loop_time = (time.perf_counter() - start) / 20 * 1000
+    expected = [m.weight.grad.clone() for m in model.modules() if isinstance(m, nn.BatchNorm2d)]
+
+    for m, grad in zip([m for m in model.modules() if isinstance(m, nn.BatchNorm2d)], reference):
+        m.weight.grad.copy_(grad)
+    sparsity = Sparsity(model, sparsity_scale=1e-4)
+    start = time.perf_counter()
+    for _ in range(20):
+        sparsity.updateBN()
+    foreach_time = (time.perf_counter() - start) / 20 * 1000
+    error = max((w.grad - e).abs().max().item() for w, e in zip(sparsity.bn_weights, expected))
+    print('loop: %.3fms, foreach: %.3fms, max error: %g' % (loop_time, foreach_time, error))
@@ -24,6 +24,17 @@ class DelayerScheduler(_LRScheduler):
 
 		return self.base_lrs
 
+	def state_dict(self):
+		state = {key: value for key, value in self.__dict__.items() if key not in ('optimizer', 'after_scheduler')}
+		state['after_scheduler'] = self.after_scheduler.state_dict()
+		return state
+
+	def load_state_dict(self, state_dict):
+		state_dict = dict(state_dict)
+		after_scheduler_state = state_dict.pop('after_scheduler')
+		self.__dict__.update(state_dict)
+		self.after_scheduler.load_state_dict(after_scheduler_state)
+
 	def step(self, epoch=None):
 		if self.finished:
 			if epoch is None:
@@ -5,3 +5,5 @@ from .over9000 import Over9000, RangerLars
 from .ralamb import Ralamb
 from .novograd import Novograd
 from .lamb import Lamb
+from .multi_tensor import ForeachRAdam, ForeachPlainRAdam, ForeachAdamW, ForeachRalamb, ForeachLamb, ForeachNovograd, \
+    ForeachLookahead, ForeachRanger, ForeachRangerLars
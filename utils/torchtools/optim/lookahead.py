@@ -11,10 +11,45 @@ Paper: `Lookahead Optimizer: k steps forward, 1 step back` - https://arxiv.org/a
 import torch
 from torch.optim.optimizer import Optimizer
 from collections import defaultdict
+from itertools import chain
+
+
+def _interpolate(fast, slow, alpha):
+    """slow += alpha * (fast - slow)，然后用slow覆盖fast"""
+    if slow.dtype == fast.dtype:
+        slow.add_(fast - slow, alpha=alpha)
+        fast.copy_(slow)
+    else:
+        # 慢权重为低精度时直接在快权重上计算插值，不需要分配与参数同样大小的临时变量
+        fast.sub_(slow).mul_(alpha).add_(slow)
+        slow.copy_(fast)
+
+
+def _interpolate_flat(fast, slow, alpha, chunk_size=2 ** 16):
+    """对展平的一维buffer分块插值：临时变量只有chunk_size大小，可以留在cache中，也不会每次都重新申请大块内存"""
+    for start in range(0, fast.numel(), chunk_size):
+        _interpolate(fast[start:start + chunk_size], slow[start:start + chunk_size], alpha)
+
+
+def _view_like(flat, param):
+    """把一段一维buffer看作与param形状相同、内存排布也相同的张量，channels_last的卷积核仍然为channels_last"""
+    if param.dim() == 4 and not param.is_contiguous() and param.is_contiguous(memory_format=torch.channels_last):
+        n, c, h, w = param.shape
+        return flat.view(n, h, w, c).permute(0, 3, 1, 2)
+    return flat.view_as(param)
 
 
 class Lookahead(Optimizer):
-    def __init__(self, base_optimizer, alpha=0.5, k=6):
+    def __init__(self, base_optimizer, alpha=0.5, k=6, flatten=False, slow_dtype=None):
+        """
+        Args:
+            base_optimizer: 快权重使用的优化器
+            alpha: 慢权重的更新率
+            k: 每k步更新一次慢权重
+            flatten: 是否将每个param_group的参数放入一块连续的内存，慢权重也保存在一块连续的内存中，
+                这样每次更新慢权重只需要几次向量运算；参数被替换为这块内存的view，需要在模型移动到目标设备后再创建优化器
+            slow_dtype: 慢权重的数据类型，例如torch.float16，为None时与参数相同
+        """
         if not 0.0 <= alpha <= 1.0:
             raise ValueError(f'Invalid slow update rate: {alpha}')
         if not 1 <= k:
@@ -30,17 +65,78 @@ class Lookahead(Optimizer):
             for group in self.param_groups:
                 group.setdefault(name, default)
 
+        self.slow_dtype = slow_dtype
+        # 与param_groups一一对应，不能展平的group为None；不放在param_groups中，以免被保存到state_dict中
+        self.flat_groups = [self.__flatten_group(group) if flatten else None for group in self.param_groups]
+
+    def __flatten_group(self, group):
+        params = group['params']
+        if not params:
+            return None
+        dtype, device = params[0].dtype, params[0].device
+        if any(p.dtype != dtype or p.device != device or p.is_sparse for p in params):
+            print('Params in a group have different dtypes or devices, Lookahead is not flattened.')
+            return None
+        fast = torch.empty(sum(p.numel() for p in params), dtype=dtype, device=device)
+        offset = 0
+        for p in params:
+            numel = p.numel()
+            fast_view = _view_like(fast[offset:offset + numel], p.data)
+            fast_view.copy_(p.data)
+            p.data = fast_view
+            offset += numel
+        return {'fast': fast, 'slow': None, 'data_ptrs': [p.data.data_ptr() for p in params]}
+
+    def __get_flat_group(self, group):
+        index = next((i for i, g in enumerate(self.param_groups) if g is group), None)
+        flat_group = self.flat_groups[index] if index is not None and index < len(self.flat_groups) else None
+        if flat_group is None:
+            return None
+        if [p.data.data_ptr() for p in group['params']] != flat_group['data_ptrs']:
+            # 参数的data被替换（如模型被移动到了其它设备），不再是展平内存的view，退化为逐个参数更新
+            print('Params are no longer views of the flat buffer, Lookahead falls back to per-param update.')
+            self.flat_groups[index] = None
+            return None
+        if flat_group['slow'] is None:
+            self.__build_flat_slow(group, flat_group)
+        return flat_group
+
+    def __build_flat_slow(self, group, flat_group):
+        """分配连续的慢权重，已有的慢权重被拷贝进来，其余的与原实现一样初始化为当前的快权重"""
+        fast = flat_group['fast']
+        slow = torch.empty_like(fast, dtype=self.slow_dtype or fast.dtype)
+        offset = 0
+        for p in group['params']:
+            numel = p.numel()
+            slow_view = _view_like(slow[offset:offset + numel], p.data)
+            param_state = self.state[p]
+            slow_view.copy_(param_state['slow_buffer'] if 'slow_buffer' in param_state else p.data)
+            # state中仍然为每个参数保存一个慢权重，只不过是连续内存的view，state_dict的格式不变
+            param_state['slow_buffer'] = slow_view
+            offset += numel
+        flat_group['slow'] = slow
+
     def update_slow(self, group):
+        flat_group = self.__get_flat_group(group)
+        if flat_group is not None:
+            _interpolate_flat(flat_group['fast'], flat_group['slow'], group['lookahead_alpha'])
+            return
+        fast_params, slow_buffers = [], []
         for fast_p in group["params"]:
             if fast_p.grad is None:
                 continue
             param_state = self.state[fast_p]
             if 'slow_buffer' not in param_state:
-                param_state['slow_buffer'] = torch.empty_like(fast_p.data)
+                param_state['slow_buffer'] = torch.empty_like(fast_p.data, dtype=self.slow_dtype or fast_p.dtype)
                 param_state['slow_buffer'].copy_(fast_p.data)
-            slow = param_state['slow_buffer']
-            slow.add_(group['lookahead_alpha'], fast_p.data - slow)
-            fast_p.data.copy_(slow)
+            fast_params.append(fast_p.data)
+            slow_buffers.append(param_state['slow_buffer'])
+        if fast_params:
+            self._update_slow_params(fast_params, slow_buffers, group['lookahead_alpha'])
+
+    def _update_slow_params(self, fast_params, slow_buffers, alpha):
+        for fast, slow in zip(fast_params, slow_buffers):
+            _interpolate(fast, slow, alpha)
 
     def sync_lookahead(self):
         for group in self.param_groups:
@@ -58,9 +154,16 @@ class Lookahead(Optimizer):
 
     def state_dict(self):
         fast_state_dict = self.base_optimizer.state_dict()
+        # key the slow state exactly like the base optimizer keys its params so that
+        # it can be matched to the params of a freshly built optimizer on resume
+        param_keys = {}
+        for group, packed_group in zip(self.param_groups, fast_state_dict['param_groups']):
+            for p, key in zip(group['params'], packed_group['params']):
+                param_keys[id(p)] = key
         slow_state = {
-            (id(k) if isinstance(k, torch.Tensor) else k): v
+            param_keys[id(k)]: v
             for k, v in self.state.items()
+            if id(k) in param_keys
         }
         fast_state = fast_state_dict['state']
         param_groups = fast_state_dict['param_groups']
@@ -76,25 +179,36 @@ class Lookahead(Optimizer):
             'param_groups': state_dict['param_groups'],
         }
         self.base_optimizer.load_state_dict(fast_state_dict)
+        self.param_groups = self.base_optimizer.param_groups  # make both ref same container
+        # reapply defaults to catch missing lookahead specific ones
+        for name, default in self.defaults.items():
+            for group in self.param_groups:
+                group.setdefault(name, default)
 
-        # We want to restore the slow state, but share param_groups reference
-        # with base_optimizer. This is a bit redundant but least code
-        slow_state_new = False
         if 'slow_state' not in state_dict:
             print('Loading state_dict from optimizer without Lookahead applied.')
-            state_dict['slow_state'] = defaultdict(dict)
-            slow_state_new = True
-        slow_state_dict = {
-            'state': state_dict['slow_state'],
-            'param_groups': state_dict['param_groups'],  # this is pointless but saves code
-        }
-        super(Lookahead, self).load_state_dict(slow_state_dict)
-        self.param_groups = self.base_optimizer.param_groups  # make both ref same container
-        if slow_state_new:
-            # reapply defaults to catch missing lookahead specific ones
-            for name, default in self.defaults.items():
-                for group in self.param_groups:
-                    group.setdefault(name, default)
+        saved_keys = chain.from_iterable(g['params'] for g in state_dict['param_groups'])
+        params = chain.from_iterable(g['params'] for g in self.param_groups)
+        key_to_param = dict(zip(saved_keys, params))
+        self.state = defaultdict(dict)
+        skipped = 0
+        for key, param_state in state_dict.get('slow_state', {}).items():
+            if key not in key_to_param:
+                skipped += 1
+                continue
+            p = key_to_param[key]
+            self.state[p] = {
+                name: value.to(device=p.device, dtype=self.slow_dtype or p.dtype, copy=True) if isinstance(value, torch.Tensor) else value
+                for name, value in param_state.items()
+            }
+        if skipped:
+            print('Skipping %d slow buffers that do not match any param.' % skipped)
+        # 展平时将加载的慢权重拷贝到连续内存中
+        for group, flat_group in zip(self.param_groups, self.flat_groups):
+            if flat_group is not None:
+                flat_group['slow'] = None
+                if any('slow_buffer' in self.state[p] for p in group['params']):
+                    self.__get_flat_group(group)
 
 
 def LookaheadAdam(params, alpha=0.5, k=6, *args, **kwargs):
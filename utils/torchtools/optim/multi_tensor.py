@@ -0,0 +1,517 @@
+####
+# Multi-tensor (foreach) versions of the optimizers in this package.
+#
+# Each optimizer subclasses the original implementation and only overrides `step`, so the
+# hyper-parameters, the param_groups and the per-param state (and therefore the state_dict)
+# are exactly the same as the original ones. Instead of issuing several small ops per param
+# in a Python loop, the params of a group are gathered into lists and updated with
+# `torch._foreach_*` ops. When the installed torch does not provide them, the helpers below
+# fall back to a plain loop so the results are still the same.
+####
+
+import math
+import torch
+from .lookahead import Lookahead
+from .radam import RAdam, PlainRAdam, AdamW
+from .ralamb import Ralamb
+from .lamb import Lamb
+from .novograd import Novograd
+
+
+def _has_foreach(name):
+    return hasattr(torch, '_foreach_' + name)
+
+
+def _mul_(tensors, scalars):
+    if _has_foreach('mul_'):
+        torch._foreach_mul_(tensors, scalars)
+        return
+    if not isinstance(scalars, list):
+        scalars = [scalars] * len(tensors)
+    for tensor, scalar in zip(tensors, scalars):
+        tensor.mul_(scalar)
+
+
+def _div_(tensors, scalars):
+    if _has_foreach('div_'):
+        torch._foreach_div_(tensors, scalars)
+        return
+    for tensor, scalar in zip(tensors, scalars):
+        tensor.div_(scalar)
+
+
+def _add_(tensors, others, alpha=1):
+    if _has_foreach('add_'):
+        torch._foreach_add_(tensors, others, alpha=alpha)
+        return
+    for tensor, other in zip(tensors, others):
+        tensor.add_(other, alpha=alpha)
+
+
+def _add_scalar_(tensors, scalar):
+    if _has_foreach('add_'):
+        torch._foreach_add_(tensors, scalar)
+        return
+    for tensor in tensors:
+        tensor.add_(scalar)
+
+
+def _addcmul_(tensors, tensors1, tensors2, value):
+    if _has_foreach('addcmul_'):
+        torch._foreach_addcmul_(tensors, tensors1, tensors2, value)
+        return
+    for tensor, tensor1, tensor2 in zip(tensors, tensors1, tensors2):
+        tensor.addcmul_(tensor1, tensor2, value=value)
+
+
+def _addcdiv_(tensors, tensors1, tensors2, values):
+    if _has_foreach('addcdiv_'):
+        torch._foreach_addcdiv_(tensors, tensors1, tensors2, values)
+        return
+    if not isinstance(values, list):
+        values = [values] * len(tensors)
+    for tensor, tensor1, tensor2, value in zip(tensors, tensors1, tensors2, values):
+        tensor.addcdiv_(tensor1, tensor2, value=value)
+
+
+def _sqrt(tensors):
+    if _has_foreach('sqrt'):
+        return list(torch._foreach_sqrt(tensors))
+    return [tensor.sqrt() for tensor in tensors]
+
+
+def _sub(tensors, others):
+    if _has_foreach('sub'):
+        return list(torch._foreach_sub(tensors, others))
+    return [tensor - other for tensor, other in zip(tensors, others)]
+
+
+def _add(tensors, others, alpha=1):
+    if _has_foreach('add'):
+        return list(torch._foreach_add(tensors, others, alpha=alpha))
+    return [tensor.add(other, alpha=alpha) for tensor, other in zip(tensors, others)]
+
+
+def _div(tensors, others):
+    if _has_foreach('div'):
+        return list(torch._foreach_div(tensors, others))
+    return [tensor / other for tensor, other in zip(tensors, others)]
+
+
+def _norm(tensors):
+    """返回每一个tensor的L2范数，结果为一维tensor"""
+    if _has_foreach('norm'):
+        return torch.stack(torch._foreach_norm(tensors))
+    return torch.stack([tensor.pow(2).sum().sqrt() for tensor in tensors])
+
+
+def _copy_(tensors, sources):
+    if _has_foreach('copy_'):
+        torch._foreach_copy_(tensors, sources)
+        return
+    for tensor, source in zip(tensors, sources):
+        tensor.copy_(source)
+
+
+def _copy_back(params, params_fp32):
+    """params不是fp32时，将fp32的拷贝写回；是fp32时p.data.float()返回的就是p.data本身"""
+    for p, p_data_fp32 in zip(params, params_fp32):
+        if p.data.dtype != torch.float32:
+            p.data.copy_(p_data_fp32)
+
+
+def _init_adam_state(p_data):
+    return {
+        'step': 0,
+        'exp_avg': torch.zeros_like(p_data),
+        'exp_avg_sq': torch.zeros_like(p_data)
+    }
+
+
+def _group_buckets(optimizer, group, name, init_state, cast_fp32=True, split_by_step=True):
+    """收集group中有梯度的参数，初始化其状态并将step加一
+
+    step与设备相同的参数被放入同一个桶中，同一个桶中的参数共享与step有关的标量，可以用一组foreach操作完成更新。
+
+    Args:
+        optimizer: 优化器
+        group: param_group
+        name: 优化器的名称，用于报错
+        init_state: 由参数得到初始状态的函数
+        cast_fp32: 是否与原实现一样将参数、梯度与状态转换为fp32
+        split_by_step: 是否按照step分桶
+    Return:
+        list, 每一项为(step, params, params_data, grads, states)
+    """
+    buckets = {}
+    for p in group['params']:
+        if p.grad is None:
+            continue
+        grad = p.grad.data.float() if cast_fp32 else p.grad.data
+        if grad.is_sparse:
+            raise RuntimeError('%s does not support sparse gradients' % name)
+        p_data = p.data.float() if cast_fp32 else p.data
+
+        state = optimizer.state[p]
+        if len(state) == 0:
+            state.update(init_state(p_data))
+        elif cast_fp32:
+            state['exp_avg'] = state['exp_avg'].type_as(p_data)
+            state['exp_avg_sq'] = state['exp_avg_sq'].type_as(p_data)
+        state['step'] += 1
+
+        key = (state['step'] if split_by_step else None, p_data.device)
+        bucket = buckets.setdefault(key, ([], [], [], []))
+        bucket[0].append(p)
+        bucket[1].append(p_data)
+        bucket[2].append(grad)
+        bucket[3].append(state)
+    return [(key[0],) + bucket for key, bucket in buckets.items()]
+
+
+def _update_moments(exp_avgs, exp_avg_sqs, grads, beta1, beta2):
+    _mul_(exp_avg_sqs, beta2)
+    _addcmul_(exp_avg_sqs, grads, grads, 1 - beta2)
+    _mul_(exp_avgs, beta1)
+    _add_(exp_avgs, grads, alpha=1 - beta1)
+
+
+def _radam_step_size(buffer, step, beta1, beta2, degenerated_to_sgd=True):
+    """与RAdam中的计算完全相同，并复用其缓存"""
+    buffered = buffer[int(step % 10)]
+    if step == buffered[0]:
+        N_sma, step_size = buffered[1], buffered[2]
+    else:
+        buffered[0] = step
+        beta2_t = beta2 ** step
+        N_sma_max = 2 / (1 - beta2) - 1
+        N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+        buffered[1] = N_sma
+
+        # more conservative since it's an approximated value
+        if N_sma >= 5:
+            step_size = math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+        elif degenerated_to_sgd:
+            step_size = 1.0 / (1 - beta1 ** step)
+        else:
+            step_size = -1
+        buffered[2] = step_size
+    return N_sma, step_size
+
+
+def _trust_ratio(weight_norm, update_norm):
+    """weight_norm或update_norm为0时trust_ratio为1"""
+    valid = (weight_norm != 0) & (update_norm != 0)
+    return torch.where(valid, weight_norm / torch.where(valid, update_norm, torch.ones_like(update_norm)),
+                       torch.ones_like(weight_norm))
+
+
+class ForeachRAdam(RAdam):
+    """RAdam的multi-tensor实现，超参数与state与RAdam相同"""
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for step, params, params_fp32, grads, states in _group_buckets(self, group, 'RAdam', _init_adam_state):
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+                _update_moments(exp_avgs, exp_avg_sqs, grads, beta1, beta2)
+
+                N_sma, step_size = _radam_step_size(group['buffer'], step, beta1, beta2, self.degenerated_to_sgd)
+                if N_sma < 5 and step_size <= 0:
+                    continue
+                if group['weight_decay'] != 0:
+                    _add_(params_fp32, params_fp32, alpha=-group['weight_decay'] * group['lr'])
+                if N_sma >= 5:
+                    denom = _sqrt(exp_avg_sqs)
+                    _add_scalar_(denom, group['eps'])
+                    _addcdiv_(params_fp32, exp_avgs, denom, -step_size * group['lr'])
+                else:
+                    _add_(params_fp32, exp_avgs, alpha=-step_size * group['lr'])
+                _copy_back(params, params_fp32)
+
+        return loss
+
+
+class ForeachPlainRAdam(PlainRAdam):
+    """PlainRAdam的multi-tensor实现，超参数与state与PlainRAdam相同"""
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for step, params, params_fp32, grads, states in _group_buckets(self, group, 'RAdam', _init_adam_state):
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+                _update_moments(exp_avgs, exp_avg_sqs, grads, beta1, beta2)
+
+                beta2_t = beta2 ** step
+                N_sma_max = 2 / (1 - beta2) - 1
+                N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+
+                if N_sma < 5 and not self.degenerated_to_sgd:
+                    continue
+                if group['weight_decay'] != 0:
+                    _add_(params_fp32, params_fp32, alpha=-group['weight_decay'] * group['lr'])
+                if N_sma >= 5:
+                    step_size = group['lr'] * math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+                    denom = _sqrt(exp_avg_sqs)
+                    _add_scalar_(denom, group['eps'])
+                    _addcdiv_(params_fp32, exp_avgs, denom, -step_size)
+                else:
+                    step_size = group['lr'] / (1 - beta1 ** step)
+                    _add_(params_fp32, exp_avgs, alpha=-step_size)
+                _copy_back(params, params_fp32)
+
+        return loss
+
+
+class ForeachAdamW(AdamW):
+    """AdamW（带warmup）的multi-tensor实现，超参数与state与AdamW相同"""
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for step, params, params_fp32, grads, states in _group_buckets(self, group, 'Adam', _init_adam_state):
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+                _update_moments(exp_avgs, exp_avg_sqs, grads, beta1, beta2)
+
+                denom = _sqrt(exp_avg_sqs)
+                _add_scalar_(denom, group['eps'])
+                bias_correction1 = 1 - beta1 ** step
+                bias_correction2 = 1 - beta2 ** step
+
+                if group['warmup'] > step:
+                    scheduled_lr = 1e-8 + step * group['lr'] / group['warmup']
+                else:
+                    scheduled_lr = group['lr']
+
+                step_size = scheduled_lr * math.sqrt(bias_correction2) / bias_correction1
+
+                if group['weight_decay'] != 0:
+                    _add_(params_fp32, params_fp32, alpha=-group['weight_decay'] * scheduled_lr)
+                _addcdiv_(params_fp32, exp_avgs, denom, -step_size)
+                _copy_back(params, params_fp32)
+
+        return loss
+
+
+class ForeachRalamb(Ralamb):
+    """Ralamb（RAdam + LARS）的multi-tensor实现，超参数与state与Ralamb相同
+
+    每一个参数的trust_ratio一起计算，每个桶只需要一次设备到主机的同步。
+    """
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for step, params, params_fp32, grads, states in _group_buckets(self, group, 'Ralamb', _init_adam_state):
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+                _update_moments(exp_avgs, exp_avg_sqs, grads, beta1, beta2)
+
+                N_sma, radam_step_size = _radam_step_size(self.buffer, step, beta1, beta2)
+
+                if group['weight_decay'] != 0:
+                    _add_(params_fp32, params_fp32, alpha=-group['weight_decay'] * group['lr'])
+
+                # more conservative since it's an approximated value
+                if N_sma >= 5:
+                    denom = _sqrt(exp_avg_sqs)
+                    _add_scalar_(denom, group['eps'])
+                    updates = _div(exp_avgs, denom)
+                else:
+                    updates = [exp_avg.clone() for exp_avg in exp_avgs]
+                radam_steps = _add(params_fp32, updates, alpha=-radam_step_size * group['lr'])
+
+                radam_norms = _norm(radam_steps)
+                del radam_steps
+                weight_norms = _norm([p.data for p in params]).clamp(0, 10)
+                trust_ratios = _trust_ratio(weight_norms, radam_norms)
+                for state, weight_norm, radam_norm, trust_ratio in zip(
+                        states, weight_norms.unbind(), radam_norms.unbind(), trust_ratios.unbind()):
+                    state['weight_norm'] = weight_norm
+                    state['adam_norm'] = radam_norm
+                    state['trust_ratio'] = trust_ratio
+
+                _mul_(updates, (trust_ratios * (-radam_step_size * group['lr'])).tolist())
+                _add_(params_fp32, updates)
+                _copy_back(params, params_fp32)
+
+        return loss
+
+
+class ForeachLamb(Lamb):
+    """Lamb的multi-tensor实现，超参数与state与Lamb相同"""
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            buckets = _group_buckets(self, group, 'Lamb', _init_adam_state, cast_fp32=False, split_by_step=False)
+            for _, params, params_data, grads, states in buckets:
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+                _update_moments(exp_avgs, exp_avg_sqs, grads, beta1, beta2)
+
+                # Paper v3 does not use debiasing.
+                step_size = group['lr']
+
+                weight_norms = _norm(params_data).clamp(0, 10)
+
+                denom = _sqrt(exp_avg_sqs)
+                _add_scalar_(denom, group['eps'])
+                adam_steps = _div(exp_avgs, denom)
+                if group['weight_decay'] != 0:
+                    _add_(adam_steps, params_data, alpha=group['weight_decay'])
+
+                adam_norms = _norm(adam_steps)
+                trust_ratios = _trust_ratio(weight_norms, adam_norms)
+                for state, weight_norm, adam_norm, trust_ratio in zip(
+                        states, weight_norms.unbind(), adam_norms.unbind(), trust_ratios.unbind()):
+                    state['weight_norm'] = weight_norm
+                    state['adam_norm'] = adam_norm
+                    state['trust_ratio'] = trust_ratio
+                if self.adam:
+                    trust_ratios = torch.ones_like(trust_ratios)
+
+                _mul_(adam_steps, (trust_ratios * -step_size).tolist())
+                _add_(params_data, adam_steps)
+
+        return loss
+
+
+class ForeachNovograd(Novograd):
+    """Novograd的multi-tensor实现，超参数与state与Novograd相同
+
+    与原实现一样，梯度会被原地修改。
+    """
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        for group in self.param_groups:
+            amsgrad = group['amsgrad']
+            beta1, beta2 = group['betas']
+
+            def init_state(p_data):
+                state = {
+                    'step': 0,
+                    'exp_avg': torch.zeros_like(p_data),
+                    'exp_avg_sq': torch.zeros([]).to(p_data.device)
+                }
+                if amsgrad:
+                    state['max_exp_avg_sq'] = torch.zeros([]).to(p_data.device)
+                return state
+
+            buckets = _group_buckets(self, group, 'Novograd', init_state, cast_fp32=False, split_by_step=False)
+            for _, params, params_data, grads, states in buckets:
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+
+                norms = _norm(grads).pow(2)
+                exp_avg_sq = torch.stack(exp_avg_sqs)
+                exp_avg_sq = torch.where(exp_avg_sq == 0, norms, exp_avg_sq * beta2 + (1 - beta2) * norms)
+                _copy_(exp_avg_sqs, list(exp_avg_sq.unbind()))
+
+                if amsgrad:
+                    max_exp_avg_sqs = [state['max_exp_avg_sq'] for state in states]
+                    # Maintains the maximum of all 2nd moment running avg. till now
+                    max_exp_avg_sq = torch.max(torch.stack(max_exp_avg_sqs), exp_avg_sq)
+                    _copy_(max_exp_avg_sqs, list(max_exp_avg_sq.unbind()))
+                    denom = max_exp_avg_sq.sqrt() + group['eps']
+                else:
+                    denom = exp_avg_sq.sqrt() + group['eps']
+
+                _div_(grads, denom.tolist())
+                if group['weight_decay'] != 0:
+                    _add_(grads, params_data, alpha=group['weight_decay'])
+                if group['grad_averaging']:
+                    _mul_(grads, 1 - beta1)
+                _mul_(exp_avgs, beta1)
+                _add_(exp_avgs, grads)
+
+                _add_(params_data, exp_avgs, alpha=-group['lr'])
+
+        return loss
+
+
+class ForeachLookahead(Lookahead):
+    """Lookahead的multi-tensor实现，慢权重的更新由foreach操作完成，state与Lookahead相同"""
+
+    def _update_slow_params(self, fast_params, slow_buffers, alpha):
+        if any(slow.dtype != fast.dtype for fast, slow in zip(fast_params, slow_buffers)):
+            super(ForeachLookahead, self)._update_slow_params(fast_params, slow_buffers, alpha)
+            return
+        _add_(slow_buffers, _sub(fast_params, slow_buffers), alpha=alpha)
+        _copy_(fast_params, slow_buffers)
+
+
+def ForeachRanger(params, alpha=0.5, k=6, betas=(.95, 0.999), flatten=False, slow_dtype=None, *args, **kwargs):
+    radam = ForeachRAdam(params, betas=betas, *args, **kwargs)
+    return ForeachLookahead(radam, alpha, k, flatten=flatten, slow_dtype=slow_dtype)
+
+
+def ForeachRangerLars(params, alpha=0.5, k=6, flatten=False, slow_dtype=None, *args, **kwargs):
+    ralamb = ForeachRalamb(params, *args, **kwargs)
+    return ForeachLookahead(ralamb, alpha, k, flatten=flatten, slow_dtype=slow_dtype)
+
+
+if __name__ == '__main__':
+    # 与原实现比较：相同的初始权重与梯度下更新若干步，两者的权重应当一致
+    # 运行方式：python -m utils.torchtools.optim.multi_tensor
+    from .ranger import Ranger
+    from .over9000 import RangerLars
+
+    def run(optimizer_class, steps=12):
+        torch.manual_seed(0)
+        model = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 8, 3), torch.nn.BatchNorm2d(8), torch.nn.ReLU(),
+            torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(), torch.nn.Linear(8, 5)
+        )
+        params = [
+            {'params': list(model[:2].parameters()), 'lr': 1e-4},
+            {'params': list(model[5].parameters()), 'lr': 1e-3}
+        ]
+        optimizer = optimizer_class(params, weight_decay=1e-4)
+        inputs, targets = torch.randn(4, 3, 8, 8), torch.randint(0, 5, (4,))
+        for step in range(steps):
+            optimizer.zero_grad()
+            torch.nn.functional.cross_entropy(model(inputs), targets).backward()
+            if isinstance(optimizer, Lookahead):
+                # 较新的torch中Lookahead.step无法调用，直接更新快权重并每k步同步一次慢权重，两种实现的调用方式相同
+                optimizer.base_optimizer.step()
+                if (step + 1) % 6 == 0:
+                    optimizer.sync_lookahead()
+            else:
+                optimizer.step()
+        return [p.detach() for p in model.parameters()]
+
+    pairs = [(RAdam, ForeachRAdam), (PlainRAdam, ForeachPlainRAdam), (AdamW, ForeachAdamW), (Ralamb, ForeachRalamb),
+             (Lamb, ForeachLamb), (Novograd, ForeachNovograd), (Ranger, ForeachRanger), (RangerLars, ForeachRangerLars)]
+    for original, foreach in pairs:
+        expected, result = run(original), run(foreach)
+        error = max((a - b).abs().max().item() for a, b in zip(expected, result))
+        print('%s: max error %.2e' % (foreach.__name__, error))
+        assert all(torch.allclose(a, b, atol=1e-6) for a, b in zip(expected, result))
@@ -14,9 +14,9 @@ from .ralamb import Ralamb
 # Lookahead implementation from https://github.com/lonePatient/lookahead_pytorch/blob/master/optimizer.py
 # RAdam + LARS implementation from https://gist.github.com/redknightlois/c4023d393eb8f92bb44b2ab582d7ec20
 
-def Over9000(params, alpha=0.5, k=6, *args, **kwargs):
+def Over9000(params, alpha=0.5, k=6, flatten=False, slow_dtype=None, *args, **kwargs):
     ralamb = Ralamb(params, *args, **kwargs)
-    return Lookahead(ralamb, alpha, k)
+    return Lookahead(ralamb, alpha, k, flatten=flatten, slow_dtype=slow_dtype)
 
 
 RangerLars = Over9000
@@ -11,6 +11,6 @@ from .lookahead import Lookahead
 from .radam import RAdam
 
 
-def Ranger(params, alpha=0.5, k=6, betas=(.95, 0.999), *args, **kwargs):
+def Ranger(params, alpha=0.5, k=6, betas=(.95, 0.999), flatten=False, slow_dtype=None, *args, **kwargs):
     radam = RAdam(params, betas=betas, *args, **kwargs)
-    return Lookahead(radam, alpha, k)
+    return Lookahead(radam, alpha, k, flatten=flatten, slow_dtype=slow_dtype)
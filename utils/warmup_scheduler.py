@@ -33,6 +33,21 @@ class GradualWarmupScheduler(_LRScheduler):
 
         return [base_lr * ((self.multiplier - 1.) * self.last_epoch / self.total_epoch + 1.) for base_lr in self.base_lrs]
 
+    def state_dict(self):
+        """after_scheduler中保存了对optimizer的引用，因此单独保存其state_dict
+        """
+        state = {key: value for key, value in self.__dict__.items() if key not in ('optimizer', 'after_scheduler')}
+        if self.after_scheduler is not None:
+            state['after_scheduler'] = self.after_scheduler.state_dict()
+        return state
+
+    def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        after_scheduler_state = state_dict.pop('after_scheduler', None)
+        self.__dict__.update(state_dict)
+        if after_scheduler_state is not None and self.after_scheduler is not None:
+            self.after_scheduler.load_state_dict(after_scheduler_state)
+
     def step_ReduceLROnPlateau(self, metrics, epoch=None):
         if epoch is None:
             epoch = self.last_epoch + 1